@@ -0,0 +1,44 @@
+# albums.py — сборка альбомов (media group) из отдельных сообщений.
+# Telegram присылает альбом как несколько сообщений с общим media_group_id, каждое
+# своим апдейтом. Первое сообщение ждёт, пока перестанут приходить остальные,
+# и забирает весь альбом; хендлеры остальных частей сразу выходят.
+# Состояние — в памяти процесса, поэтому все части альбома должны попасть в один процесс
+# (polling — всегда; webhook с несколькими репликами — нет, см. main.ALBUMS).
+
+import os
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.types import Message
+
+# Разбирать альбом одним запросом к модели (0 — каждая картинка отдельно)
+ALBUM_BATCH = os.getenv("ALBUM_BATCH", "1") == "1"
+# Сколько ждать следующую часть альбома, сек (окно сдвигается с каждой новой частью)
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))
+# Больше картинок в одном альбоме Telegram не присылает
+ALBUM_MAX_ITEMS = int(os.getenv("ALBUM_MAX_ITEMS", "10"))
+
+
+class AlbumCollector:
+    """Копит сообщения альбома; collect() возвращает весь альбом первой части и None остальным."""
+
+    def __init__(self, window: float = ALBUM_WINDOW, max_items: int = ALBUM_MAX_ITEMS):
+        self.window = window
+        self.max_items = max_items
+        self._groups: Dict[Tuple[int, str], List[Message]] = {}
+
+    async def collect(self, m: Message) -> Optional[List[Message]]:
+        key = (m.chat.id, m.media_group_id)
+        group = self._groups.get(key)
+        if group is not None:
+            group.append(m)
+            return None
+        group = self._groups[key] = [m]
+        try:
+            seen = 0
+            while len(group) != seen and len(group) < self.max_items:
+                seen = len(group)
+                await asyncio.sleep(self.window)
+        finally:
+            del self._groups[key]
+        return sorted(group, key=lambda msg: msg.message_id)[: self.max_items]
@@ -0,0 +1,66 @@
+# bench/bench_downscale.py — микробенчмарк utils.encode_for_model по размерам и форматам.
+#
+#   python -m bench.bench_downscale --repeat 5
+#
+# Для каждой пары (размер, формат) печатает медиану и максимум времени,
+# размер входа и выхода, detail, оценку токенов и качество JPEG.
+
+import io
+import time
+import argparse
+import statistics
+
+from PIL import Image
+
+from bench.load import make_image
+from llm import image_token_budget, image_token_costs
+from utils import encode_for_model
+
+SIZES = (512, 1024, 1536, 2048, 4096, 6000)
+FORMATS = ("JPEG", "PNG", "WEBP")
+
+
+def photo_like(size: int, fmt: str) -> bytes:
+    """Шумная картинка (как фото с камеры): плохо сжимается, дорогое декодирование."""
+    w, h = size, size * 3 // 4
+    im = Image.merge("RGB", [Image.effect_noise((w, h), 40 + 10 * i) for i in range(3)])
+    out = io.BytesIO()
+    im.save(out, format=fmt, quality=90) if fmt != "PNG" else im.save(out, format=fmt)
+    return out.getvalue()
+
+
+def measure(data: bytes, repeat: int, max_side: int) -> tuple:
+    timings = []
+    out = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        out = encode_for_model(data, image_token_budget(), *image_token_costs(), max_side)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), max(timings), out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Микробенчмарк utils.encode_for_model")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-side", type=int, default=1536)
+    parser.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=SIZES)
+    parser.add_argument("--formats", type=lambda v: v.upper().split(","), default=FORMATS)
+    args = parser.parse_args()
+
+    print(
+        f"{'content':8} {'format':6} {'size':>6} {'in KB':>8} {'out KB':>8} {'median ms':>10} {'max ms':>8} "
+        f"{'detail':>6} {'tokens':>7} {'q':>3}"
+    )
+    for content, make in (("drawing", lambda s, f: make_image(s, s, f)), ("noise", photo_like)):
+        for fmt in args.formats:
+            for size in args.sizes:
+                data = make(size, fmt)
+                median, worst, out = measure(data, args.repeat, args.max_side)
+                print(
+                    f"{content:8} {fmt:6} {size:>6} {len(data) / 1024:>8.0f} {len(out.data) / 1024:>8.0f} "
+                    f"{median * 1000:>10.1f} {worst * 1000:>8.1f} {out.detail:>6} {out.tokens:>7} {out.quality or '-':>3}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# bench/fake_openai.py — локальная заглушка OpenAI Chat Completions для бенчмарков.
+# Настраиваемая задержка до первого токена, скорость «генерации» в режиме stream
+# и доля ответов 429 (с Retry-After). Можно запустить отдельно:
+#   python -m bench.fake_openai --port 8082 --latency 2.0 --chunks 40 --chunk-delay 0.05
+
+import io
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+from typing import Optional
+
+from aiohttp import web
+from PIL import Image
+
+from llm import image_token_costs
+from utils import vision_tokens
+
+REPLY_WORDS = (
+    "КОМПОЗИЦИЯ! Где ритм?! Цвет работает, но свет плоский. Силуэт читается, "
+    "а вот фон спорит с персонажем. Добавь контраст, убери мусор, и будет огонь! "
+).split()
+
+
+class FakeOpenAI:
+    def __init__(
+        self,
+        latency: float = 1.0,
+        jitter: float = 0.2,
+        chunks: int = 40,
+        chunk_delay: float = 0.03,
+        error_rate: float = 0.0,
+        retry_after: float = 1.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def _words(self) -> list:
+        return [REPLY_WORDS[i % len(REPLY_WORDS)] + " " for i in range(self.chunks)]
+
+    def _usage(self, body: dict) -> dict:
+        # картинки — по формуле плиток модели, текст — примерно 3 символа на токен
+        base, tile = image_token_costs(body.get("model"))
+        prompt = 0
+        for msg in body.get("messages", []):
+            parts = msg["content"] if isinstance(msg.get("content"), list) else [{"text": msg.get("content", "")}]
+            for part in parts:
+                if part.get("type") == "image_url":
+                    url = part["image_url"]["url"]
+                    w, h = Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))).size
+                    prompt += vision_tokens(w, h, part["image_url"].get("detail", "high"), base, tile)
+                else:
+                    prompt += len(part.get("text", "")) // 3 + 4
+        return {"prompt_tokens": prompt, "completion_tokens": self.chunks, "total_tokens": prompt + self.chunks}
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        if random.random() < self.error_rate:
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+            created = int(time.time())
+            model = body.get("model", "gpt-4o-mini")
+
+            if not body.get("stream"):
+                return web.json_response({
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(self._words())},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": self._usage(body),
+                })
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+
+            def chunk(delta: dict, finish: Optional[str] = None) -> bytes:
+                data = {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+                }
+                return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+            await response.write(chunk({"role": "assistant", "content": ""}))
+            for word in self._words():
+                await response.write(chunk({"content": word}))
+                await asyncio.sleep(self.chunk_delay)
+            await response.write(chunk({}, "stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage = {
+                    "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created,
+                    "model": model, "choices": [], "usage": self._usage(body),
+                }
+                await response.write(f"data: {json.dumps(usage)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            self.in_flight -= 1
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8082) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self._completions)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    fake = FakeOpenAI(args.latency, args.jitter, args.chunks, args.chunk_delay, args.error_rate)
+    url = await fake.start(port=args.port)
+    print(f"Fake OpenAI on {url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=1.0, help="сек до первого токена")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--chunks", type=int, default=40, help="кусков текста в ответе")
+    parser.add_argument("--chunk-delay", type=float, default=0.03)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    asyncio.run(_serve(parser.parse_args()))
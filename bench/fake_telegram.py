@@ -0,0 +1,134 @@
+# bench/fake_telegram.py — локальная заглушка Telegram Bot API для бенчмарков.
+# Отдаёт апдейты через getUpdates (long polling), файлы — через /file/bot<token>/...,
+# принимает sendMessage/editMessageText и запоминает, когда что пришло в какой чат.
+
+import time
+import asyncio
+import itertools
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    def __init__(self, bot_id: int = 1):
+        self.bot_id = bot_id
+        self.files: Dict[str, bytes] = {}
+        # chat_id -> [(время, метод, текст)]
+        self.events: Dict[int, List[tuple]] = defaultdict(list)
+        # chat_id -> время getFile / конца скачивания файла
+        self.get_file_at: Dict[int, float] = {}
+        self.download_done_at: Dict[int, float] = {}
+        self._file_chat: Dict[str, int] = {}
+        self._updates: List[dict] = []
+        self._new_updates = asyncio.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    # ---- наполнение ----
+
+    def add_file(self, file_id: str, data: bytes, chat_id: int) -> None:
+        self.files[file_id] = data
+        self._file_chat[file_id] = chat_id
+
+    async def push_update(self, message: dict) -> int:
+        """Кладёт апдейт с сообщением в очередь getUpdates. Возвращает update_id."""
+        update_id = next(self._update_ids)
+        async with self._new_updates:
+            self._updates.append({"update_id": update_id, "message": message})
+            self._new_updates.notify_all()
+        return update_id
+
+    def message(self, user_id: int, **fields) -> dict:
+        """Заготовка сообщения из личного чата пользователя user_id."""
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            **fields,
+        }
+
+    # ---- HTTP ----
+
+    def _ok(self, result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    def _sent(self, chat_id: int, text: str, message_id: Optional[int] = None) -> dict:
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": self.bot_id, "is_bot": True, "first_name": "bench"},
+            "text": text,
+        }
+
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+
+        if method == "getMe":
+            return self._ok({"id": self.bot_id, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(data))
+        if method == "getFile":
+            file_id = data["file_id"]
+            self.get_file_at[self._file_chat.get(file_id, 0)] = time.perf_counter()
+            return self._ok({
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.files[file_id]),
+                "file_path": f"photos/{file_id}",
+            })
+        if method == "sendMessage":
+            chat_id = int(data["chat_id"])
+            self.events[chat_id].append((time.perf_counter(), method, data["text"]))
+            return self._ok(self._sent(chat_id, data["text"]))
+        if method == "editMessageText":
+            chat_id = int(data["chat_id"])
+            self.events[chat_id].append((time.perf_counter(), method, data["text"]))
+            return self._ok(self._sent(chat_id, data["text"], int(data["message_id"])))
+        # deleteWebhook, setWebhook и прочее — просто «ок»
+        return self._ok(True)
+
+    async def _get_updates(self, data: dict) -> list:
+        offset = int(data.get("offset") or 0)
+        timeout = float(data.get("timeout") or 0)
+        limit = int(data.get("limit") or 100)
+        async with self._new_updates:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    async def _file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["path"].split("/")[-1]
+        data = self.files[file_id]
+        response = web.StreamResponse()
+        response.content_length = len(data)
+        await response.prepare(request)
+        await response.write(data)
+        await response.write_eof()
+        self.download_done_at[self._file_chat.get(file_id, 0)] = time.perf_counter()
+        return response
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._api)
+        app.router.add_get("/file/bot{token}/{path:.*}", self._file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
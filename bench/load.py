@@ -0,0 +1,276 @@
+# bench/load.py — сквозной нагрузочный тест: настоящий диспетчер из main.py (polling)
+# против заглушек Telegram Bot API и OpenAI и локального Postgres (или файла SQLite).
+#
+#   DATABASE_URL=postgresql://postgres@127.0.0.1/bench python -m bench.load --rate 10 --duration 30
+#   STORAGE_BACKEND=sqlite SQLITE_PATH=/tmp/bench.db python -m bench.load --rate 10 --duration 30
+#
+# Генерирует смесь апдейтов (фото, картинки-документы, альбомы, текстовые отзывы, команды)
+# с заданной средней частотой (пуассоновский поток) и печатает p50/p95/p99 по этапам
+# и итоговую пропускную способность. Пишет в базу из DATABASE_URL (пользователи
+# с id от 9_000_000_000) — используйте отдельную базу, не боевую.
+
+import io
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import defaultdict
+from typing import Dict, List
+
+from PIL import Image, ImageDraw
+
+from bench.fake_telegram import FakeTelegram
+from bench.fake_openai import FakeOpenAI
+
+USER_ID_BASE = 9_000_000_000
+OWNER_ID = USER_ID_BASE - 1
+FEEDBACK_GROUP_ID = -USER_ID_BASE
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        name, _, share = part.partition("=")
+        mix[name.strip()] = float(share)
+    unknown = set(mix) - {"photo", "document", "album", "feedback", "command"}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"неизвестные типы апдейтов: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def make_image(seed: int, size: int, fmt: str) -> bytes:
+    """Синтетическая «иллюстрация»: случайные цветные фигуры, у каждой seed свой перцептивный хэш."""
+    rnd = random.Random(seed)
+    w, h = size, size * 3 // 4
+    im = Image.new("RGB", (w, h), tuple(rnd.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(im)
+    for _ in range(24):
+        x, y = rnd.randrange(w), rnd.randrange(h)
+        box = (x, y, x + rnd.randrange(w // 8, w // 2), y + rnd.randrange(h // 8, h // 2))
+        color = tuple(rnd.randrange(256) for _ in range(3))
+        (draw.ellipse if rnd.random() < 0.5 else draw.rectangle)(box, fill=color)
+    out = io.BytesIO()
+    im.save(out, format=fmt, quality=88) if fmt == "JPEG" else im.save(out, format=fmt)
+    return out.getvalue()
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Request:
+    def __init__(self, kind: str, user_id: int, sent_at: float):
+        self.kind = kind
+        self.user_id = user_id
+        self.sent_at = sent_at
+
+
+async def run(args: argparse.Namespace) -> None:
+    fake_tg = FakeTelegram()
+    fake_oai = FakeOpenAI(args.latency, args.jitter, args.chunks, args.chunk_delay, args.error_rate)
+    tg_url = await fake_tg.start(port=args.telegram_port)
+    oai_url = await fake_oai.start(port=args.openai_port)
+
+    # Окружение для main.py — до его импорта
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "1:bench",
+        "OPENAI_API_KEY": "bench",
+        "TELEGRAM_API_URL": tg_url,
+        "OPENAI_BASE_URL": oai_url,
+        "OWNER_ID": str(OWNER_ID),
+        "FEEDBACK_GROUP_ID": str(FEEDBACK_GROUP_ID),
+    })
+    import main
+    from storage import inc_count
+
+    total = int(args.rate * args.duration)
+    mix = args.mix
+    kinds = random.choices(list(mix), weights=list(mix.values()), k=total)
+    user_ids = itertools.count(USER_ID_BASE + random.randrange(10**8) * 100)
+
+    n_images = kinds.count("photo") + kinds.count("document") + kinds.count("album") * args.album_size
+    print(f"Готовлю {n_images} картинок…", file=sys.stderr)
+    images: Dict[int, bytes] = {}
+    albums: Dict[int, List[bytes]] = {}
+    seeds = itertools.count(random.randrange(10**9))
+    first_seed = None
+    for i, kind in enumerate(kinds):
+        if kind in ("photo", "document"):
+            if first_seed is not None and random.random() < args.dup_ratio:
+                seed = first_seed  # повтор уже отправленной картинки — попадание в кэш
+            else:
+                seed = next(seeds)
+            first_seed = first_seed if first_seed is not None else seed
+            fmt = "JPEG" if kind == "photo" else "PNG"
+            images[i] = await asyncio.to_thread(make_image, seed, args.image_size, fmt)
+        elif kind == "album":
+            albums[i] = [
+                await asyncio.to_thread(make_image, next(seeds), args.image_size, "JPEG")
+                for _ in range(args.album_size)
+            ]
+
+    polling = asyncio.create_task(main.dp.start_polling(main.bot, handle_signals=False))
+    await asyncio.sleep(1.0)  # startup: init_db, getMe
+
+    # Пользователи для текстовых отзывов должны уже выбрать лимит
+    requests: List[Request] = []
+    feedback_users = [next(user_ids) for _ in range(kinds.count("feedback"))]
+    for user_id in feedback_users:
+        for _ in range(main.FREE_LIMIT):
+            await inc_count(user_id)
+
+    started = time.perf_counter()
+    next_at = started
+    for i, kind in enumerate(kinds):
+        user_id = feedback_users.pop() if kind == "feedback" else next(user_ids)
+        if kind == "photo":
+            file_id = f"p{i}"
+            fake_tg.add_file(file_id, images[i], user_id)
+            msg = fake_tg.message(user_id, photo=[
+                {"file_id": f"t{i}", "file_unique_id": f"t{i}", "width": 320, "height": 240},
+                {"file_id": file_id, "file_unique_id": file_id, "width": args.image_size,
+                 "height": args.image_size * 3 // 4, "file_size": len(images[i])},
+            ])
+        elif kind == "document":
+            file_id = f"d{i}"
+            fake_tg.add_file(file_id, images[i], user_id)
+            msg = fake_tg.message(user_id, document={
+                "file_id": file_id, "file_unique_id": file_id, "file_name": "art.png",
+                "mime_type": "image/png", "file_size": len(images[i]),
+            })
+        elif kind == "album":
+            # части альбома — отдельные апдейты с общим media_group_id, как шлёт Telegram
+            requests.append(Request(kind, user_id, time.perf_counter()))
+            for j, data in enumerate(albums[i]):
+                file_id = f"a{i}_{j}"
+                fake_tg.add_file(file_id, data, user_id)
+                await fake_tg.push_update(fake_tg.message(user_id, media_group_id=f"g{i}", photo=[
+                    {"file_id": file_id, "file_unique_id": file_id, "width": args.image_size,
+                     "height": args.image_size * 3 // 4, "file_size": len(data)},
+                ]))
+            next_at += random.expovariate(args.rate)
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            continue
+        elif kind == "feedback":
+            msg = fake_tg.message(user_id, text="Классный бот, но хочется подробнее про цвет.")
+        else:
+            msg = fake_tg.message(user_id, text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+
+        requests.append(Request(kind, user_id, time.perf_counter()))
+        await fake_tg.push_update(msg)
+
+        # пуассоновский поток: экспоненциальные интервалы со средним 1/rate
+        next_at += random.expovariate(args.rate)
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+
+    # Ждём, пока все ответят (или истечёт --drain)
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline:
+        if all(_final_event(fake_tg, r) for r in requests):
+            break
+        await asyncio.sleep(0.2)
+
+    await main.dp.stop_polling()
+    await polling
+    await fake_tg.stop()
+    await fake_oai.stop()
+
+    report(requests, fake_tg, fake_oai, started)
+
+
+def _final_event(fake_tg: FakeTelegram, req: Request):
+    """(время, текст) последнего ответа пользователю по запросу, или None, если ещё не ответили."""
+    for at, method, text in fake_tg.events.get(req.user_id, []):
+        if req.kind in ("photo", "document", "album"):
+            if "Осталось бесплатных запросов" in text or "Упс" in text or "слишком" in text:
+                return at, text
+        elif req.kind == "feedback":
+            if "отзыв" in text.lower():
+                return at, text
+        else:
+            return at, text
+    return None
+
+
+def report(requests: List[Request], fake_tg: FakeTelegram, fake_oai: FakeOpenAI, started: float) -> None:
+    stages: Dict[str, List[float]] = defaultdict(list)
+    done, errors, last_done = 0, 0, started
+
+    for req in requests:
+        final = _final_event(fake_tg, req)
+        if final is None:
+            continue
+        done += 1
+        final_at, text = final
+        last_done = max(last_done, final_at)
+        if "Упс" in text:
+            errors += 1
+            continue
+        stages[f"{req.kind}: end-to-end"].append(final_at - req.sent_at)
+        if req.kind not in ("photo", "document"):
+            continue
+
+        uid = req.user_id
+        events = fake_tg.events[uid]
+        get_file_at = fake_tg.get_file_at.get(uid)
+        download_at = fake_tg.download_done_at.get(uid)
+        placeholder_at = next((at for at, method, _ in events if method == "sendMessage"), None)
+        first_edit_at = next((at for at, method, _ in events if method == "editMessageText"), None)
+        if get_file_at:
+            stages["image: update → getFile (dispatch, quota)"].append(get_file_at - req.sent_at)
+        if get_file_at and download_at:
+            stages["image: download"].append(download_at - get_file_at)
+        if download_at and placeholder_at and placeholder_at < final_at:
+            stages["image: preprocess + cache lookup"].append(placeholder_at - download_at)
+            if first_edit_at and first_edit_at < final_at:
+                stages["image: model first text"].append(first_edit_at - placeholder_at)
+            stages["image: model + commit + reply"].append(final_at - placeholder_at)
+
+    print()
+    print(f"{'stage':45} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name in sorted(stages):
+        values = stages[name]
+        print(
+            f"{name:45} {len(values):>6} "
+            + " ".join(f"{percentile(values, q) * 1000:>9.1f}" for q in (0.5, 0.95, 0.99))
+            + f" {max(values) * 1000:>9.1f}"
+        )
+    elapsed = max(last_done - started, 1e-9)
+    print()
+    print(f"sent: {len(requests)}  answered: {done}  errors: {errors}  lost: {len(requests) - done}")
+    print(f"throughput: {done / elapsed:.2f} updates/s over {elapsed:.1f} s")
+    print(f"openai: {fake_oai.requests} requests, max in flight {fake_oai.max_in_flight}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест бота")
+    parser.add_argument("--rate", type=float, default=5.0, help="апдейтов в секунду (в среднем)")
+    parser.add_argument("--duration", type=float, default=20.0, help="сколько секунд подавать нагрузку")
+    parser.add_argument("--drain", type=float, default=60.0, help="сколько ждать ответов после подачи")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("photo=0.6,document=0.15,feedback=0.1,command=0.15"))
+    parser.add_argument("--album-size", type=int, default=3, help="картинок в одном альбоме (kind album в --mix)")
+    parser.add_argument("--dup-ratio", type=float, default=0.1, help="доля повторно отправленных картинок")
+    parser.add_argument("--image-size", type=int, default=2048, help="длинная сторона входных картинок")
+    parser.add_argument("--latency", type=float, default=1.5, help="задержка OpenAI до первого токена, сек")
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--chunks", type=int, default=60)
+    parser.add_argument("--chunk-delay", type=float, default=0.03)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов OpenAI 429")
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--openai-port", type=int, default=8082)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    if os.getenv("STORAGE_BACKEND", "postgres") == "postgres" and not os.getenv("DATABASE_URL"):
+        parser.error("нужен DATABASE_URL с локальным Postgres (отдельная база под бенчмарк) "
+                     "или STORAGE_BACKEND=sqlite")
+    if args.seed is not None:
+        random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
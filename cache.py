@@ -0,0 +1,117 @@
+# cache.py — кэш готовых разборов, чтобы одна и та же картинка не ходила в OpenAI дважды.
+# Два уровня: LRU в памяти процесса (мгновенно) и таблица analysis_cache в хранилище
+# (переживает рестарты, общая для всех процессов).
+# Точное совпадение (sha256) отдаётся любому пользователю. Перцептивный хэш у разных работ
+# может совпасть, поэтому по нему находятся только картинки того же пользователя —
+# его же пережатые копии; чужой разбор по похожему хэшу не отдаём.
+
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from storage import cache_lookup, cache_store, cache_prune
+from utils import image_hashes, run_in_pool
+
+log = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+CACHE_LRU_SIZE = int(os.getenv("CACHE_LRU_SIZE", "512"))       # записей в памяти
+CACHE_TTL_DAYS = int(os.getenv("CACHE_TTL_DAYS", "30"))
+CACHE_MAX_ROWS = int(os.getenv("CACHE_MAX_ROWS", "50000"))     # записей в хранилище
+CACHE_PRUNE_INTERVAL = int(os.getenv("CACHE_PRUNE_INTERVAL", "3600"))  # сек
+# Списывать ли бесплатный запрос, если ответ взят из кэша
+CACHE_HIT_COUNTS = os.getenv("CACHE_HIT_COUNTS", "1") == "1"
+
+
+class CacheKey(NamedTuple):
+    sha256: str
+    phash: Optional[int]  # None — картинка слишком «пустая» для перцептивного сравнения
+    user_id: int          # чьи картинки сравниваются по phash
+
+
+# sha256 -> (reply, stored_at); порядок = давность использования
+_lru: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+# (user_id, phash) -> sha256, чтобы пережатые копии находились и в памяти
+_by_phash: dict[tuple[int, int], str] = {}
+
+# dHash однотонных/почти пустых картинок вырождается в 0 или -1 (все биты одинаковые) —
+# по нему совпали бы совершенно разные работы, поэтому такие хэши не используем
+_DEGENERATE_PHASHES = {0, -1}
+
+
+async def cache_key(prepared_jpeg: bytes, user_id: int) -> CacheKey:
+    """Считает ключ по подготовленному JPEG (после utils.encode_for_model) в пуле процессов."""
+    sha, phash = await run_in_pool(image_hashes, prepared_jpeg)
+    return CacheKey(sha, None if phash in _DEGENERATE_PHASHES else phash, user_id)
+
+
+def _lru_get(key: CacheKey) -> Optional[str]:
+    sha = key.sha256 if key.sha256 in _lru else _by_phash.get((key.user_id, key.phash))
+    if sha is None or sha not in _lru:
+        return None
+    reply, stored_at = _lru[sha]
+    if time.time() - stored_at > CACHE_TTL_DAYS * 86400:
+        _lru_drop(sha)
+        return None
+    _lru.move_to_end(sha)
+    return reply
+
+
+def _lru_put(key: CacheKey, reply: str) -> None:
+    _lru[key.sha256] = (reply, time.time())
+    _lru.move_to_end(key.sha256)
+    if key.phash is not None:
+        _by_phash[(key.user_id, key.phash)] = key.sha256
+    while len(_lru) > CACHE_LRU_SIZE:
+        oldest, _ = next(iter(_lru.items()))
+        _lru_drop(oldest)
+
+
+def _lru_drop(sha: str) -> None:
+    _lru.pop(sha, None)
+    for owner_phash in [p for p, s in _by_phash.items() if s == sha]:
+        del _by_phash[owner_phash]
+
+
+async def get_cached_reply(key: CacheKey) -> Optional[str]:
+    """Готовый разбор из кэша или None. Сначала память, потом хранилище."""
+    if not CACHE_ENABLED:
+        return None
+    reply = _lru_get(key)
+    if reply is not None:
+        return reply
+    try:
+        reply = await cache_lookup(key.sha256, key.phash, key.user_id, CACHE_TTL_DAYS)
+    except Exception as e:
+        # кэш — не критичная часть: при ошибке просто идём в модель
+        log.warning("Cache lookup failed: %s", e)
+        return None
+    if reply is not None:
+        _lru_put(key, reply)
+    return reply
+
+
+async def store_reply(key: CacheKey, reply: str) -> None:
+    """Кладёт разбор в оба уровня кэша. Пустые ответы не кэшируем."""
+    if not CACHE_ENABLED or not reply:
+        return
+    _lru_put(key, reply)
+    try:
+        await cache_store(key.sha256, key.phash, key.user_id, reply)
+    except Exception as e:
+        log.warning("Cache store failed: %s", e)
+
+
+async def prune_loop() -> None:
+    """Фоновая чистка кэша в хранилище по TTL и размеру."""
+    while True:
+        try:
+            deleted = await cache_prune(CACHE_TTL_DAYS, CACHE_MAX_ROWS)
+            if deleted:
+                log.info("Cache prune: removed %s rows", deleted)
+        except Exception as e:
+            log.warning("Cache prune failed: %s", e)
+        await asyncio.sleep(CACHE_PRUNE_INTERVAL)
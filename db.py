@@ -1,63 +1,999 @@
-# db.py
-# Простая БД на SQLite для учёта бесплатных запросов по месяцам
-
+# db.py — SQLite: лимиты, фидбек, статистика, очередь разборов, кэш (тот же интерфейс, что db_pg.py).
+# Для одного узла и бенчмарков без сервера Postgres. Одно долгоживущее соединение в режиме WAL;
+# записи из разных корутин собираются в общую транзакцию и коммитятся пачкой (group commit).
+import os
+import math
+import time
+import asyncio
+import sqlite3
 import aiosqlite
+from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from metrics import timed_db, DB_COMMIT_BATCH
+
+DB_PATH = os.getenv("SQLITE_PATH", "bot.db")
+conn: Optional[aiosqlite.Connection] = None  # единственное соединение процесса
+
+# Групповой коммит: записи копятся в открытой транзакции не дольше SQLITE_COMMIT_INTERVAL сек
+# или до SQLITE_COMMIT_BATCH штук; функция записи возвращается только после COMMIT
+SQLITE_COMMIT_INTERVAL = float(os.getenv("SQLITE_COMMIT_INTERVAL", "0.002"))
+SQLITE_COMMIT_BATCH = int(os.getenv("SQLITE_COMMIT_BATCH", "128"))
+# NORMAL в WAL не теряет данные при падении процесса (только при отключении питания); FULL — fsync на каждый COMMIT
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "32768"))
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+# Сколько ждать блокировку записи, если в тот же файл пишет другой процесс (worker.py), мс
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Как часто listen_jobs проверяет, не закоммитил ли другой процесс новые задачи, сек
+SQLITE_LISTEN_INTERVAL = float(os.getenv("SQLITE_LISTEN_INTERVAL", "0.25"))
+
+# Через сколько секунд «зависшая» бронь слота перестаёт учитываться (как в db_pg)
+QUOTA_RESERVATION_TTL = int(os.getenv("QUOTA_RESERVATION_TTL", "600"))
+# Лимит, относительно которого month_rollup считает users_hit_limit
+ROLLUP_FREE_LIMIT = int(os.getenv("FREE_LIMIT", "3"))
+# Сколько последних месяцев (включая текущий) держать в usage/feedback; 0 — все
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "13"))
+# detach — перенести старые месяцы в таблицы <имя>_archived, drop — удалить
+RETENTION_MODE = os.getenv("RETENTION_MODE", "detach")
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", str(6 * 3600)))
 
-DB_PATH = "bot.db"
+_write_lock = asyncio.Lock()
+_pending: List[asyncio.Future] = []  # записи, ждущие COMMIT текущей транзакции
+_flush_task: Optional[asyncio.Task] = None
+
+# ---- утилиты ----
+
+def _add_months(month: str, n: int) -> str:
+    """'2024-12' + 1 -> '2025-01'."""
+    year, mon = map(int, month.split("-"))
+    total = year * 12 + (mon - 1) + n
+    return f"{total // 12:04d}-{total % 12 + 1:02d}"
+
+def _epoch_sql(month_ref: str) -> str:
+    """SQL: текущая эпоха сброса лимитов для месяца month_ref (параметр вида ?2 или колонка)."""
+    return f"COALESCE((SELECT epoch FROM limit_epochs WHERE month = {month_ref}), 0)"
+
+def _live_count(month_ref: str) -> str:
+    """SQL: count строки usage с учётом сбросов — из старой эпохи читается как 0."""
+    return f'(CASE WHEN epoch = {_epoch_sql(month_ref)} THEN "count" ELSE 0 END)'
 
 def current_month() -> str:
-    """Возвращает текущий месяц в формате YYYY-MM (например, '2025-08')."""
-    # Для простоты используем UTC — этого достаточно.
+    """YYYY-MM по UTC."""
     return datetime.utcnow().strftime("%Y-%m")
 
-async def init_db():
-    """Создаёт таблицу, если её ещё нет."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS usage (
-            user_id INTEGER,
-            month   TEXT,
-            count   INTEGER,
-            PRIMARY KEY (user_id, month)
-        );
-        """)
-        await db.commit()
+def _check() -> aiosqlite.Connection:
+    if conn is None:
+        raise RuntimeError("DB is not initialized. Call init_db() first.")
+    return conn
+
+async def _fetchone(sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+    # fetchall, а не fetchone: INSERT/UPDATE … RETURNING применяется, только когда
+    # оператор прочитан до конца
+    rows = await _check().execute_fetchall(sql, params)
+    return rows[0] if rows else None
+
+async def _usage_count(db: aiosqlite.Connection, user_id: int, month: str) -> Optional[int]:
+    """count пользователя с учётом сбросов; None — строки usage ещё нет."""
+    rows = await db.execute_fetchall(_USAGE_COUNT, (user_id, month))
+    return rows[0][0] if rows else None
+
+async def _rollup_add(
+    db: aiosqlite.Connection, month: str, old: Optional[int], new: int, feedback: int = 0
+) -> None:
+    """
+    Агрегаты месяца после смены count пользователя с old (None — строки не было) на new.
+    Вызывать в той же транзакции, что и запись в usage.
+    """
+    was = old or 0
+    deltas = (
+        int(old is None),
+        int(new >= ROLLUP_FREE_LIMIT) - int(was >= ROLLUP_FREE_LIMIT),
+        new - was,
+        feedback,
+    )
+    if any(deltas):
+        await db.execute(_ROLLUP_ADD, (month, ROLLUP_FREE_LIMIT) + deltas)
+
+async def _commit_locked() -> None:
+    """COMMIT открытой транзакции и пробуждение всех, кто её ждёт. Вызывать под _write_lock."""
+    global _pending
+    waiters, _pending = _pending, []
+    if not waiters:
+        return
+    try:
+        await conn.execute("COMMIT")
+    except Exception as e:
+        if conn.in_transaction:
+            await conn.execute("ROLLBACK")
+        for fut in waiters:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    DB_COMMIT_BATCH.observe(len(waiters))
+    for fut in waiters:
+        if not fut.done():
+            fut.set_result(None)
+
+async def _flush_later() -> None:
+    global _flush_task
+    try:
+        await asyncio.sleep(SQLITE_COMMIT_INTERVAL)
+        async with _write_lock:
+            await _commit_locked()
+    finally:
+        _flush_task = None
+
+@asynccontextmanager
+async def _write():
+    """
+    Одна логическая запись: SAVEPOINT внутри общей транзакции. Ошибка откатывает только
+    эту запись; выход из блока ждёт группового COMMIT, так что после него данные на диске.
+    """
+    global _flush_task
+    db = _check()
+    async with _write_lock:
+        if not db.in_transaction:
+            # IMMEDIATE: блокировка записи берётся сразу, другой процесс подождёт busy_timeout
+            await db.execute("BEGIN IMMEDIATE")
+        await db.execute("SAVEPOINT op")
+        try:
+            yield db
+        except BaseException:
+            await db.execute("ROLLBACK TO op")
+            await db.execute("RELEASE op")
+            if not _pending:
+                await db.execute("ROLLBACK")  # пустую транзакцию не держим открытой
+            raise
+        await db.execute("RELEASE op")
+        done = asyncio.get_running_loop().create_future()
+        _pending.append(done)
+        if len(_pending) >= SQLITE_COMMIT_BATCH:
+            await _commit_locked()
+        elif _flush_task is None:
+            _flush_task = asyncio.create_task(_flush_later())
+    await done
+
+# ---- запросы ----
+# Тексты запросов — константы: sqlite3 кэширует подготовленные операторы по тексту
+# (cached_statements), так что горячие запросы не компилируются заново
+
+_EPOCH = _epoch_sql("?2")
+_LIVE_COUNT = _live_count("?2")
+# То же внутри ON CONFLICT DO UPDATE: в excluded.epoch вставлялась текущая эпоха
+_UPSERT_COUNT = 'CASE WHEN epoch = excluded.epoch THEN "count" ELSE 0 END'
+
+_GET_QUOTA = f"""
+SELECT
+    COALESCE((SELECT {_LIVE_COUNT} FROM usage WHERE user_id = ?1 AND month = ?2), 0) AS "count",
+    EXISTS(SELECT 1 FROM feedback WHERE user_id = ?1 AND month = ?2) AS feedback_sent
+"""
+
+_USAGE_COUNT = f"SELECT {_LIVE_COUNT} FROM usage WHERE user_id = ?1 AND month = ?2"
+
+_INC_COUNT = f"""
+INSERT INTO usage(user_id, month, "count", epoch) VALUES (?1, ?2, 1, {_EPOCH})
+ON CONFLICT (user_id, month) DO UPDATE SET "count" = {_UPSERT_COUNT} + 1, epoch = excluded.epoch
+RETURNING "count"
+"""
+
+_RESERVE_SLOT = f"""
+INSERT INTO usage(user_id, month, "count", reserved, reserved_at, epoch) VALUES (?1, ?2, 0, ?6, ?3, {_EPOCH})
+ON CONFLICT (user_id, month) DO UPDATE SET
+    reserved = CASE WHEN reserved_at < ?3 - ?4 THEN ?6 ELSE reserved + ?6 END,
+    reserved_at = ?3,
+    "count" = {_UPSERT_COUNT},
+    epoch = excluded.epoch
+WHERE {_UPSERT_COUNT} + CASE WHEN reserved_at < ?3 - ?4 THEN 0 ELSE reserved END + ?6 <= ?5
+RETURNING "count"
+"""
+
+_SLOTS_USED = f"""
+SELECT {_LIVE_COUNT}, CASE WHEN reserved_at < ?3 - ?4 THEN 0 ELSE reserved END
+FROM usage WHERE user_id = ?1 AND month = ?2
+"""
+
+_COMMIT_SLOT = f"""
+INSERT INTO usage(user_id, month, "count", epoch) VALUES (?1, ?2, ?3, {_EPOCH})
+ON CONFLICT (user_id, month) DO UPDATE SET
+    "count" = {_UPSERT_COUNT} + ?3,
+    reserved = MAX(reserved - ?3 - ?4, 0),
+    epoch = excluded.epoch
+RETURNING "count"
+"""
+
+_RELEASE_SLOT = f"""
+UPDATE usage SET reserved = MAX(reserved - ?3, 0) WHERE user_id = ?1 AND month = ?2
+RETURNING {_LIVE_COUNT}
+"""
+
+_SETTLE_JOB = "UPDATE jobs SET settled = 1 WHERE id = ? AND settled = 0"
+
+_GRANT_BONUS = f"""
+INSERT INTO usage(user_id, month, "count", epoch) VALUES (?1, ?2, 0, {_EPOCH})
+ON CONFLICT (user_id, month) DO UPDATE SET "count" = MAX({_UPSERT_COUNT} - ?3, 0), epoch = excluded.epoch
+RETURNING "count"
+"""
+
+# Прибавляет дельты к строке месяца в month_rollup (см. db_pg._ROLLUP_ADD)
+_ROLLUP_ADD = """
+INSERT INTO month_rollup(month, free_limit, users_total, users_hit_limit, total_requests, feedback_count)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (month) DO UPDATE SET
+    users_total     = users_total     + excluded.users_total,
+    users_hit_limit = users_hit_limit + excluded.users_hit_limit,
+    total_requests  = total_requests  + excluded.total_requests,
+    feedback_count  = feedback_count  + excluded.feedback_count
+"""
+
+_CLAIM_JOB = """
+UPDATE jobs SET status = 'running', attempts = attempts + 1, lease = lease + 1, visible_at = ?1 + ?2
+WHERE id = (
+    SELECT id FROM jobs
+    WHERE status IN ('queued', 'running') AND visible_at <= ?1
+    ORDER BY visible_at, id
+    LIMIT 1
+)
+RETURNING *, ?1 - created_at AS age
+"""
+
+_CACHE_LOOKUP = """
+UPDATE analysis_cache SET last_hit_at = ?5, hits = hits + 1
+WHERE sha256 = (
+    SELECT sha256 FROM analysis_cache
+    WHERE (sha256 = ?1 OR (user_id = ?3 AND phash = ?2)) AND created_at > ?5 - ?4 * 86400
+    ORDER BY (sha256 = ?1) DESC, created_at DESC
+    LIMIT 1
+)
+RETURNING reply
+"""
+
+# ---- секции по месяцам ----
+# В SQLite секций нет: обслуживание — перенос/удаление строк старых месяцев
+
+@timed_db
+async def maintain_partitions() -> List[str]:
+    """
+    Месяцы старше RETENTION_MONTHS переносятся в usage_archived/feedback_archived/events_archived
+    или удаляются (RETENTION_MODE). Возвращает снятые месяцы в виде «таблица_YYYY_MM».
+    """
+    _check()
+    if RETENTION_MONTHS <= 0:
+        return []
+    oldest = _add_months(current_month(), -(RETENTION_MONTHS - 1))
+    removed: List[str] = []
+    async with _write() as db:
+        for table in ("usage", "feedback", "events"):
+            months = [r[0] for r in await db.execute_fetchall(
+                f"SELECT DISTINCT month FROM {table} WHERE month < ?", (oldest,)
+            )]
+            if not months:
+                continue
+            if RETENTION_MODE != "drop":
+                await db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table}_archived AS SELECT * FROM {table} WHERE 0"
+                )
+                await db.execute(f"INSERT INTO {table}_archived SELECT * FROM {table} WHERE month < ?", (oldest,))
+            await db.execute(f"DELETE FROM {table} WHERE month < ?", (oldest,))
+            removed += [f"{table}_{m.replace('-', '_')}" for m in months]
+        await db.execute("DELETE FROM limit_epochs WHERE month < ?", (oldest,))
+    for name in removed:
+        print(f"[DB] Месяц {name}: {'удалён' if RETENTION_MODE == 'drop' else 'перенесён в архив'}")
+    return removed
+
+async def partition_maintenance_loop() -> None:
+    """Фоновая задача: раз в PARTITION_MAINTENANCE_INTERVAL вызывает maintain_partitions."""
+    while True:
+        try:
+            await maintain_partitions()
+        except Exception as e:
+            print(f"[DB] Обслуживание старых месяцев не удалось: {e}")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+# ---- миграции схемы ----
+# Версия схемы — в PRAGMA user_version (заголовок файла БД, читается без обращения к таблицам).
+# Изменение схемы — новая функция в конец _MIGRATIONS; уже применённые миграции не меняются.
+
+async def _migration_1(db: aiosqlite.Connection) -> None:
+    """
+    Исходная схема. Все операторы идемпотентны: на базе, созданной до версионирования,
+    миграция только досоздаст недостающее.
+    """
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS usage (
+        user_id     INTEGER NOT NULL,
+        month       TEXT    NOT NULL,
+        "count"     INTEGER NOT NULL,
+        reserved    INTEGER NOT NULL DEFAULT 0,
+        reserved_at REAL,
+        PRIMARY KEY (user_id, month)
+    )
+    """)
+    # таблица из старой версии db.py — только (user_id, month, count)
+    columns = {r["name"] for r in await db.execute_fetchall("PRAGMA table_info(usage)")}
+    if "reserved" not in columns:
+        await db.execute("ALTER TABLE usage ADD COLUMN reserved INTEGER NOT NULL DEFAULT 0")
+        await db.execute("ALTER TABLE usage ADD COLUMN reserved_at REAL")
+    await db.execute("CREATE INDEX IF NOT EXISTS usage_month_idx ON usage (month)")
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS feedback (
+        id         INTEGER PRIMARY KEY,
+        user_id    INTEGER NOT NULL,
+        month      TEXT    NOT NULL,
+        text       TEXT    NOT NULL,
+        created_at REAL    NOT NULL
+    )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS feedback_user_month_idx ON feedback (user_id, month)")
+    await db.execute("CREATE INDEX IF NOT EXISTS feedback_month_idx ON feedback (month)")
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS events (
+        month             TEXT    NOT NULL,
+        created_at        REAL    NOT NULL,
+        kind              TEXT    NOT NULL,
+        user_id           INTEGER NOT NULL,
+        outcome           TEXT    NOT NULL,
+        error             TEXT,
+        latency_ms        INTEGER NOT NULL,
+        images            INTEGER,
+        bytes_in          INTEGER,
+        bytes_out         INTEGER,
+        prompt_tokens     INTEGER,
+        completion_tokens INTEGER
+    )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS events_month_idx ON events (month, kind, outcome, latency_ms)")
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS admin_codes (
+        name       TEXT PRIMARY KEY,
+        code       TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """)
+
+    # Очередь разборов, как в db_pg; visible_at и created_at — unix-время
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id             INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id        INTEGER NOT NULL,
+        chat_id        INTEGER NOT NULL,
+        file_id        TEXT    NOT NULL,
+        file_size      INTEGER,
+        placeholder_id INTEGER,
+        status         TEXT    NOT NULL DEFAULT 'queued',
+        attempts       INTEGER NOT NULL DEFAULT 0,
+        visible_at     REAL    NOT NULL,
+        last_error     TEXT,
+        created_at     REAL    NOT NULL
+    )
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS jobs_pending_idx ON jobs (visible_at, id) "
+        "WHERE status IN ('queued', 'running')"
+    )
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS analysis_cache (
+        sha256      TEXT PRIMARY KEY,
+        phash       INTEGER,
+        user_id     INTEGER,
+        reply       TEXT    NOT NULL,
+        created_at  REAL    NOT NULL,
+        last_hit_at REAL    NOT NULL,
+        hits        INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS analysis_cache_user_phash_idx ON analysis_cache (user_id, phash)"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS analysis_cache_last_hit_idx ON analysis_cache (last_hit_at)")
+
+async def _migration_2(db: aiosqlite.Connection) -> None:
+    # Номер захвата задачи (см. db_pg._migration_2)
+    columns = {row[1] for row in await db.execute_fetchall("PRAGMA table_info(jobs)")}
+    if "lease" not in columns:
+        await db.execute("ALTER TABLE jobs ADD COLUMN lease INTEGER NOT NULL DEFAULT 0")
+
+async def _migration_3(db: aiosqlite.Connection) -> None:
+    # Бронь задачи уже закрыта (см. db_pg._migration_3)
+    columns = {row[1] for row in await db.execute_fetchall("PRAGMA table_info(jobs)")}
+    if "settled" not in columns:
+        await db.execute("ALTER TABLE jobs ADD COLUMN settled INTEGER NOT NULL DEFAULT 0")
+
+async def _migration_4(db: aiosqlite.Connection) -> None:
+    # Эпохи сброса лимитов и месячные агрегаты для /stats (см. db_pg._migration_1):
+    # /reset_limits не переписывает usage, /stats читает одну строку.
+    # usage_archived (если есть) копирует usage через SELECT * — колонка нужна и там
+    for table in ("usage", "usage_archived"):
+        columns = {row[1] for row in await db.execute_fetchall(f"PRAGMA table_info({table})")}
+        if columns and "epoch" not in columns:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0")
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS limit_epochs (
+        month TEXT PRIMARY KEY,
+        epoch INTEGER NOT NULL
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS month_rollup (
+        month           TEXT PRIMARY KEY,
+        free_limit      INTEGER NOT NULL,
+        users_total     INTEGER NOT NULL DEFAULT 0,
+        users_hit_limit INTEGER NOT NULL DEFAULT 0,
+        total_requests  INTEGER NOT NULL DEFAULT 0,
+        feedback_count  INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+async def _migration_5(db: aiosqlite.Connection) -> None:
+    # Пересылка отзывов из таблицы (см. db_pg._migration_4); feedback_archived — как в _migration_4
+    for table in ("feedback", "feedback_archived"):
+        columns = {row[1] for row in await db.execute_fetchall(f"PRAGMA table_info({table})")}
+        if columns and "forward_at" not in columns:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN username TEXT")
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN forward_at REAL")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS feedback_forward_idx ON feedback (forward_at) WHERE forward_at IS NOT NULL"
+    )
+
+_MIGRATIONS = (
+    (1, "initial schema", _migration_1),
+    (2, "jobs.lease", _migration_2),
+    (3, "jobs.settled", _migration_3),
+    (4, "limit epochs, month_rollup", _migration_4),
+    (5, "feedback forwarding", _migration_5),
+)
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+async def _schema_version(db: aiosqlite.Connection) -> int:
+    return (await db.execute_fetchall("PRAGMA user_version"))[0][0]
+
+# ---- инициализация ----
+
+async def init_db() -> None:
+    """
+    Открывает соединение, настраивает pragma и применяет недостающие миграции.
+    На актуальной схеме — только чтение user_version и агрегата текущего месяца.
+    """
+    global conn
+    if conn is None:
+        # isolation_level=None — транзакциями управляем сами (BEGIN IMMEDIATE / групповой COMMIT)
+        conn = await aiosqlite.connect(DB_PATH, isolation_level=None, cached_statements=256)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA journal_mode = WAL")
+        await conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        await conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        await conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_KB}")
+        await conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_BYTES}")
+        await conn.execute("PRAGMA temp_store = MEMORY")
+
+    if await _schema_version(conn) < SCHEMA_VERSION:
+        # BEGIN IMMEDIATE в _write сериализует процессы (бот и воркеры): версию перечитываем под ним
+        async with _write() as db:
+            version = await _schema_version(db)
+            for number, name, migration in _MIGRATIONS:
+                if number <= version:
+                    continue
+                await migration(db)
+                await db.execute(f"PRAGMA user_version = {number:d}")
+                print(f"[DB] Применена миграция {number}: {name}")
+
+    m = current_month()
+    row = await _fetchone("SELECT free_limit FROM month_rollup WHERE month = ?", (m,))
+    if row is None or row[0] != ROLLUP_FREE_LIMIT:
+        # Досчитываем текущий месяц по сырым таблицам, если агрегата ещё нет
+        # (первый запуск с этой таблицей) или сменился FREE_LIMIT — как в db_pg.init_db
+        async with _write() as db:
+            await db.execute(f"""
+            INSERT INTO month_rollup
+                (month, free_limit, users_total, users_hit_limit, total_requests, feedback_count)
+            SELECT ?1, ?2,
+                (SELECT COUNT(*) FROM usage WHERE month = ?1),
+                (SELECT COUNT(*) FROM usage WHERE month = ?1 AND {_live_count("?1")} >= ?2),
+                (SELECT COALESCE(SUM({_live_count("?1")}), 0) FROM usage WHERE month = ?1),
+                (SELECT COUNT(*) FROM feedback WHERE month = ?1)
+            ON CONFLICT (month) DO UPDATE
+            SET free_limit = excluded.free_limit, users_hit_limit = excluded.users_hit_limit
+            WHERE free_limit <> excluded.free_limit
+            """, (m, ROLLUP_FREE_LIMIT))
+
+@timed_db
+async def warm_db() -> None:
+    """
+    Подгружает в кэш страниц индексы, которые читает каждый запрос (квота месяца, очередь);
+    соединение одно, открывать больше нечего.
+    """
+    db = _check()
+    await db.execute_fetchall("SELECT COUNT(*) FROM usage WHERE month = ?", (current_month(),))
+    await db.execute_fetchall("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')")
+
+async def close_db() -> None:
+    """Коммитит накопленные записи и закрывает соединение."""
+    global conn
+    if conn is None:
+        return
+    async with _write_lock:
+        await _commit_locked()
+        await conn.close()
+        conn = None
+
+# ---- функции лимитов/фидбека ----
+
+@timed_db
+async def get_quota(user_id: int) -> Tuple[int, bool]:
+    """(сколько запросов сделал в текущем месяце, отправлял ли фидбек в этом месяце)."""
+    row = await _fetchone(_GET_QUOTA, (user_id, current_month()))
+    return int(row["count"]), bool(row["feedback_sent"])
 
 async def get_count(user_id: int) -> int:
-    """Сколько запросов сделал пользователь в этом месяце."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT count FROM usage WHERE user_id = ? AND month = ?",
-            (user_id, current_month())
-        )
-        row = await cur.fetchone()
-        return row[0] if row else 0
+    """Сколько запросов сделал пользователь в текущем месяце."""
+    count, _ = await get_quota(user_id)
+    return count
 
+@timed_db
 async def inc_count(user_id: int) -> int:
+    """Увеличивает счётчик на 1 и возвращает новое значение."""
+    m = current_month()
+    async with _write() as db:
+        old = await _usage_count(db, user_id, m)
+        new_count = (await db.execute_fetchall(_INC_COUNT, (user_id, m)))[0][0]
+        await _rollup_add(db, m, old, new_count)
+    return new_count
+
+# ---- бронирование слотов: reserve → (долгий вызов модели) → commit или release ----
+
+@timed_db
+async def reserve_slot(user_id: int, free_limit: int, n: int = 1) -> bool:
     """
-    Увеличивает счётчик на 1 и возвращает новое значение.
-    Если записи ещё нет — создаёт её с 1.
+    Атомарно бронирует n запросов (все или ни одного), если count + брони + n <= free_limit.
+    Брони старше QUOTA_RESERVATION_TTL считаются брошенными и не учитываются.
     """
+    _check()
+    if n <= 0 or free_limit < n:
+        return False
     m = current_month()
-    async with aiosqlite.connect(DB_PATH) as db:
-        # читаем текущее значение
-        cur = await db.execute(
-            "SELECT count FROM usage WHERE user_id = ? AND month = ?",
-            (user_id, m)
+    async with _write() as db:
+        old = await _usage_count(db, user_id, m)
+        rows = await db.execute_fetchall(
+            _RESERVE_SLOT, (user_id, m, time.time(), QUOTA_RESERVATION_TTL, free_limit, n)
         )
-        row = await cur.fetchone()
-        if row:
-            new_count = row[0] + 1
-            await db.execute(
-                "UPDATE usage SET count = ? WHERE user_id = ? AND month = ?",
-                (new_count, user_id, m)
+        if rows:
+            await _rollup_add(db, m, old, rows[0][0])
+    return bool(rows)
+
+@timed_db
+async def reserve_up_to(user_id: int, free_limit: int, n: int) -> int:
+    """
+    Бронирует сколько влезет из n запросов: min(n, free_limit - count - брони).
+    Возвращает, сколько забронировано (0 — лимит исчерпан). Расчёт и бронь — в одной
+    транзакции записи, между ними никто не влезет.
+    """
+    _check()
+    if n <= 0 or free_limit <= 0:
+        return 0
+    m = current_month()
+    params = (user_id, m, time.time(), QUOTA_RESERVATION_TTL, free_limit)
+    async with _write() as db:
+        rows = await db.execute_fetchall(_SLOTS_USED, params[:4])
+        count, reserved = rows[0] if rows else (None, 0)
+        n = min(n, free_limit - (count or 0) - reserved)
+        if n <= 0:
+            return 0
+        await db.execute_fetchall(_RESERVE_SLOT, params + (n,))
+        await _rollup_add(db, m, count, count or 0)
+    return n
+
+@timed_db
+async def commit_slot(user_id: int, n: int = 1, release: int = 0, job_id: Optional[int] = None) -> int:
+    """
+    Превращает n забронированных запросов в списанные и тем же запросом снимает ещё release
+    броней без списания. Возвращает новое значение счётчика.
+    job_id — бронь задачи очереди, закрывается один раз на задачу (как в db_pg).
+    """
+    async with _write() as db:
+        if job_id is not None and (await db.execute(_SETTLE_JOB, (job_id,))).rowcount == 0:
+            return await get_count(user_id)  # бронь задачи уже закрыта раньше
+        m = current_month()
+        old = await _usage_count(db, user_id, m)
+        new_count = (await db.execute_fetchall(_COMMIT_SLOT, (user_id, m, n, release)))[0][0]
+        await _rollup_add(db, m, old, new_count)
+    return new_count
+
+@timed_db
+async def release_slot(user_id: int, n: int = 1, job_id: Optional[int] = None) -> int:
+    """
+    Снимает n броней без списания (ошибка, ответ не засчитывается). Возвращает текущий счётчик.
+    job_id — как в commit_slot: бронь задачи, уже закрытую раньше, не трогает.
+    """
+    async with _write() as db:
+        if job_id is not None and (await db.execute(_SETTLE_JOB, (job_id,))).rowcount == 0:
+            return await get_count(user_id)
+        rows = await db.execute_fetchall(_RELEASE_SLOT, (user_id, current_month(), n))
+    return rows[0][0] if rows else 0
+
+async def already_sent_feedback_this_month(user_id: int) -> bool:
+    """Проверка: отправлял ли фидбек в этом месяце (для выдачи бонуса только 1 раз/мес)."""
+    _, feedback = await get_quota(user_id)
+    return feedback
+
+@timed_db
+async def save_feedback_and_grant_bonus(
+    user_id: int,
+    text: str,
+    free_limit: Optional[int] = None,
+    username: Optional[str] = None,
+) -> None:
+    """
+    Сохраняет фидбек и «выдаёт +free_limit» (по факту — уменьшает счётчик на free_limit),
+    но только 1 раз в текущем месяце. Сохранённый отзыв ждёт пересылки (claim_feedback).
+    """
+    if free_limit is None:
+        try:
+            free_limit = int(os.getenv("FREE_LIMIT", "3"))
+        except Exception:
+            free_limit = 3
+
+    m = current_month()
+    async with _write() as db:
+        # транзакция уже держит блокировку записи — между проверкой и вставкой никто не влезет
+        exists = await db.execute_fetchall(
+            "SELECT 1 FROM feedback WHERE user_id = ? AND month = ? LIMIT 1", (user_id, m)
+        )
+        if exists:
+            return
+        now = time.time()
+        await db.execute(
+            "INSERT INTO feedback(user_id, month, text, created_at, username, forward_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, m, text, now, username, now)
+        )
+        old = await _usage_count(db, user_id, m)
+        new_count = (await db.execute_fetchall(_GRANT_BONUS, (user_id, m, free_limit)))[0][0]
+        await _rollup_add(db, m, old, new_count, feedback=1)
+
+@timed_db
+async def claim_feedback(min_age: float, visibility_timeout: int, limit: int = 100) -> List[sqlite3.Row]:
+    """Отзывы, ждущие пересылки (как в db_pg.claim_feedback)."""
+    async with _write() as db:
+        rows = await db.execute_fetchall(
+            """
+            UPDATE feedback SET forward_at = ?1 + ?3
+            WHERE id IN (
+                SELECT id FROM feedback
+                WHERE forward_at <= ?1
+                  AND EXISTS (SELECT 1 FROM feedback WHERE forward_at <= ?1 AND created_at <= ?1 - ?2)
+                ORDER BY id
+                LIMIT ?4
             )
-        else:
-            new_count = 1
-            await db.execute(
-                "INSERT INTO usage(user_id, month, count) VALUES (?,?,?)",
-                (user_id, m, new_count)
+            RETURNING id, month, user_id, username, text
+            """,
+            (time.time(), min_age, visibility_timeout, limit)
+        )
+    return sorted(rows, key=lambda r: r["id"])
+
+@timed_db
+async def ack_feedback(keys: Sequence[Tuple[int, str]]) -> None:
+    """Отзывы (id, month) из claim_feedback пересланы — больше их не забирать."""
+    async with _write() as db:
+        await db.executemany("UPDATE feedback SET forward_at = NULL WHERE id = ?", [(k[0],) for k in keys])
+
+# ---- коды подтверждения ----
+
+@timed_db
+async def set_admin_code(name: str, code: str) -> None:
+    """Запоминает код подтверждения для команды name (старый код перезаписывается)."""
+    async with _write() as db:
+        await db.execute(
+            """
+            INSERT INTO admin_codes(name, code, created_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET code = excluded.code, created_at = excluded.created_at
+            """,
+            (name, code, time.time())
+        )
+
+@timed_db
+async def consume_admin_code(name: str, code: str, ttl_seconds: int = 600) -> bool:
+    """Проверяет и гасит код: True, только если код совпал и не старше ttl_seconds."""
+    async with _write() as db:
+        rows = await db.execute_fetchall(
+            "DELETE FROM admin_codes WHERE name = ? AND code = ? AND created_at > ? RETURNING 1",
+            (name, code, time.time() - ttl_seconds)
+        )
+    return bool(rows)
+
+# ---- очередь разборов ----
+
+@timed_db
+async def enqueue_job(
+    user_id: int,
+    chat_id: int,
+    file_id: str,
+    file_size: Optional[int] = None,
+    placeholder_id: Optional[int] = None,
+) -> int:
+    """Ставит картинку в очередь на разбор. Возвращает id задачи."""
+    now = time.time()
+    async with _write() as db:
+        row = (await db.execute_fetchall(
+            """
+            INSERT INTO jobs(user_id, chat_id, file_id, file_size, placeholder_id, visible_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+            """,
+            (user_id, chat_id, file_id, file_size, placeholder_id, now, now)
+        ))[0]
+    return row[0]
+
+@timed_db
+async def claim_job(visibility_timeout: int) -> Optional[sqlite3.Row]:
+    """
+    Забирает одну готовую к работе задачу (или None, если таких нет).
+    Задача становится невидимой для других воркеров на visibility_timeout сек
+    (продлевается extend_job); lease и age в строке — как в db_pg.claim_job.
+    SKIP LOCKED не нужен: транзакция записи в SQLite одна на всю базу.
+    """
+    async with _write() as db:
+        rows = await db.execute_fetchall(_CLAIM_JOB, (time.time(), visibility_timeout))
+    return rows[0] if rows else None
+
+@timed_db
+async def complete_job(job_id: int, lease: int) -> bool:
+    """Задача выполнена — удаляем её из очереди. False — задачу уже перехватил другой воркер."""
+    async with _write() as db:
+        cursor = await db.execute("DELETE FROM jobs WHERE id = ? AND lease = ?", (job_id, lease))
+    return cursor.rowcount > 0
+
+@timed_db
+async def extend_job(job_id: int, lease: int, visibility_timeout: int) -> bool:
+    """
+    Продлевает невидимость задачи ещё на visibility_timeout сек (heartbeat воркера).
+    False — задачу уже перехватил другой воркер, продолжать её нельзя.
+    """
+    async with _write() as db:
+        cursor = await db.execute(
+            "UPDATE jobs SET visible_at = ? WHERE id = ? AND lease = ? AND status = 'running'",
+            (time.time() + visibility_timeout, job_id, lease)
+        )
+    return cursor.rowcount > 0
+
+@timed_db
+async def retry_job(
+    job_id: int, lease: int, delay_seconds: float, error: str, refund_attempt: bool = False
+) -> bool:
+    """
+    Возвращает задачу в очередь, чтобы повторить через delay_seconds.
+    refund_attempt — попытка не засчитывается (задачу просто отложили, например из-за перегрузки).
+    False — задачу уже перехватил другой воркер.
+    """
+    async with _write() as db:
+        cursor = await db.execute(
+            """
+            UPDATE jobs SET status = 'queued', visible_at = ?, last_error = ?,
+                attempts = attempts - ?
+            WHERE id = ? AND lease = ?
+            """,
+            (time.time() + delay_seconds, error, int(refund_attempt), job_id, lease)
+        )
+    return cursor.rowcount > 0
+
+@timed_db
+async def fail_job(job_id: int, lease: int, error: str) -> bool:
+    """
+    Окончательно помечает задачу неудачной (остаётся в таблице для разбора).
+    False — задачу уже перехватил другой воркер.
+    """
+    async with _write() as db:
+        cursor = await db.execute(
+            "UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ? AND lease = ?", (error, job_id, lease)
+        )
+    return cursor.rowcount > 0
+
+class _JobsListener:
+    """
+    Замена LISTEN/NOTIFY: PRAGMA data_version меняется, когда в файл закоммитил
+    другой процесс (бот поставил задачу) — тогда вызываем callback.
+    """
+
+    def __init__(self, callback):
+        self._task = asyncio.create_task(self._poll(callback))
+
+    async def _poll(self, callback) -> None:
+        version = None
+        while True:
+            try:
+                row = await _fetchone("PRAGMA data_version")
+                if version is not None and row[0] != version:
+                    callback()
+                version = row[0]
+            except Exception as e:
+                print(f"[DB] data_version не прочитан: {e}")
+            await asyncio.sleep(SQLITE_LISTEN_INTERVAL)
+
+    async def close(self) -> None:
+        self._task.cancel()
+
+async def listen_jobs(callback) -> _JobsListener:
+    """callback() вызывается, когда другой процесс что-то записал в базу (например, новую задачу)."""
+    _check()
+    return _JobsListener(callback)
+
+# ---- кэш разборов ----
+
+@timed_db
+async def cache_lookup(sha256: str, phash: Optional[int], user_id: int, ttl_days: int) -> Optional[str]:
+    """
+    Ищет готовый разбор: сначала точное совпадение по sha256, потом по phash
+    среди картинок того же пользователя. Просроченные (старше ttl_days) записи не возвращаются.
+    """
+    async with _write() as db:
+        rows = await db.execute_fetchall(_CACHE_LOOKUP, (sha256, phash, user_id, ttl_days, time.time()))
+    return rows[0][0] if rows else None
+
+@timed_db
+async def cache_store(sha256: str, phash: Optional[int], user_id: int, reply: str) -> None:
+    """Сохраняет разбор в кэш (перезаписывает, если такой ключ уже был)."""
+    now = time.time()
+    async with _write() as db:
+        await db.execute(
+            """
+            INSERT INTO analysis_cache(sha256, phash, user_id, reply, created_at, last_hit_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (sha256) DO UPDATE
+            SET phash = excluded.phash, user_id = excluded.user_id, reply = excluded.reply,
+                created_at = excluded.created_at, last_hit_at = excluded.last_hit_at
+            """,
+            (sha256, phash, user_id, reply, now, now)
+        )
+
+@timed_db
+async def cache_prune(ttl_days: int, max_rows: int) -> int:
+    """
+    Чистит кэш: удаляет просроченные записи и всё, что не влезает в max_rows
+    (сначала то, к чему дольше всего не обращались). Возвращает число удалённых строк.
+    """
+    async with _write() as db:
+        expired = await db.execute(
+            "DELETE FROM analysis_cache WHERE created_at <= ?", (time.time() - ttl_days * 86400,)
+        )
+        overflow = await db.execute(
+            """
+            DELETE FROM analysis_cache WHERE sha256 IN (
+                SELECT sha256 FROM analysis_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?
             )
-        await db.commit()
-        return new_count
+            """,
+            (max_rows,)
+        )
+        return expired.rowcount + overflow.rowcount
+
+# ---- статистика ----
+
+@timed_db
+async def month_stats(free_limit: Optional[int] = None) -> Tuple[int, int, int, int]:
+    """
+    Возвращает (users_total, users_hit_limit, total_requests, feedback_count) за текущий месяц.
+    users_hit_limit — пользователи, у кого count >= FREE_LIMIT.
+    """
+    if free_limit is None:
+        try:
+            free_limit = int(os.getenv("FREE_LIMIT", "3"))
+        except Exception:
+            free_limit = 3
+
+    m = current_month()
+    row = await _fetchone("SELECT * FROM month_rollup WHERE month = ?", (m,))
+    if row is None:
+        # в этом месяце ещё никто ничего не делал
+        return 0, 0, 0, 0
+    users_hit_limit = row["users_hit_limit"]
+    if row["free_limit"] != free_limit:
+        # агрегат посчитан под другой лимит — этот показатель считаем напрямую
+        users_hit_limit = (await _fetchone(
+            f"SELECT COUNT(*) FROM usage WHERE month = ?1 AND {_live_count('?1')} >= ?2", (m, free_limit)
+        ))[0]
+    return (
+        int(row["users_total"]), int(users_hit_limit),
+        int(row["total_requests"]), int(row["feedback_count"]),
+    )
+
+# ---- журнал событий ----
+
+@timed_db
+async def insert_events(events: Sequence[tuple]) -> None:
+    """Пачка событий (events.Event: имена полей — колонки) одним executemany в групповой транзакции."""
+    if not events:
+        return
+    columns = events[0]._fields
+    async with _write() as db:
+        await db.executemany(
+            f"INSERT INTO events ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            events
+        )
+
+@timed_db
+async def event_breakdown() -> List[Tuple[str, str, int, int, int]]:
+    """
+    События текущего месяца по (kind, outcome): (kind, outcome, n, p50_ms, p95_ms),
+    самые частые сначала. Перцентилей в SQLite нет — строка с нужным номером по индексу.
+    """
+    m = current_month()
+    groups = await _check().execute_fetchall(
+        "SELECT kind, outcome, COUNT(*) FROM events WHERE month = ? GROUP BY kind, outcome ORDER BY 3 DESC",
+        (m,)
+    )
+    result = []
+    for kind, outcome, n in groups:
+        percentiles = []
+        for q in (0.5, 0.95):
+            row = await _fetchone(
+                """
+                SELECT latency_ms FROM events WHERE month = ? AND kind = ? AND outcome = ?
+                ORDER BY latency_ms LIMIT 1 OFFSET ?
+                """,
+                (m, kind, outcome, max(math.ceil(n * q) - 1, 0))
+            )
+            percentiles.append(row[0])
+        result.append((kind, outcome, n, *percentiles))
+    return result
+
+@timed_db
+async def event_daily(days: int = 7) -> List[Tuple[str, int, int, int]]:
+    """
+    Последние days дней (UTC) с событиями разбора: (YYYY-MM-DD, запросов к модели,
+    входных токенов, выходных токенов), по порядку дат.
+    """
+    rows = await _check().execute_fetchall(
+        """
+        SELECT strftime('%Y-%m-%d', created_at, 'unixepoch') AS day,
+               COUNT(prompt_tokens), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0)
+        FROM events WHERE month >= ? AND created_at >= ?
+        GROUP BY day ORDER BY day
+        """,
+        (_add_months(current_month(), -1), time.time() - days * 86400)
+    )
+    return [tuple(r) for r in rows]
+
+# ---- сбросы ----
+
+@timed_db
+async def reset_all_limits() -> None:
+    """
+    Сбрасывает счётчики запросов для всех пользователей в текущем месяце.
+    Строки usage не переписываются: эпоха месяца +1, старые счётчики читаются как 0.
+    """
+    m = current_month()
+    async with _write() as db:
+        await db.execute(
+            """
+            INSERT INTO limit_epochs(month, epoch) VALUES (?, 1)
+            ON CONFLICT (month) DO UPDATE SET epoch = epoch + 1
+            """,
+            (m,)
+        )
+        await db.execute(
+            """
+            UPDATE month_rollup
+            SET total_requests = 0,
+                users_hit_limit = CASE WHEN free_limit <= 0 THEN users_total ELSE 0 END
+            WHERE month = ?
+            """,
+            (m,)
+        )
+
+@timed_db
+async def reset_bot() -> None:
+    """
+    Полный сброс бота: очищает все основные таблицы (usage, feedback, month_rollup,
+    limit_epochs, admin_codes, jobs, analysis_cache, events).
+    ВНИМАНИЕ: это необратимо.
+    """
+    async with _write() as db:
+        for table in (
+            "usage", "feedback", "month_rollup", "limit_epochs", "admin_codes", "jobs", "analysis_cache", "events"
+        ):
+            deleted = await db.execute(f"DELETE FROM {table}")
+            print(f"[RESET BOT] Таблица {table} очищена. Было строк: {deleted.rowcount}")
+        await db.execute("DELETE FROM sqlite_sequence WHERE name = 'jobs'")
+    print("[RESET BOT] Полный сброс завершён.")
@@ -1,111 +1,747 @@
 # db_pg.py — Postgres: лимиты, фидбек, статистика (месячная)
 import os
+import time
+import asyncio
 import asyncpg
-from datetime import datetime
-from typing import Optional, Tuple
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from metrics import timed_db, DB_POOL_WAIT_SECONDS
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Соединений в пуле (warm_db открывает их все сразу после старта)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
 pool: Optional[asyncpg.Pool] = None  # глобальный пул
 
+# Кэш квоты (count, отправлял ли фидбек) на пользователя, сек.
+# Короткий TTL + запись/инвалидация во всех функциях, которые меняют эти данные.
+# Инвалидация — только в своём процессе: если квоту меняют и другие процессы (реплики
+# webhook.py при заданном WEBHOOK_URL, воркеры при JOB_QUEUE=1), кэш по умолчанию выключен
+_SHARED_QUOTA = bool(os.getenv("WEBHOOK_URL")) or os.getenv("JOB_QUEUE", "0") == "1"
+QUOTA_CACHE_TTL = float(os.getenv("QUOTA_CACHE_TTL", "0" if _SHARED_QUOTA else "5"))
+_quota_cache: Dict[int, Tuple[float, str, int, bool]] = {}  # user_id -> (expires_at, month, count, feedback)
+
+# Через сколько секунд «зависшая» бронь слота (процесс упал между reserve и commit/release)
+# перестаёт учитываться
+QUOTA_RESERVATION_TTL = int(os.getenv("QUOTA_RESERVATION_TTL", "600"))
+
+# Лимит, относительно которого month_rollup считает users_hit_limit
+ROLLUP_FREE_LIMIT = int(os.getenv("FREE_LIMIT", "3"))
+
+# Прибавляет дельты к строке месяца в month_rollup; {source} — VALUES/SELECT с дельтами
+_ROLLUP_ADD = """
+    INSERT INTO public."month_rollup"
+        (month, free_limit, users_total, users_hit_limit, total_requests, feedback_count)
+    {source}
+    ON CONFLICT (month) DO UPDATE SET
+        users_total     = public."month_rollup".users_total     + EXCLUDED.users_total,
+        users_hit_limit = public."month_rollup".users_hit_limit + EXCLUDED.users_hit_limit,
+        total_requests  = public."month_rollup".total_requests  + EXCLUDED.total_requests,
+        feedback_count  = public."month_rollup".feedback_count  + EXCLUDED.feedback_count
+"""
+
 # ---- утилиты ----
 
+def _epoch_sql(month_ref: str) -> str:
+    """SQL: текущая эпоха сброса лимитов для месяца month_ref (параметр вида $2 или колонка)."""
+    return f'COALESCE((SELECT epoch FROM public."limit_epochs" WHERE month = {month_ref}), 0)'
+
+def _live_count(month_ref: str) -> str:
+    """SQL: count строки usage с учётом сбросов — из старой эпохи читается как 0."""
+    return f'(CASE WHEN epoch = {_epoch_sql(month_ref)} THEN "count" ELSE 0 END)'
+
+# То же внутри ON CONFLICT DO UPDATE: в EXCLUDED.epoch вставлялась текущая эпоха
+_LIVE_COUNT = 'CASE WHEN public."usage".epoch = EXCLUDED.epoch THEN public."usage"."count" ELSE 0 END'
+
+def _add_months(month: str, n: int) -> str:
+    """'2024-12' + 1 -> '2025-01'."""
+    year, mon = map(int, month.split("-"))
+    total = year * 12 + (mon - 1) + n
+    return f"{total // 12:04d}-{total % 12 + 1:02d}"
+
+def _partition_name(table: str, month: str) -> str:
+    return f"{table}_{month.replace('-', '_')}"
+
 def current_month() -> str:
     """YYYY-MM по UTC."""
     return datetime.utcnow().strftime("%Y-%m")
 
+def _quota_get(user_id: int, month: str) -> Optional[Tuple[int, bool]]:
+    entry = _quota_cache.get(user_id)
+    if entry is None:
+        return None
+    expires_at, cached_month, count, feedback = entry
+    if cached_month != month or expires_at < time.monotonic():
+        _quota_cache.pop(user_id, None)
+        return None
+    return count, feedback
+
+def _quota_put(user_id: int, month: str, count: int, feedback: bool) -> None:
+    if QUOTA_CACHE_TTL > 0:
+        _quota_cache[user_id] = (time.monotonic() + QUOTA_CACHE_TTL, month, count, feedback)
+
+def _quota_set_count(user_id: int, month: str, count: int) -> None:
+    """Write-through для счётчика: обновляем запись, только если она уже есть."""
+    cached = _quota_get(user_id, month)
+    if cached is not None:
+        _quota_put(user_id, month, count, cached[1])
+
+@asynccontextmanager
+async def _acquire():
+    """pool.acquire() с замером ожидания свободного соединения."""
+    started = time.perf_counter()
+    async with pool.acquire() as conn:
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+        yield conn
+
+# ---- секции по месяцам ----
+
+# Таблицы, секционированные по month
+PARTITIONED_TABLES = ("usage", "feedback", "events")
+# Сколько последних месяцев (включая текущий) держать в секционированных таблицах; 0 — все
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "13"))
+# Что делать со старыми месяцами: detach — отцепить в отдельную таблицу <имя>_archived (архив), drop — удалить
+RETENTION_MODE = os.getenv("RETENTION_MODE", "detach")
+# Как часто проверять секции и срок хранения, сек
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", str(6 * 3600)))
+
+_USAGE_DDL = """
+CREATE TABLE public."usage" (
+    user_id     BIGINT  NOT NULL,
+    month       TEXT    NOT NULL,
+    count       INTEGER NOT NULL,
+    reserved    INTEGER NOT NULL DEFAULT 0,
+    reserved_at TIMESTAMPTZ,
+    epoch       INTEGER NOT NULL DEFAULT 0,
+    -- TRUE, пока строку только вставили; каждый ON CONFLICT DO UPDATE ставит FALSE.
+    -- Так upsert отличает вставку от обновления: xmax = 0 у секционированной таблицы недоступен
+    is_new      BOOLEAN NOT NULL DEFAULT TRUE,
+    PRIMARY KEY (user_id, month)
+) PARTITION BY RANGE (month);
+"""
+
+_FEEDBACK_DDL = """
+CREATE TABLE public."feedback" (
+    id         BIGINT NOT NULL DEFAULT nextval('public.feedback_id_seq'),
+    user_id    BIGINT NOT NULL,
+    month      TEXT   NOT NULL,
+    text       TEXT   NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, month)
+) PARTITION BY RANGE (month);
+"""
+
+# Журнал событий (events.py): только вставки COPY пачками, без ключа и индексов —
+# отчёты читают секцию месяца целиком
+_EVENTS_DDL = """
+CREATE TABLE public."events" (
+    month             TEXT        NOT NULL,
+    created_at        TIMESTAMPTZ NOT NULL,
+    kind              TEXT        NOT NULL,
+    user_id           BIGINT      NOT NULL,
+    outcome           TEXT        NOT NULL,
+    error             TEXT,
+    latency_ms        INTEGER     NOT NULL,
+    images            INTEGER,
+    bytes_in          INTEGER,
+    bytes_out         INTEGER,
+    prompt_tokens     INTEGER,
+    completion_tokens INTEGER
+) PARTITION BY RANGE (month);
+"""
+
+async def _relkind(conn: asyncpg.Connection, table: str) -> Optional[str]:
+    """'p' — секционированная, 'r' — обычная таблица, None — таблицы нет."""
+    return await conn.fetchval(
+        """
+        SELECT c.relkind::text FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public' AND c.relname = $1
+        """,
+        table
+    )
+
+async def _create_partitioned_tables(conn: asyncpg.Connection) -> None:
+    """
+    Создаёт usage, feedback и events секционированными. Старые обычные таблицы (до секционирования)
+    переносятся: данные во временную таблицу, пересоздание, секции под все месяцы, обратно.
+    Вызывать в транзакции под advisory-локом схемы.
+    """
+    await conn.execute('CREATE SEQUENCE IF NOT EXISTS public."feedback_id_seq";')
+    for table, ddl in (("usage", _USAGE_DDL), ("feedback", _FEEDBACK_DDL), ("events", _EVENTS_DDL)):
+        kind = await _relkind(conn, table)
+        if kind == "p":
+            continue
+        if kind == "r":
+            if table == "usage":
+                # колонки, добавленные до секционирования
+                await conn.execute("""
+                ALTER TABLE public."usage"
+                    ADD COLUMN IF NOT EXISTS reserved    INTEGER NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS reserved_at TIMESTAMPTZ,
+                    ADD COLUMN IF NOT EXISTS epoch       INTEGER NOT NULL DEFAULT 0;
+                """)
+            else:
+                # последовательность id переживёт пересоздание таблицы
+                await conn.execute('ALTER SEQUENCE public."feedback_id_seq" OWNED BY NONE;')
+            await conn.execute(
+                f'CREATE TEMP TABLE "{table}_migrate" ON COMMIT DROP AS SELECT * FROM public."{table}";'
+            )
+            await conn.execute(f'DROP TABLE public."{table}";')
+            await conn.execute(ddl)
+            months = [r["month"] for r in await conn.fetch(f'SELECT DISTINCT month FROM "{table}_migrate"')]
+            await _ensure_partitions(conn, months, tables=(table,))
+            columns = ", ".join(
+                f'"{r["attname"]}"' for r in await conn.fetch(
+                    """
+                    SELECT attname FROM pg_attribute
+                    WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped
+                    """,
+                    f'"{table}_migrate"'
+                )
+            )
+            await conn.execute(
+                f'INSERT INTO public."{table}" ({columns}) SELECT {columns} FROM "{table}_migrate";'
+            )
+            print(f"[DB] Таблица {table} секционирована по месяцам ({len(months)} мес.)")
+        else:
+            await conn.execute(ddl)
+    await conn.execute('ALTER SEQUENCE public."feedback_id_seq" OWNED BY public."feedback".id;')
+    # проверка «фидбек в этом месяце» внутри секции месяца
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS feedback_user_month_idx ON public."feedback" (user_id, month);'
+    )
+
+async def _ensure_partitions(
+    conn: asyncpg.Connection, months: List[str], tables: Tuple[str, ...] = PARTITIONED_TABLES
+) -> None:
+    """Создаёт недостающие секции под месяцы (формат YYYY-MM)."""
+    for table in tables:
+        for month in months:
+            datetime.strptime(month, "%Y-%m")  # в DDL параметры не передать — проверяем формат
+            await conn.execute(
+                f'CREATE TABLE IF NOT EXISTS public."{_partition_name(table, month)}" '
+                f'PARTITION OF public."{table}" '
+                f"FOR VALUES FROM ('{month}') TO ('{_add_months(month, 1)}');"
+            )
+
+@timed_db
+async def maintain_partitions() -> List[str]:
+    """
+    Секции текущего и следующего месяца создаются заранее; месяцы старше
+    RETENTION_MONTHS отцепляются в архив или удаляются (RETENTION_MODE).
+    Возвращает имена снятых секций.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    m = current_month()
+    removed: List[str] = []
+    async with _acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('art_bot_schema'))")
+            await _ensure_partitions(conn, [m, _add_months(m, 1)])
+            if RETENTION_MONTHS <= 0:
+                return removed
+            oldest = _add_months(m, -(RETENTION_MONTHS - 1))
+            for table in PARTITIONED_TABLES:
+                rows = await conn.fetch(
+                    """
+                    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = $1::regclass
+                    """,
+                    f'public."{table}"'
+                )
+                for row in rows:
+                    name = row["relname"]
+                    month = name[len(table) + 1:].replace("_", "-")
+                    if month >= oldest:
+                        continue
+                    if RETENTION_MODE == "drop":
+                        await conn.execute(f'DROP TABLE public."{name}";')
+                    else:
+                        await conn.execute(f'ALTER TABLE public."{table}" DETACH PARTITION public."{name}";')
+                        await conn.execute(f'ALTER TABLE public."{name}" RENAME TO "{name}_archived";')
+                    removed.append(name)
+            await conn.execute('DELETE FROM public."limit_epochs" WHERE month < $1', oldest)
+    for name in removed:
+        print(f"[DB] Секция {name}: {'удалена' if RETENTION_MODE == 'drop' else 'перенесена в архив'}")
+    return removed
+
+async def partition_maintenance_loop() -> None:
+    """Фоновая задача: раз в PARTITION_MAINTENANCE_INTERVAL вызывает maintain_partitions."""
+    while True:
+        try:
+            await maintain_partitions()
+        except Exception as e:
+            print(f"[DB] Обслуживание секций не удалось: {e}")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+# ---- миграции схемы ----
+# Версия схемы — в schema_migrations. При старте схема проверяется одним запросом;
+# если она актуальна, DDL не выполняется. Изменение схемы — новая функция в конец
+# _MIGRATIONS; уже применённые миграции не меняются.
+
+async def _migration_1(conn: asyncpg.Connection) -> None:
+    """
+    Исходная схема. Все операторы идемпотентны: на базе, созданной до версионирования,
+    миграция только досоздаст недостающее.
+    """
+    # usage, feedback и events секционированы по месяцу (RANGE по month): горячие запросы
+    # трогают только секцию текущего месяца, старые месяцы снимаются целиком
+    await _create_partitioned_tables(conn)
+
+    # Эпохи сброса лимитов: /reset_limits — это +1 к эпохе месяца, а не UPDATE всех строк.
+    # Строка usage со старой эпохой читается как count = 0 и догоняется при следующей записи
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS public."limit_epochs" (
+        month TEXT PRIMARY KEY,
+        epoch INTEGER NOT NULL
+    );
+    """)
+
+    # Готовые месячные агрегаты для /stats. Обновляются в тех же запросах/транзакциях,
+    # что и usage/feedback, так что /stats — чтение одной строки
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS public."month_rollup" (
+        month           TEXT PRIMARY KEY,
+        free_limit      INTEGER NOT NULL,
+        users_total     INTEGER NOT NULL DEFAULT 0,
+        users_hit_limit INTEGER NOT NULL DEFAULT 0,
+        total_requests  BIGINT  NOT NULL DEFAULT 0,
+        feedback_count  INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+    # Одноразовые коды подтверждения админ-команд (/reset_all). Живут в БД,
+    # а не в памяти процесса, чтобы работать при нескольких репликах бота
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS public."admin_codes" (
+        name       TEXT PRIMARY KEY,
+        code       TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+
+    # Очередь разборов: хендлер ставит задачу, воркеры (worker.py) забирают
+    # через FOR UPDATE SKIP LOCKED. status: queued → running → (удаляется) | failed.
+    # visible_at — когда задачу можно взять: отложенный повтор или истёкший
+    # таймаут видимости у running (воркер умер — задачу заберёт другой)
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS public."jobs" (
+        id             BIGSERIAL PRIMARY KEY,
+        user_id        BIGINT NOT NULL,
+        chat_id        BIGINT NOT NULL,
+        file_id        TEXT   NOT NULL,
+        file_size      BIGINT,
+        placeholder_id BIGINT,
+        status         TEXT   NOT NULL DEFAULT 'queued',
+        attempts       INTEGER NOT NULL DEFAULT 0,
+        visible_at     TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        last_error     TEXT,
+        created_at     TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    """)
+    await conn.execute(
+        """CREATE INDEX IF NOT EXISTS jobs_pending_idx ON public."jobs" (visible_at, id)
+        WHERE status IN ('queued', 'running');"""
+    )
+
+    # Кэш готовых разборов: ключ — sha256 подготовленного JPEG,
+    # phash — перцептивный хэш, чтобы совпадали и пережатые копии того же пользователя
+    # (64 бита dHash у разных работ иногда совпадают — чужой разбор по нему не отдаём)
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS public."analysis_cache" (
+        sha256      TEXT PRIMARY KEY,
+        phash       BIGINT,
+        user_id     BIGINT,
+        reply       TEXT   NOT NULL,
+        created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        last_hit_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        hits        INTEGER NOT NULL DEFAULT 0
+    );
+    """)
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS analysis_cache_user_phash_idx ON public."analysis_cache" (user_id, phash);'
+    )
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS analysis_cache_last_hit_idx ON public."analysis_cache" (last_hit_at);'
+    )
+
+async def _migration_2(conn: asyncpg.Connection) -> None:
+    # Номер захвата задачи: растёт с каждым claim_job и никогда не уменьшается (в отличие
+    # от attempts). Воркер закрывает и продлевает задачу только со своим номером — если
+    # её успел перехватить другой воркер, опоздавший ничего не испортит.
+    await conn.execute('ALTER TABLE public."jobs" ADD COLUMN IF NOT EXISTS lease INTEGER NOT NULL DEFAULT 0;')
+
+async def _migration_3(conn: asyncpg.Connection) -> None:
+    # Бронь квоты задачи уже закрыта (commit или release). Ставится тем же запросом, что
+    # закрывает бронь, и закрыть её второй раз не даёт: повтор задачи после сбоя доставки,
+    # перехват другим воркером или _give_up после списания не спишут и не снимут слот дважды.
+    await conn.execute('ALTER TABLE public."jobs" ADD COLUMN IF NOT EXISTS settled BOOLEAN NOT NULL DEFAULT FALSE;')
+
+async def _migration_4(conn: asyncpg.Connection) -> None:
+    # Отзывы пересылаются владельцу из таблицы, а не из памяти процесса (см. claim_feedback):
+    # forward_at — с какого момента отзыв можно забрать в дайджест, NULL — уже переслан
+    # (в том числе все строки, сохранённые до этой миграции)
+    await conn.execute(
+        'ALTER TABLE public."feedback" ADD COLUMN IF NOT EXISTS username TEXT, '
+        'ADD COLUMN IF NOT EXISTS forward_at TIMESTAMPTZ;'
+    )
+    await conn.execute(
+        'CREATE INDEX IF NOT EXISTS feedback_forward_idx ON public."feedback" (forward_at) '
+        'WHERE forward_at IS NOT NULL;'
+    )
+
+_MIGRATIONS = (
+    (1, "initial schema", _migration_1),
+    (2, "jobs.lease", _migration_2),
+    (3, "jobs.settled", _migration_3),
+    (4, "feedback forwarding", _migration_4),
+)
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+async def _schema_version(conn: asyncpg.Connection) -> int:
+    """Последняя применённая миграция; 0 — таблицы schema_migrations ещё нет."""
+    try:
+        return await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM public."schema_migrations"')
+    except asyncpg.UndefinedTableError:
+        return 0
+
+async def _migrate(conn: asyncpg.Connection) -> None:
+    """
+    Применяет недостающие миграции в одной транзакции под advisory-локом схемы:
+    реплики, стартующие одновременно, ждут друг друга, и каждая миграция выполняется один раз.
+    """
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('art_bot_schema'))")
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS public."schema_migrations" (
+            version    INTEGER PRIMARY KEY,
+            name       TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """)
+        version = await _schema_version(conn)  # другая реплика могла успеть раньше
+        for number, name, migration in _MIGRATIONS:
+            if number <= version:
+                continue
+            await migration(conn)
+            await conn.execute(
+                'INSERT INTO public."schema_migrations"(version, name) VALUES ($1, $2)', number, name
+            )
+            print(f"[DB] Применена миграция {number}: {name}")
+
 # ---- инициализация ----
 
 async def init_db() -> None:
-    """Создаёт пул и таблицы (если ещё нет)."""
+    """
+    Создаёт пул и приводит схему к SCHEMA_VERSION. На актуальной схеме — два запроса:
+    версия схемы и проверка секций месяца с агрегатом /stats. Соединения пула
+    до DB_POOL_SIZE открывает warm_db — уже после старта, параллельно с приёмом апдейтов.
+    """
     global pool
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL не задан. Проверь переменные окружения.")
 
     if pool is None:
-        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=DB_POOL_SIZE)
 
-    async with pool.acquire() as conn:
-        # Таблица учёта количества запросов на пользователя в пределах месяца
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS public."usage" (
-            user_id BIGINT NOT NULL,
-            month   TEXT   NOT NULL,
-            count   INTEGER NOT NULL,
-            PRIMARY KEY (user_id, month)
-        );
-        """)
+    m = current_month()
+    months = [m, _add_months(m, 1)]
+    async with _acquire() as conn:
+        if await _schema_version(conn) < SCHEMA_VERSION:
+            await _migrate(conn)
 
-        # Таблица пользовательских отзывов (фидбек для +3 попыток)
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS public."feedback" (
-            id         BIGSERIAL PRIMARY KEY,
-            user_id    BIGINT NOT NULL,
-            month      TEXT   NOT NULL,
-            text       TEXT   NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        );
-        """)
+        partitions, rollup_limit = await conn.fetchrow(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                 WHERE n.nspname = 'public' AND c.relname = ANY($1::text[])),
+                (SELECT free_limit FROM public."month_rollup" WHERE month = $2)
+            """,
+            [_partition_name(t, month) for t in PARTITIONED_TABLES for month in months], m
+        )
+        if partitions < len(PARTITIONED_TABLES) * len(months):
+            # после простоя дольше месяца секций текущего месяца может не быть
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('art_bot_schema'))")
+                await _ensure_partitions(conn, months)
+
+        if rollup_limit != ROLLUP_FREE_LIMIT:
+            # Досчитываем текущий месяц по сырым таблицам, если агрегата ещё нет
+            # (первый запуск с этой таблицей) или сменился FREE_LIMIT
+            await conn.execute("""
+            INSERT INTO public."month_rollup"
+                (month, free_limit, users_total, users_hit_limit, total_requests, feedback_count)
+            SELECT $1, $2,
+                (SELECT COUNT(*) FROM public."usage" WHERE month=$1),
+                (SELECT COUNT(*) FROM public."usage" WHERE month=$1 AND """ + _live_count("$1") + """ >= $2),
+                (SELECT COALESCE(SUM(""" + _live_count("$1") + """), 0) FROM public."usage" WHERE month=$1),
+                (SELECT COUNT(*) FROM public."feedback" WHERE month=$1)
+            ON CONFLICT (month) DO UPDATE
+            SET free_limit = EXCLUDED.free_limit, users_hit_limit = EXCLUDED.users_hit_limit
+            WHERE public."month_rollup".free_limit <> EXCLUDED.free_limit;
+            """, current_month(), ROLLUP_FREE_LIMIT)
+
+@timed_db
+async def warm_db() -> None:
+    """
+    Открывает соединения пула до DB_POOL_SIZE параллельно, чтобы первые запросы после
+    старта не ждали подключения. Занятые хендлерами соединения не ждём.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    free = pool.get_max_size() - pool.get_size() + pool.get_idle_size()
+    conns = await asyncio.gather(*(pool.acquire() for _ in range(free)), return_exceptions=True)
+    for conn in conns:
+        if isinstance(conn, BaseException):
+            print(f"[DB] Прогрев пула: {conn}")
+        else:
+            await pool.release(conn)
+
+async def close_db() -> None:
+    """Закрывает пул."""
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
 
 # ---- функции лимитов/фидбека ----
 
-async def get_count(user_id: int) -> int:
-    """Сколько запросов сделал пользователь в текущем месяце."""
+@timed_db
+async def get_quota(user_id: int) -> Tuple[int, bool]:
+    """
+    (сколько запросов сделал в текущем месяце, отправлял ли фидбек в этом месяце) —
+    одним запросом к БД, с коротким кэшем в памяти.
+    """
     if pool is None:
         raise RuntimeError("DB pool is not initialized. Call init_db() first.")
     m = current_month()
-    async with pool.acquire() as conn:
+    cached = _quota_get(user_id, m)
+    if cached is not None:
+        return cached
+    async with _acquire() as conn:
         row = await conn.fetchrow(
-            'SELECT "count" FROM public."usage" WHERE user_id=$1 AND month=$2',
+            """
+            SELECT
+                COALESCE((SELECT """ + _live_count("$2") + """ FROM public."usage" WHERE user_id=$1 AND month=$2), 0)
+                    AS count,
+                EXISTS(SELECT 1 FROM public."feedback" WHERE user_id=$1 AND month=$2) AS feedback_sent
+            """,
             user_id, m
         )
-        return int(row["count"]) if row else 0
+    count, feedback = int(row["count"]), bool(row["feedback_sent"])
+    _quota_put(user_id, m, count, feedback)
+    return count, feedback
+
+async def get_count(user_id: int) -> int:
+    """Сколько запросов сделал пользователь в текущем месяце."""
+    count, _ = await get_quota(user_id)
+    return count
 
+@timed_db
 async def inc_count(user_id: int) -> int:
     """Увеличивает счётчик на 1 и возвращает новое значение."""
     if pool is None:
         raise RuntimeError("DB pool is not initialized. Call init_db() first.")
     m = current_month()
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
+        new_count = await conn.fetchval(
+            """
+            WITH u AS (
+                INSERT INTO public."usage"(user_id, month, "count", epoch) VALUES ($1, $2, 1, """ + _epoch_sql("$2") + """)
+                ON CONFLICT (user_id, month) DO UPDATE SET
+                    "count" = """ + _LIVE_COUNT + """ + 1,
+                    epoch   = EXCLUDED.epoch,
+                    is_new  = FALSE
+                RETURNING "count", is_new AS inserted
+            ), r AS (""" + _ROLLUP_ADD.format(
+                source='SELECT $2, $3, u.inserted::int, (u."count" = $3)::int, 1, 0 FROM u'
+            ) + """)
+            SELECT "count" FROM u
+            """,
+            user_id, m, ROLLUP_FREE_LIMIT
+        )
+    _quota_set_count(user_id, m, new_count)
+    return new_count
+
+# ---- бронирование слотов: reserve → (долгий вызов модели) → commit или release ----
+
+@timed_db
+async def reserve_slot(user_id: int, free_limit: int, n: int = 1) -> bool:
+    """
+    Атомарно бронирует n запросов (все или ни одного), если count + брони + n <= free_limit.
+    Одним INSERT … ON CONFLICT: параллельные картинки не проскочат лимит.
+    Брони старше QUOTA_RESERVATION_TTL считаются брошенными и не учитываются.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    if n <= 0 or free_limit < n:
+        return False
+    m = current_month()
+    async with _acquire() as conn:
         row = await conn.fetchrow(
-            'SELECT "count" FROM public."usage" WHERE user_id=$1 AND month=$2',
-            user_id, m
+            """
+            WITH u AS (
+                INSERT INTO public."usage"(user_id, month, "count", reserved, reserved_at, epoch)
+                VALUES ($1, $2, 0, $6, NOW(), """ + _epoch_sql("$2") + """)
+                ON CONFLICT (user_id, month) DO UPDATE SET
+                    reserved = CASE
+                        WHEN public."usage".reserved_at < NOW() - make_interval(secs => $4) THEN $6
+                        ELSE public."usage".reserved + $6
+                    END,
+                    reserved_at = NOW(),
+                    "count" = """ + _LIVE_COUNT + """,
+                    epoch   = EXCLUDED.epoch,
+                    is_new  = FALSE
+                WHERE """ + _LIVE_COUNT + """ + CASE
+                        WHEN public."usage".reserved_at < NOW() - make_interval(secs => $4) THEN 0
+                        ELSE public."usage".reserved
+                    END + $6 <= $3
+                RETURNING "count", is_new AS inserted
+            ), r AS (""" + _ROLLUP_ADD.format(
+                source="SELECT $2, $5, 1, 0, 0, 0 FROM u WHERE u.inserted"
+            ) + """)
+            SELECT "count" FROM u
+            """,
+            user_id, m, free_limit, QUOTA_RESERVATION_TTL, ROLLUP_FREE_LIMIT, n
         )
-        if row:
-            new_count = int(row["count"]) + 1
-            await conn.execute(
-                'UPDATE public."usage" SET "count"=$1 WHERE user_id=$2 AND month=$3',
-                new_count, user_id, m
-            )
-        else:
-            new_count = 1
-            await conn.execute(
-                'INSERT INTO public."usage"(user_id, month, "count") VALUES ($1, $2, $3)',
-                user_id, m, new_count
+    return row is not None
+
+@timed_db
+async def reserve_up_to(user_id: int, free_limit: int, n: int) -> int:
+    """
+    Бронирует сколько влезет из n запросов: min(n, free_limit - count - брони), одним запросом.
+    Возвращает, сколько забронировано (0 — лимит исчерпан). Для альбомов: не нужно
+    подбирать n по count из кэша, который мог устареть.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    if n <= 0 or free_limit <= 0:
+        return 0
+    m = current_month()
+    live_reserved = "CASE WHEN reserved_at < NOW() - make_interval(secs => $4) THEN 0 ELSE reserved END"
+    async with _acquire() as conn:
+        for _ in range(2):
+            row = await conn.fetchrow(
+                """
+                WITH cur AS (
+                    -- строка пользователя блокируется до конца запроса: между расчётом
+                    -- и бронью её никто не изменит (FOR UPDATE читает последнюю версию)
+                    SELECT """ + _live_count("$2") + """ AS "count", """ + live_reserved + """ AS reserved
+                    FROM public."usage" WHERE user_id=$1 AND month=$2
+                    FOR UPDATE
+                ), g AS (
+                    SELECT
+                        LEAST($6, $3 - COALESCE((SELECT "count" + reserved FROM cur), 0)) AS n,
+                        EXISTS(SELECT 1 FROM cur) AS existed
+                ), u AS (
+                    INSERT INTO public."usage"(user_id, month, "count", reserved, reserved_at, epoch)
+                    SELECT $1, $2, 0, g.n, NOW(), """ + _epoch_sql("$2") + """ FROM g WHERE g.n > 0
+                    ON CONFLICT (user_id, month) DO UPDATE SET
+                        reserved = CASE
+                            WHEN public."usage".reserved_at < NOW() - make_interval(secs => $4) THEN 0
+                            ELSE public."usage".reserved
+                        END + EXCLUDED.reserved,
+                        reserved_at = NOW(),
+                        "count" = """ + _LIVE_COUNT + """,
+                        epoch   = EXCLUDED.epoch,
+                        is_new  = FALSE
+                    WHERE (SELECT existed FROM g)
+                    RETURNING is_new AS inserted
+                ), r AS (""" + _ROLLUP_ADD.format(
+                    source="SELECT $2, $5, 1, 0, 0, 0 FROM u WHERE u.inserted"
+                ) + """)
+                SELECT g.n, g.existed, EXISTS(SELECT 1 FROM u) AS reserved FROM g
+                """,
+                user_id, m, free_limit, QUOTA_RESERVATION_TTL, ROLLUP_FREE_LIMIT, n
             )
-        return new_count
+            if row["reserved"]:
+                return row["n"]
+            if row["existed"] or row["n"] <= 0:
+                return 0
+            # строку пользователя вставил параллельный запрос уже после нашего снимка — ещё раз по ней
+    return 0
 
-async def already_sent_feedback_this_month(user_id: int) -> bool:
+@timed_db
+async def commit_slot(user_id: int, n: int = 1, release: int = 0, job_id: Optional[int] = None) -> int:
     """
-    Проверка: отправлял ли фидбек в этом месяце (для выдачи бонуса только 1 раз/мес).
+    Превращает n забронированных запросов в списанные и тем же запросом снимает ещё release
+    броней без списания. Возвращает новое значение счётчика.
+    job_id — бронь сделана под задачу очереди: закрывается один раз на задачу
+    (jobs.settled), повторный вызов ничего не меняет.
     """
     if pool is None:
         raise RuntimeError("DB pool is not initialized. Call init_db() first.")
     m = current_month()
-    async with pool.acquire() as conn:
-        exists = await conn.fetchval(
-            'SELECT 1 FROM public."feedback" WHERE user_id=$1 AND month=$2 LIMIT 1',
-            user_id, m
+    async with _acquire() as conn:
+        new_count = await conn.fetchval(
+            """
+            WITH j AS (
+                UPDATE public."jobs" SET settled = TRUE WHERE id = $6 AND NOT settled RETURNING id
+            ), u AS (
+                INSERT INTO public."usage"(user_id, month, "count", epoch)
+                SELECT $1, $2, $4, """ + _epoch_sql("$2") + """
+                WHERE $6::bigint IS NULL OR EXISTS (SELECT 1 FROM j)
+                ON CONFLICT (user_id, month) DO UPDATE SET
+                    "count"  = """ + _LIVE_COUNT + """ + $4,
+                    reserved = GREATEST(public."usage".reserved - $4 - $5, 0),
+                    epoch    = EXCLUDED.epoch,
+                    is_new   = FALSE
+                RETURNING "count", is_new AS inserted
+            ), r AS (""" + _ROLLUP_ADD.format(
+                source='SELECT $2, $3, u.inserted::int, (u."count" >= $3 AND u."count" - $4 < $3)::int, $4, 0 FROM u'
+            ) + """)
+            SELECT "count" FROM u
+            """,
+            user_id, m, ROLLUP_FREE_LIMIT, n, release, job_id
+        )
+    if new_count is None:
+        return await get_count(user_id)  # бронь задачи уже закрыта раньше
+    _quota_set_count(user_id, m, new_count)
+    return new_count
+
+@timed_db
+async def release_slot(user_id: int, n: int = 1, job_id: Optional[int] = None) -> int:
+    """
+    Снимает n броней без списания (ошибка, ответ не засчитывается). Возвращает текущий счётчик.
+    job_id — как в commit_slot: бронь задачи, уже закрытую раньше, не трогает.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    m = current_month()
+    async with _acquire() as conn:
+        count = await conn.fetchval(
+            """
+            WITH j AS (
+                UPDATE public."jobs" SET settled = TRUE WHERE id = $4 AND NOT settled RETURNING id
+            )
+            UPDATE public."usage" SET reserved = GREATEST(reserved - $3, 0)
+            WHERE user_id=$1 AND month=$2 AND ($4::bigint IS NULL OR EXISTS (SELECT 1 FROM j))
+            RETURNING """ + _live_count("$2") + """
+            """,
+            user_id, m, n, job_id
         )
-        return bool(exists)
+    if count is None and job_id is not None:
+        return await get_count(user_id)
+    return int(count or 0)
+
+async def already_sent_feedback_this_month(user_id: int) -> bool:
+    """
+    Проверка: отправлял ли фидбек в этом месяце (для выдачи бонуса только 1 раз/мес).
+    """
+    _, feedback = await get_quota(user_id)
+    return feedback
 
+@timed_db
 async def save_feedback_and_grant_bonus(
     user_id: int,
     text: str,
-    free_limit: Optional[int] = None
+    free_limit: Optional[int] = None,
+    username: Optional[str] = None,
 ) -> None:
     """
     Сохраняет фидбек и «выдаёт +free_limit» (по факту — уменьшает счётчик на free_limit),
-    но только 1 раз в текущем месяце.
+    но только 1 раз в текущем месяце. Сохранённый отзыв ждёт пересылки (claim_feedback).
     """
     if pool is None:
         raise RuntimeError("DB pool is not initialized. Call init_db() first.")
@@ -117,7 +753,7 @@ async def save_feedback_and_grant_bonus(
             free_limit = 3
 
     m = current_month()
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         async with conn.transaction():
             # если уже был фидбек в этом месяце — бонус не выдаём
             exists = await conn.fetchval(
@@ -125,34 +761,337 @@ async def save_feedback_and_grant_bonus(
                 user_id, m
             )
             if exists:
+                _quota_cache.pop(user_id, None)
                 return
 
             # сохраняем сам фидбек
             await conn.execute(
-                'INSERT INTO public."feedback"(user_id, month, text) VALUES ($1, $2, $3)',
-                user_id, m, text
+                """
+                INSERT INTO public."feedback"(user_id, month, text, username, forward_at)
+                VALUES ($1, $2, $3, $4, NOW())
+                """,
+                user_id, m, text, username
             )
 
-            # уменьшаем текущий счётчик на free_limit (минимум 0)
-            row = await conn.fetchrow(
-                'SELECT "count" FROM public."usage" WHERE user_id=$1 AND month=$2',
+            # уменьшаем текущий счётчик на free_limit (минимум 0);
+            # если записей не было, просто создадим с 0
+            old_count = await conn.fetchval(
+                'SELECT ' + _live_count("$2") + ' FROM public."usage" WHERE user_id=$1 AND month=$2 FOR UPDATE',
                 user_id, m
             )
-            if row:
-                new_count = max(int(row["count"]) - free_limit, 0)
-                await conn.execute(
-                    'UPDATE public."usage" SET "count"=$1 WHERE user_id=$2 AND month=$3',
-                    new_count, user_id, m
-                )
-            else:
-                # если записей не было, просто создадим с 0
-                await conn.execute(
-                    'INSERT INTO public."usage"(user_id, month, "count") VALUES ($1, $2, 0)',
-                    user_id, m
+            new_count = await conn.fetchval(
+                """
+                INSERT INTO public."usage"(user_id, month, "count", epoch) VALUES ($1, $2, 0, """ + _epoch_sql("$2") + """)
+                ON CONFLICT (user_id, month) DO UPDATE
+                SET "count" = GREATEST(""" + _LIVE_COUNT + """ - $3, 0), epoch = EXCLUDED.epoch, is_new = FALSE
+                RETURNING "count"
+                """,
+                user_id, m, free_limit
+            )
+
+            # та же транзакция — агрегаты месяца
+            was = old_count or 0
+            await conn.execute(
+                _ROLLUP_ADD.format(source="VALUES ($1, $2, $3, $4, $5, 1)"),
+                m, ROLLUP_FREE_LIMIT,
+                int(old_count is None),
+                int(new_count >= ROLLUP_FREE_LIMIT) - int(was >= ROLLUP_FREE_LIMIT),
+                new_count - was,
+            )
+    _quota_put(user_id, m, new_count, True)
+
+@timed_db
+async def claim_feedback(min_age: float, visibility_timeout: int, limit: int = 100) -> List[asyncpg.Record]:
+    """
+    Забирает отзывы, ждущие пересылки, — все разом и только если самый старый из них ждёт
+    не меньше min_age сек: сколько бы реплик ни проверяло, дайджест один на интервал.
+    Забранные отзывы невидимы для других на visibility_timeout сек; не подтвердили
+    пересылку (ack_feedback) — их заберут снова. Строки: id, month, user_id, username, text.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """
+            WITH due AS (
+                SELECT id, month FROM public."feedback"
+                WHERE forward_at <= NOW()
+                  AND EXISTS (
+                      SELECT 1 FROM public."feedback"
+                      WHERE forward_at <= NOW() AND created_at <= NOW() - make_interval(secs => $1)
+                  )
+                ORDER BY id
+                FOR UPDATE SKIP LOCKED
+                LIMIT $3
+            )
+            UPDATE public."feedback" f SET forward_at = NOW() + make_interval(secs => $2)
+            FROM due WHERE f.id = due.id AND f.month = due.month
+            RETURNING f.id, f.month, f.user_id, f.username, f.text
+            """,
+            min_age, visibility_timeout, limit
+        )
+    return sorted(rows, key=lambda r: r["id"])
+
+@timed_db
+async def ack_feedback(keys: Sequence[Tuple[int, str]]) -> None:
+    """Отзывы (id, month) из claim_feedback пересланы — больше их не забирать."""
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        await conn.execute(
+            """
+            UPDATE public."feedback" SET forward_at = NULL
+            WHERE (id, month) IN (SELECT * FROM unnest($1::bigint[], $2::text[]))
+            """,
+            [k[0] for k in keys], [k[1] for k in keys]
+        )
+
+# ---- коды подтверждения ----
+
+@timed_db
+async def set_admin_code(name: str, code: str) -> None:
+    """Запоминает код подтверждения для команды name (старый код перезаписывается)."""
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO public."admin_codes"(name, code) VALUES ($1, $2)
+            ON CONFLICT (name) DO UPDATE SET code = EXCLUDED.code, created_at = NOW()
+            """,
+            name, code
+        )
+
+@timed_db
+async def consume_admin_code(name: str, code: str, ttl_seconds: int = 600) -> bool:
+    """
+    Проверяет и гасит код: True, только если код совпал и не старше ttl_seconds.
+    Удаление и проверка — одним запросом, так что код срабатывает ровно один раз.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        deleted = await conn.fetchval(
+            """
+            DELETE FROM public."admin_codes"
+            WHERE name = $1 AND code = $2 AND created_at > NOW() - make_interval(secs => $3)
+            RETURNING 1
+            """,
+            name, code, ttl_seconds
+        )
+    return bool(deleted)
+
+# ---- очередь разборов ----
+
+JOBS_CHANNEL = "analysis_jobs"  # LISTEN/NOTIFY: будим воркеры сразу, а не по таймеру
+
+@timed_db
+async def enqueue_job(
+    user_id: int,
+    chat_id: int,
+    file_id: str,
+    file_size: Optional[int] = None,
+    placeholder_id: Optional[int] = None,
+) -> int:
+    """Ставит картинку в очередь на разбор. Возвращает id задачи."""
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        return await conn.fetchval(
+            """
+            WITH job AS (
+                INSERT INTO public."jobs"(user_id, chat_id, file_id, file_size, placeholder_id)
+                VALUES ($1, $2, $3, $4, $5)
+                RETURNING id
+            )
+            SELECT job.id FROM job, pg_notify($6, job.id::text)
+            """,
+            user_id, chat_id, file_id, file_size, placeholder_id, JOBS_CHANNEL
+        )
+
+@timed_db
+async def claim_job(visibility_timeout: int) -> Optional[asyncpg.Record]:
+    """
+    Забирает одну готовую к работе задачу (или None, если таких нет).
+    Задача становится невидимой для других воркеров на visibility_timeout сек
+    (продлевается extend_job); если воркер её не закроет и не продлит — её заберёт следующий.
+    В строке: lease — номер захвата для complete/retry/fail/extend_job,
+    age — сколько сек прошло с постановки задачи.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        return await conn.fetchrow(
+            """
+            UPDATE public."jobs" SET
+                status = 'running',
+                attempts = attempts + 1,
+                lease = lease + 1,
+                visible_at = NOW() + make_interval(secs => $1)
+            WHERE id = (
+                SELECT id FROM public."jobs"
+                WHERE status IN ('queued', 'running') AND visible_at <= NOW()
+                ORDER BY visible_at, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *, EXTRACT(EPOCH FROM NOW() - created_at)::float8 AS age
+            """,
+            visibility_timeout
+        )
+
+@timed_db
+async def complete_job(job_id: int, lease: int) -> bool:
+    """Задача выполнена — удаляем её из очереди. False — задачу уже перехватил другой воркер."""
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        return await conn.fetchval(
+            'DELETE FROM public."jobs" WHERE id=$1 AND lease=$2 RETURNING TRUE', job_id, lease
+        ) is not None
+
+@timed_db
+async def extend_job(job_id: int, lease: int, visibility_timeout: int) -> bool:
+    """
+    Продлевает невидимость задачи ещё на visibility_timeout сек (heartbeat воркера).
+    False — задачу уже перехватил другой воркер, продолжать её нельзя.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        return await conn.fetchval(
+            """
+            UPDATE public."jobs" SET visible_at = NOW() + make_interval(secs => $3)
+            WHERE id = $1 AND lease = $2 AND status = 'running'
+            RETURNING TRUE
+            """,
+            job_id, lease, visibility_timeout
+        ) is not None
+
+@timed_db
+async def retry_job(
+    job_id: int, lease: int, delay_seconds: float, error: str, refund_attempt: bool = False
+) -> bool:
+    """
+    Возвращает задачу в очередь, чтобы повторить через delay_seconds.
+    refund_attempt — попытка не засчитывается (задачу просто отложили, например из-за перегрузки).
+    False — задачу уже перехватил другой воркер.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        return await conn.fetchval(
+            """
+            UPDATE public."jobs"
+            SET status = 'queued', visible_at = NOW() + make_interval(secs => $3), last_error = $4,
+                attempts = CASE WHEN $5 THEN attempts - 1 ELSE attempts END
+            WHERE id = $1 AND lease = $2
+            RETURNING TRUE
+            """,
+            job_id, lease, delay_seconds, error, refund_attempt
+        ) is not None
+
+@timed_db
+async def fail_job(job_id: int, lease: int, error: str) -> bool:
+    """
+    Окончательно помечает задачу неудачной (остаётся в таблице для разбора).
+    False — задачу уже перехватил другой воркер.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        return await conn.fetchval(
+            """
+            UPDATE public."jobs" SET status = 'failed', last_error = $3
+            WHERE id = $1 AND lease = $2
+            RETURNING TRUE
+            """,
+            job_id, lease, error
+        ) is not None
+
+async def listen_jobs(callback) -> asyncpg.Connection:
+    """
+    Отдельное соединение (не из пула), которое слушает NOTIFY о новых задачах.
+    callback() вызывается на каждую новую задачу. Соединение нужно держать открытым.
+    """
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL не задан. Проверь переменные окружения.")
+    conn = await asyncpg.connect(DATABASE_URL)
+    await conn.add_listener(JOBS_CHANNEL, lambda *args: callback())
+    return conn
+
+# ---- кэш разборов ----
+
+@timed_db
+async def cache_lookup(sha256: str, phash: Optional[int], user_id: int, ttl_days: int) -> Optional[str]:
+    """
+    Ищет готовый разбор: сначала точное совпадение по sha256, потом по phash
+    среди картинок того же пользователя. Просроченные (старше ttl_days) записи не возвращаются.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        return await conn.fetchval(
+            """
+            UPDATE public."analysis_cache" SET last_hit_at = NOW(), hits = hits + 1
+            WHERE sha256 = (
+                SELECT sha256 FROM public."analysis_cache"
+                WHERE (sha256 = $1 OR (user_id = $3 AND phash = $2))
+                  AND created_at > NOW() - make_interval(days => $4)
+                ORDER BY (sha256 = $1) DESC, created_at DESC
+                LIMIT 1
+            )
+            RETURNING reply
+            """,
+            sha256, phash, user_id, ttl_days
+        )
+
+@timed_db
+async def cache_store(sha256: str, phash: Optional[int], user_id: int, reply: str) -> None:
+    """Сохраняет разбор в кэш (перезаписывает, если такой ключ уже был)."""
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO public."analysis_cache"(sha256, phash, user_id, reply) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (sha256) DO UPDATE
+            SET phash = EXCLUDED.phash, user_id = EXCLUDED.user_id, reply = EXCLUDED.reply,
+                created_at = NOW(), last_hit_at = NOW()
+            """,
+            sha256, phash, user_id, reply
+        )
+
+@timed_db
+async def cache_prune(ttl_days: int, max_rows: int) -> int:
+    """
+    Чистит кэш: удаляет просроченные записи и всё, что не влезает в max_rows
+    (сначала то, к чему дольше всего не обращались). Возвращает число удалённых строк.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        async with conn.transaction():
+            expired = await conn.execute(
+                'DELETE FROM public."analysis_cache" WHERE created_at <= NOW() - make_interval(days => $1)',
+                ttl_days
+            )
+            overflow = await conn.execute(
+                """
+                DELETE FROM public."analysis_cache" WHERE sha256 IN (
+                    SELECT sha256 FROM public."analysis_cache"
+                    ORDER BY last_hit_at DESC
+                    OFFSET $1
                 )
+                """,
+                max_rows
+            )
+    # execute() возвращает статус вида "DELETE 42"
+    return int(expired.split()[-1]) + int(overflow.split()[-1])
 
 # ---- статистика ----
 
+@timed_db
 async def month_stats(free_limit: Optional[int] = None) -> Tuple[int, int, int, int]:
     """
     Возвращает (users_total, users_hit_limit, total_requests, feedback_count) за текущий месяц.
@@ -168,48 +1107,129 @@ async def month_stats(free_limit: Optional[int] = None) -> Tuple[int, int, int,
             free_limit = 3
 
     m = current_month()
-    async with pool.acquire() as conn:
-        users_total = await conn.fetchval(
-            'SELECT COUNT(DISTINCT user_id) FROM public."usage" WHERE month=$1',
-            m
-        ) or 0
-        users_hit_limit = await conn.fetchval(
-            'SELECT COUNT(*) FROM public."usage" WHERE month=$1 AND "count" >= $2',
-            m, free_limit
-        ) or 0
-        total_requests = await conn.fetchval(
-            'SELECT COALESCE(SUM("count"), 0) FROM public."usage" WHERE month=$1',
-            m
-        ) or 0
-        feedback_count = await conn.fetchval(
-            'SELECT COUNT(*) FROM public."feedback" WHERE month=$1',
-            m
-        ) or 0
-    return int(users_total), int(users_hit_limit), int(total_requests), int(feedback_count)
+    async with _acquire() as conn:
+        row = await conn.fetchrow('SELECT * FROM public."month_rollup" WHERE month=$1', m)
+        if row is None:
+            # в этом месяце ещё никто ничего не делал
+            return 0, 0, 0, 0
+        users_hit_limit = row["users_hit_limit"]
+        if row["free_limit"] != free_limit:
+            # агрегат посчитан под другой лимит — этот показатель считаем напрямую
+            users_hit_limit = await conn.fetchval(
+                'SELECT COUNT(*) FROM public."usage" WHERE month=$1 AND ' + _live_count("$1") + ' >= $2',
+                m, free_limit
+            ) or 0
+    return (
+        int(row["users_total"]), int(users_hit_limit),
+        int(row["total_requests"]), int(row["feedback_count"]),
+    )
+
+# ---- журнал событий ----
+
+@timed_db
+async def insert_events(events: Sequence[tuple]) -> None:
+    """
+    Пачка событий (events.Event: имена полей — колонки) одним COPY.
+    Секция месяца уже есть: текущий и следующий месяц создаются заранее.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    if not events:
+        return
+    columns = events[0]._fields
+    at = columns.index("created_at")
+    records = [
+        e[:at] + (datetime.fromtimestamp(e[at], timezone.utc),) + e[at + 1:] for e in events
+    ]
+    async with _acquire() as conn:
+        await conn.copy_records_to_table("events", records=records, columns=columns, schema_name="public")
+
+@timed_db
+async def event_breakdown() -> List[Tuple[str, str, int, int, int]]:
+    """
+    События текущего месяца по (kind, outcome): (kind, outcome, n, p50_ms, p95_ms),
+    самые частые сначала.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT kind, outcome, COUNT(*) AS n,
+                   percentile_disc(0.5)  WITHIN GROUP (ORDER BY latency_ms) AS p50,
+                   percentile_disc(0.95) WITHIN GROUP (ORDER BY latency_ms) AS p95
+            FROM public."events" WHERE month = $1
+            GROUP BY kind, outcome ORDER BY n DESC
+            """,
+            current_month()
+        )
+    return [(r["kind"], r["outcome"], r["n"], r["p50"], r["p95"]) for r in rows]
+
+@timed_db
+async def event_daily(days: int = 7) -> List[Tuple[str, int, int, int]]:
+    """
+    Последние days дней (UTC) с событиями разбора: (YYYY-MM-DD, запросов к модели,
+    входных токенов, выходных токенов), по порядку дат.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not initialized. Call init_db() first.")
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD') AS day,
+                   COUNT(prompt_tokens) AS n,
+                   COALESCE(SUM(prompt_tokens), 0) AS prompt,
+                   COALESCE(SUM(completion_tokens), 0) AS completion
+            FROM public."events"
+            WHERE month >= $1 AND created_at >= NOW() - make_interval(days => $2)
+            GROUP BY day ORDER BY day
+            """,
+            _add_months(current_month(), -1), days
+        )
+    return [(r["day"], r["n"], r["prompt"], r["completion"]) for r in rows]
 
 # ---- сбросы ----
 
+@timed_db
 async def reset_all_limits() -> None:
-    """Сбрасывает счётчики запросов для всех пользователей в текущем месяце (только usage.count)."""
+    """
+    Сбрасывает счётчики запросов для всех пользователей в текущем месяце.
+    Строки usage не переписываются: эпоха месяца +1, старые счётчики читаются как 0.
+    """
     if pool is None:
         raise RuntimeError("DB pool is not initialized. Call init_db() first.")
     m = current_month()
-    async with pool.acquire() as conn:
-        await conn.execute(
-            'UPDATE public."usage" SET "count" = 0 WHERE month = $1',
-            m
-        )
+    async with _acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                INSERT INTO public."limit_epochs"(month, epoch) VALUES ($1, 1)
+                ON CONFLICT (month) DO UPDATE SET epoch = public."limit_epochs".epoch + 1
+                """,
+                m
+            )
+            await conn.execute(
+                """
+                UPDATE public."month_rollup"
+                SET total_requests = 0,
+                    users_hit_limit = CASE WHEN free_limit <= 0 THEN users_total ELSE 0 END
+                WHERE month = $1
+                """,
+                m
+            )
+    _quota_cache.clear()
 
+@timed_db
 async def reset_bot() -> None:
     """
-    Полный сброс бота: очищает все основные таблицы (usage, feedback).
-    Логи выводят, сколько строк было удалено.
+    Полный сброс бота: очищает все основные таблицы (usage, feedback, admin_codes, jobs,
+    analysis_cache, events) и агрегаты. Логи выводят, сколько строк было удалено.
     ВНИМАНИЕ: это необратимо.
     """
     if pool is None:
         raise RuntimeError("DB pool is not initialized. Call init_db() first.")
 
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         async with conn.transaction():
             # usage
             deleted_usage = await conn.fetchval('SELECT COUNT(*) FROM public."usage";')
@@ -221,9 +1241,38 @@ async def reset_bot() -> None:
             await conn.execute('TRUNCATE TABLE public."feedback" RESTART IDENTITY CASCADE;')
             print(f"[RESET BOT] Таблица feedback очищена. Было строк: {deleted_feedback}")
 
+            # admin_codes
+            deleted_codes = await conn.fetchval('SELECT COUNT(*) FROM public."admin_codes";')
+            await conn.execute('TRUNCATE TABLE public."admin_codes";')
+            print(f"[RESET BOT] Таблица admin_codes очищена. Было строк: {deleted_codes}")
+
+            # month_rollup
+            await conn.execute('TRUNCATE TABLE public."month_rollup";')
+            print("[RESET BOT] Таблица month_rollup очищена.")
+
+            # limit_epochs
+            await conn.execute('TRUNCATE TABLE public."limit_epochs";')
+            print("[RESET BOT] Таблица limit_epochs очищена.")
+
+            # jobs
+            deleted_jobs = await conn.fetchval('SELECT COUNT(*) FROM public."jobs";')
+            await conn.execute('TRUNCATE TABLE public."jobs" RESTART IDENTITY CASCADE;')
+            print(f"[RESET BOT] Таблица jobs очищена. Было строк: {deleted_jobs}")
+
+            # analysis_cache
+            deleted_cache = await conn.fetchval('SELECT COUNT(*) FROM public."analysis_cache";')
+            await conn.execute('TRUNCATE TABLE public."analysis_cache" RESTART IDENTITY CASCADE;')
+            print(f"[RESET BOT] Таблица analysis_cache очищена. Было строк: {deleted_cache}")
+
+            # events
+            deleted_events = await conn.fetchval('SELECT COUNT(*) FROM public."events";')
+            await conn.execute('TRUNCATE TABLE public."events";')
+            print(f"[RESET BOT] Таблица events очищена. Было строк: {deleted_events}")
+
             # Если есть другие таблицы — добавь сюда аналогично:
             # deleted_other = await conn.fetchval('SELECT COUNT(*) FROM public."other";')
             # await conn.execute('TRUNCATE TABLE public."other" RESTART IDENTITY CASCADE;')
             # print(f"[RESET BOT] Таблица other очищена. Было строк: {deleted_other}")
 
+    _quota_cache.clear()
     print("[RESET BOT] Полный сброс завершён.")
@@ -0,0 +1,150 @@
+# events.py — журнал событий: по строке на запрос (картинка, альбом, отзыв) с задержкой,
+# токенами, размерами картинок и классом ошибки. Хендлеры только кладут событие в буфер
+# в памяти; фоновая задача пишет его в хранилище пачками (COPY в Postgres) — по размеру
+# пачки или по таймеру. Буфер ограничен: если хранилище не успевает, теряются самые старые.
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Deque, NamedTuple, Optional
+
+from storage import current_month, insert_events
+from metrics import EVENTS_DROPPED, EVENTS_WRITTEN
+
+log = logging.getLogger(__name__)
+
+EVENTS_ENABLED = os.getenv("EVENTS_ENABLED", "1") == "1"
+# Сколько событий держать в памяти до записи (дальше вытесняются самые старые)
+EVENTS_BUFFER = int(os.getenv("EVENTS_BUFFER", "10000"))
+# Писать пачкой, как только накопилось столько событий, — или раз в столько секунд
+EVENTS_BATCH = int(os.getenv("EVENTS_BATCH", "500"))
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", "5"))
+
+
+class Event(NamedTuple):
+    """Строка таблицы events; имена полей — колонки."""
+    month: str
+    created_at: float  # unix time
+    kind: str          # image / album / job / feedback
+    user_id: int
+    outcome: str       # ok / cached / queued / refused / limit / rejected / deferred / lost / expired / error
+    error: Optional[str]
+    latency_ms: int
+    images: Optional[int]
+    bytes_in: Optional[int]
+    bytes_out: Optional[int]
+    prompt_tokens: Optional[int]
+    completion_tokens: Optional[int]
+
+
+# Поля события, которое сейчас собирается (track); их дополняют pipeline и llm через note/add
+_current: ContextVar[Optional[dict]] = ContextVar("event", default=None)
+
+
+def note(**fields) -> None:
+    """Проставляет поля текущего события (вне track — ничего не делает)."""
+    event = _current.get()
+    if event is not None:
+        event.update(fields)
+
+
+def add(field: str, value: int) -> None:
+    """Прибавляет к числовому полю текущего события (байты и картинки альбома)."""
+    event = _current.get()
+    if event is not None:
+        event[field] = (event.get(field) or 0) + value
+
+
+class EventRecorder:
+    """Буфер событий с фоновой записью пачками (write-behind)."""
+
+    def __init__(
+        self,
+        max_items: int = EVENTS_BUFFER,
+        batch: int = EVENTS_BATCH,
+        interval: float = EVENTS_FLUSH_INTERVAL,
+    ):
+        self.batch = batch
+        self.interval = interval
+        self._buffer: Deque[Event] = deque(maxlen=max_items)
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def record(self, event: Event) -> None:
+        """Кладёт событие в буфер; при переполнении вытесняет самое старое."""
+        if not EVENTS_ENABLED:
+            return
+        if len(self._buffer) == self._buffer.maxlen:
+            EVENTS_DROPPED.inc()
+        self._buffer.append(event)
+        if len(self._buffer) >= self.batch:
+            self._wakeup.set()
+
+    @asynccontextmanager
+    async def track(self, kind: str, user_id: int):
+        """
+        Событие на время обработки: async with recorder.track("image", user_id) as ev.
+        ev — словарь полей; по выходу считается задержка, исключение даёт outcome=error.
+        """
+        fields = {"outcome": "ok"}
+        token = _current.set(fields)
+        started = time.monotonic()
+        try:
+            yield fields
+        except BaseException as e:
+            fields.update(outcome="error", error=type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            self.record(Event(
+                month=current_month(),
+                created_at=time.time(),
+                kind=kind,
+                user_id=user_id,
+                outcome=fields["outcome"],
+                error=fields.get("error"),
+                latency_ms=int((time.monotonic() - started) * 1000),
+                images=fields.get("images"),
+                bytes_in=fields.get("bytes_in"),
+                bytes_out=fields.get("bytes_out"),
+                prompt_tokens=fields.get("prompt_tokens"),
+                completion_tokens=fields.get("completion_tokens"),
+            ))
+
+    async def flush(self) -> None:
+        """Пишет всё накопленное пачками по batch; при ошибке пачка возвращается в буфер."""
+        async with self._lock:
+            while self._buffer:
+                rows = [self._buffer.popleft() for _ in range(min(self.batch, len(self._buffer)))]
+                try:
+                    await insert_events(rows)
+                except Exception as e:
+                    log.error("Events flush failed, %s events back to buffer: %s", len(rows), e)
+                    # пока писали, могли прийти новые — места на всех нет, теряем самые старые
+                    overflow = len(rows) + len(self._buffer) - self._buffer.maxlen
+                    if overflow > 0:
+                        EVENTS_DROPPED.inc(overflow)
+                        rows = rows[overflow:]
+                    self._buffer.extendleft(reversed(rows))
+                    return
+                EVENTS_WRITTEN.inc(len(rows))
+
+    async def run(self) -> None:
+        """Фоновая задача: запись по заполнению пачки или раз в interval секунд."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+recorder = EventRecorder()
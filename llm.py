@@ -0,0 +1,492 @@
+# llm.py — асинхронный слой вызовов модели.
+# Один общий AsyncOpenAI-клиент с keep-alive пулом HTTP-соединений и адаптивный
+# лимит одновременных запросов (AIMD): растёт, пока OpenAI отвечает быстро,
+# и режется на 429, таймаутах и росте p95. Поверх — политика вызова разбора:
+# повторы с джиттером (с учётом Retry-After), хеджирование медленных запросов,
+# предохранитель на каждую модель и запасные модели по порядку.
+# SDK openai (и httpx) импортируется при первом обращении, а не при старте бота.
+
+import os
+import math
+import time
+import base64
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, List, Optional, Set, Tuple
+
+from prompts import SYSTEM_PROMPT, USER_PROMPT, ALBUM_PROMPT
+from metrics import (
+    stage, record_usage, MODEL_CALLS, MODEL_RETRIES, MODEL_HEDGES,
+    MODEL_PROMPT_TOKENS, MODEL_PROMPT_TOKENS_RATIO,
+)
+from ratelimit import AdaptiveLimiter, CircuitBreaker
+from utils import EncodedImage
+import events
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+log = logging.getLogger(__name__)
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Модели по порядку предпочтения: следующая берётся, если предыдущая падает или её предохранитель разомкнут
+OPENAI_MODELS: List[str] = [
+    m.strip() for m in os.getenv("OPENAI_MODELS", OPENAI_MODEL).split(",") if m.strip()
+]
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "8"))   # стартовый лимит одновременных запросов
+OPENAI_MIN_CONCURRENCY = int(os.getenv("OPENAI_MIN_CONCURRENCY", "2"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+# p95 задержки до ответа OpenAI (в стриминге — до начала потока), выше которой лимит режется
+OPENAI_LATENCY_TARGET = float(os.getenv("OPENAI_LATENCY_TARGET", "15"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))        # сек на один запрос
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", str(OPENAI_MAX_CONCURRENCY)))  # keep-alive соединений
+# Сколько keep-alive соединений к API открыть заранее при старте (llm.warm)
+OPENAI_WARM_CONNECTIONS = int(os.getenv("OPENAI_WARM_CONNECTIONS", "2"))
+# Повторы разбора: сколько раз, база и потолок экспоненциальной паузы (full jitter), сек
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_RETRY_BASE = float(os.getenv("OPENAI_RETRY_BASE", "0.5"))
+OPENAI_RETRY_MAX = float(os.getenv("OPENAI_RETRY_MAX", "20"))
+# Хеджирование: если ответа нет дольше p95 (но не меньше OPENAI_HEDGE_MIN_DELAY), шлём копию запроса
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "0") == "1"
+OPENAI_HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", "2"))
+# Предохранитель модели: столько ошибок подряд — и модель выключается на столько секунд
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_RESET = float(os.getenv("OPENAI_BREAKER_RESET", "30"))
+# Потолок токенов ответа на одну картинку и сколько добавлять на каждую следующую картинку альбома
+OPENAI_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", "600"))
+ALBUM_TOKENS_PER_IMAGE = int(os.getenv("ALBUM_TOKENS_PER_IMAGE", "250"))
+# Бюджет входных токенов на картинки одного запроса (альбом делит его поровну).
+# 0 — IMAGE_MAX_TILES плиток 512x512 на одну картинку
+IMAGE_TOKEN_BUDGET = int(os.getenv("IMAGE_TOKEN_BUDGET", "0"))
+IMAGE_MAX_TILES = int(os.getenv("IMAGE_MAX_TILES", "6"))
+# Бюджет в деньгах на картинки одного запроса, $ (0 — без него); нужна цена входа модели, $ за 1M токенов
+IMAGE_COST_BUDGET = float(os.getenv("IMAGE_COST_BUDGET", "0"))
+OPENAI_INPUT_PRICE = float(os.getenv("OPENAI_INPUT_PRICE", "0"))
+# Токены картинки «база,плитка» (detail=high: база + плитка за каждые 512x512; low — только база),
+# если модели нет в _IMAGE_TOKENS
+OPENAI_IMAGE_TOKENS = os.getenv("OPENAI_IMAGE_TOKENS", "")
+
+EXTRA_INSTRUCTION = (
+    "Важно: если изображение окажется фотографией, всё равно выполни краткий анализ по тем же пунктам, "
+    "как для иллюстрации. В начале коротко предупреди, что это фото, и продолжи.\n"
+)
+
+# Токены картинки по префиксу имени модели (первое совпадение); у mini их больше при меньшей цене за токен
+_IMAGE_TOKENS = (("gpt-4o-mini", 2833, 5667), ("gpt-4o", 85, 170), ("gpt-4-turbo", 85, 170))
+# Грубо символов на токен в промпте (русский текст) и служебные токены на сообщение
+_CHARS_PER_TOKEN = 3.0
+_MESSAGE_TOKENS = 4
+
+_client: Optional["AsyncOpenAI"] = None
+_http = None  # httpx.AsyncClient клиента — для прогрева соединений
+# Сюда create_completion/stream_completion кладут usage — чтобы analyze_images_with_gpt
+# сравнил его со своей оценкой; в копии хеджирования контекст наследуется
+_usage_sink: ContextVar[Optional[list]] = ContextVar("usage_sink", default=None)
+limiter = AdaptiveLimiter(
+    initial=OPENAI_CONCURRENCY,
+    min_limit=OPENAI_MIN_CONCURRENCY,
+    max_limit=OPENAI_MAX_CONCURRENCY,
+    latency_target=OPENAI_LATENCY_TARGET,
+)
+breakers = {
+    m: CircuitBreaker(m, OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_RESET) for m in OPENAI_MODELS
+}
+
+
+class ModelUnavailable(RuntimeError):
+    """Все модели из OPENAI_MODELS сейчас недоступны (предохранители разомкнуты)."""
+
+
+def _sdk():
+    """Модуль openai; импорт (~0.4 с) — при первом вызове, дальше из sys.modules."""
+    import openai
+    return openai
+
+
+def _retryable() -> tuple:
+    """Ошибки, после которых имеет смысл повторить (на той же или запасной модели)."""
+    sdk = _sdk()
+    return (sdk.RateLimitError, sdk.APITimeoutError, sdk.APIConnectionError, sdk.InternalServerError)
+
+
+def _overload() -> tuple:
+    """Ошибки, которые режут адаптивный лимит: 429, таймауты, 5xx."""
+    sdk = _sdk()
+    return (sdk.RateLimitError, sdk.APITimeoutError, sdk.InternalServerError, asyncio.TimeoutError)
+
+
+def get_client() -> "AsyncOpenAI":
+    """Общий клиент; создаётся при первом обращении."""
+    global _client, _http
+    if _client is None:
+        import httpx
+        _http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_POOL_SIZE,
+                max_keepalive_connections=OPENAI_POOL_SIZE,
+                keepalive_expiry=60,
+            ),
+            timeout=OPENAI_TIMEOUT,
+        )
+        # свои повторы — в _resilient_pieces; встроенные в SDK выключены, чтобы не множить попытки
+        _client = _sdk().AsyncOpenAI(
+            api_key=OPENAI_API_KEY, http_client=_http, timeout=OPENAI_TIMEOUT, max_retries=0
+        )
+    return _client
+
+
+async def warm(connections: int = OPENAI_WARM_CONNECTIONS) -> None:
+    """
+    Прогрев при старте: импорт SDK — в отдельном потоке (event loop в это время
+    принимает апдейты), затем connections keep-alive соединений к API (TCP + TLS),
+    чтобы первые разборы их не ждали. Ответ на HEAD не важен — только соединение.
+    """
+    await asyncio.to_thread(_sdk)
+    client = get_client()
+    await asyncio.gather(
+        *(_http.head(str(client.base_url)) for _ in range(connections)),
+        return_exceptions=True,
+    )
+
+
+async def close() -> None:
+    """Закрывает HTTP-пул (при остановке бота)."""
+    global _client, _http
+    if _client is not None:
+        await _client.close()
+        _client = _http = None
+
+
+def image_token_costs(model: Optional[str] = None) -> Tuple[int, int]:
+    """(база, плитка) — токены картинки у модели (по умолчанию — первой из OPENAI_MODELS)."""
+    if OPENAI_IMAGE_TOKENS:
+        base, tile = OPENAI_IMAGE_TOKENS.split(",")
+        return int(base), int(tile)
+    model = model or OPENAI_MODELS[0]
+    for prefix, base, tile in _IMAGE_TOKENS:
+        if model.startswith(prefix):
+            return base, tile
+    return 85, 170
+
+
+def image_token_budget(count: int = 1) -> int:
+    """
+    Бюджет токенов на одну картинку запроса из count картинок: меньшее из
+    IMAGE_TOKEN_BUDGET и IMAGE_COST_BUDGET (пересчитанного по OPENAI_INPUT_PRICE).
+    """
+    base, tile = image_token_costs()
+    budget = IMAGE_TOKEN_BUDGET or base + IMAGE_MAX_TILES * tile
+    if IMAGE_COST_BUDGET and OPENAI_INPUT_PRICE:
+        budget = min(budget, int(IMAGE_COST_BUDGET / OPENAI_INPUT_PRICE * 1_000_000))
+    return budget // max(count, 1)
+
+
+def _text_tokens(text: str) -> int:
+    return math.ceil(len(text) / _CHARS_PER_TOKEN) + _MESSAGE_TOKENS
+
+
+def _record_usage(usage) -> None:
+    record_usage(usage)
+    sink = _usage_sink.get()
+    if usage is not None and sink is not None:
+        sink.append(usage)
+
+
+def queue_depth() -> int:
+    """Сколько запросов ждут свободного слота."""
+    return limiter.waiting()
+
+
+def in_flight() -> int:
+    """Сколько запросов сейчас выполняется в OpenAI."""
+    return limiter.in_flight()
+
+
+def concurrency_limit() -> int:
+    """Текущий адаптивный лимит одновременных запросов."""
+    return limiter.limit
+
+
+@asynccontextmanager
+async def _slot():
+    """
+    Слот адаптивного лимита. 429, таймауты и 5xx считаются перегрузкой
+    и режут лимит; задержку проставляет вызывающий в sample.latency.
+    """
+    if limiter.in_flight() >= limiter.limit:
+        log.info("OpenAI slots busy, queue depth: %s", limiter.waiting() + 1)
+    async with limiter.slot() as sample:
+        try:
+            yield sample
+        except _overload():
+            sample.overloaded = True
+            raise
+
+
+async def create_completion(**kwargs):
+    """
+    chat.completions.create через общий адаптивный лимит:
+    лишние запросы ждут в очереди.
+    """
+    async with _slot() as sample:
+        started = time.monotonic()
+        completion = await get_client().chat.completions.create(timeout=OPENAI_TIMEOUT, **kwargs)
+        sample.latency = time.monotonic() - started
+    _record_usage(completion.usage)
+    return completion
+
+
+async def stream_completion(**kwargs) -> AsyncIterator[str]:
+    """
+    То же, но в режиме stream=True: отдаёт куски текста по мере генерации.
+    Слот держится, пока читается весь поток; для лимита задержка — до начала потока.
+    Расход токенов приходит последним чанком (stream_options.include_usage).
+    """
+    async with _slot() as sample:
+        started = time.monotonic()
+        stream = await get_client().chat.completions.create(
+            stream=True, stream_options={"include_usage": True}, timeout=OPENAI_TIMEOUT, **kwargs
+        )
+        sample.latency = time.monotonic() - started
+        async for chunk in stream:
+            if chunk.usage:
+                _record_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+def bytes_to_data_url(jpeg_bytes: bytes) -> str:
+    b64 = base64.b64encode(jpeg_bytes).decode("ascii")
+    return f"data:image/jpeg;base64,{b64}"
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    """Пауза из заголовков ответа (retry-after-ms / retry-after в секундах), если есть."""
+    if not isinstance(exc, _sdk().APIStatusError):
+        return None
+    headers = exc.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # дата вместо числа — считаем, что заголовка нет
+    return None
+
+
+def _backoff(attempt: int, exc: Exception) -> Optional[float]:
+    """Пауза перед повтором: full jitter, но не меньше Retry-After; None — ждать дольше OPENAI_RETRY_MAX."""
+    delay = random.uniform(0, min(OPENAI_RETRY_MAX, OPENAI_RETRY_BASE * 2 ** attempt))
+    retry_after = _retry_after(exc)
+    if retry_after is not None:
+        if retry_after > OPENAI_RETRY_MAX:
+            return None
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _pick_model(failed: Set[str]) -> Optional[str]:
+    """Первая по порядку модель, которая ещё не падала в этом запросе и чей предохранитель замкнут."""
+    for model in OPENAI_MODELS:
+        if model not in failed and breakers[model].available():
+            return model
+    return None
+
+
+def _hedge_delay() -> float:
+    p95 = limiter.percentile(0.95)
+    return max(p95 if p95 is not None else OPENAI_LATENCY_TARGET, OPENAI_HEDGE_MIN_DELAY)
+
+
+def _breaker_result(breaker: CircuitBreaker, exc: Exception) -> None:
+    """429 — не поломка: модель жива, темп регулируют лимит и Retry-After."""
+    if isinstance(exc, _sdk().RateLimitError):
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+
+async def _attempt(model: str, request: dict, stream: bool) -> AsyncIterator[str]:
+    """Одна попытка: куски текста потока или весь ответ одним куском."""
+    if stream:
+        async for piece in stream_completion(model=model, **request):
+            yield piece
+    else:
+        completion = await create_completion(model=model, **request)
+        yield completion.choices[0].message.content or ""
+
+
+async def _first_piece(
+    model: str, request: dict, stream: bool
+) -> Tuple[str, Optional[AsyncIterator[str]]]:
+    """
+    Запускает попытку и ждёт первого куска ответа. С OPENAI_HEDGE, если первый
+    кусок задерживается дольше _hedge_delay() и у лимита есть свободное место,
+    параллельно шлёт копию запроса; побеждает та, что ответит первой, вторая отменяется.
+    Возвращает (первый кусок, итератор с остальными или None, если ответ кончился).
+    """
+    primary = _attempt(model, request, stream)
+    pending = {asyncio.ensure_future(primary.__anext__()): primary}
+    hedge_at = _hedge_delay() if OPENAI_HEDGE else None
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                pending, timeout=hedge_at, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                hedge_at = None  # копия — не больше одной
+                if limiter.in_flight() < limiter.limit:
+                    hedge = _attempt(model, request, stream)
+                    pending[asyncio.ensure_future(hedge.__anext__())] = hedge
+                    MODEL_HEDGES.labels("launched").inc()
+                continue
+            task = done.pop()
+            gen = pending.pop(task)
+            try:
+                first = task.result()
+            except StopAsyncIteration:
+                first, gen = "", None
+            except Exception:
+                if pending:
+                    continue  # вторая копия ещё в пути
+                raise
+            if gen is not primary:
+                MODEL_HEDGES.labels("won").inc()
+            return first, gen
+    finally:
+        # проигравшую копию отменяем; её слот освобождается при выходе из генератора
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for gen in pending.values():
+            await gen.aclose()
+
+
+async def _resilient_pieces(request: dict, stream: bool) -> AsyncIterator[str]:
+    """
+    Куски ответа с политикой вызова: при ошибке из _retryable() до первого куска —
+    повтор на следующей модели из OPENAI_MODELS или, если все уже пробовали,
+    пауза с джиттером и заново с первой. После начала ответа ошибка не повторяется
+    (текст уже показан пользователю).
+    """
+    failed: Set[str] = set()
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        model = _pick_model(failed)
+        if model is None:
+            raise ModelUnavailable("все модели недоступны")
+        breaker = breakers[model]
+        if not breaker.allow():
+            # пробный вызов полуоткрытого предохранителя уже занят другим запросом
+            failed.add(model)
+            continue
+        try:
+            first, rest = await _first_piece(model, request, stream)
+        except _retryable() as e:
+            _breaker_result(breaker, e)
+            MODEL_CALLS.labels(model, type(e).__name__).inc()
+            if attempt == OPENAI_MAX_RETRIES:
+                raise
+            failed.add(model)
+            if _pick_model(failed) is not None:
+                MODEL_RETRIES.labels("fallback").inc()
+                log.warning("Model %s failed (%s), falling back", model, e)
+                continue
+            delay = _backoff(attempt, e)
+            if delay is None:
+                raise
+            failed.clear()
+            MODEL_RETRIES.labels("backoff").inc()
+            log.warning("Model %s failed (%s), retry in %.1fs", model, e, delay)
+            await asyncio.sleep(delay)
+            continue
+        except asyncio.CancelledError:
+            breaker.record_cancel()
+            raise
+        except Exception:
+            breaker.record_success()  # сервис ответил — ошибка в самом запросе
+            MODEL_CALLS.labels(model, "rejected").inc()
+            raise
+
+        breaker.record_success()
+        yield first
+        if rest is not None:
+            try:
+                async for piece in rest:
+                    yield piece
+            except _retryable() as e:
+                _breaker_result(breaker, e)
+                MODEL_CALLS.labels(model, type(e).__name__).inc()
+                raise
+        MODEL_CALLS.labels(model, "ok").inc()
+        return
+
+
+async def analyze_image_with_gpt(
+    image: EncodedImage,
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> str:
+    """
+    Разбор картинки моделью (с повторами, хеджированием и запасными моделями).
+    Если передан on_text — ответ читается потоком, и on_text вызывается
+    с уже накопленным текстом после каждого куска.
+    """
+    return await analyze_images_with_gpt([image], on_text)
+
+
+async def analyze_images_with_gpt(
+    images: List[EncodedImage],
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> str:
+    """
+    Разбор нескольких картинок (альбома) одним запросом — общий ответ по всем.
+    Одна картинка — обычный разбор. detail каждой картинки — из плана кодирования
+    (utils.encode_for_model); оценка входных токенов сравнивается с usage ответа.
+    """
+    prompt = EXTRA_INSTRUCTION + USER_PROMPT
+    if len(images) > 1:
+        prompt += ALBUM_PROMPT.format(count=len(images))
+    content = [{"type": "text", "text": prompt}]
+    content += [
+        {"type": "image_url", "image_url": {"url": bytes_to_data_url(image.data), "detail": image.detail}}
+        for image in images
+    ]
+    request = dict(
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": content},
+        ],
+        # на каждую следующую работу альбома — ещё немного места под ответ
+        max_tokens=OPENAI_MAX_TOKENS + ALBUM_TOKENS_PER_IMAGE * (len(images) - 1),
+        temperature=0.4,
+    )
+    estimated = _text_tokens(SYSTEM_PROMPT) + _text_tokens(prompt) + sum(image.tokens for image in images)
+
+    usages: list = []
+    token = _usage_sink.set(usages)
+    try:
+        with stage("model"):
+            reply = ""
+            async for piece in _resilient_pieces(request, stream=on_text is not None):
+                reply += piece
+                if on_text is not None:
+                    await on_text(reply)
+    finally:
+        _usage_sink.reset(token)
+    _record_estimate(estimated, usages[-1] if usages else None)
+    return reply.strip()
+
+
+def _record_estimate(estimated: int, usage) -> None:
+    """Оценка входных токенов против usage.prompt_tokens (если модель его вернула); токены — в журнал событий."""
+    MODEL_PROMPT_TOKENS.labels("estimated").observe(estimated)
+    if usage is None or not usage.prompt_tokens:
+        return
+    events.note(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+    MODEL_PROMPT_TOKENS.labels("actual").observe(usage.prompt_tokens)
+    MODEL_PROMPT_TOKENS_RATIO.observe(usage.prompt_tokens / estimated)
+    log.debug("Prompt tokens: estimated %s, actual %s", estimated, usage.prompt_tokens)
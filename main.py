@@ -5,27 +5,47 @@
 
 import os
 import asyncio
-import base64
 import secrets
 import logging
+from typing import List, Optional, Tuple
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message
 from aiogram.filters import CommandStart, Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
-from openai import OpenAI
-from db_pg import (
+from storage import (
     reset_bot,
     init_db,
-    get_count,
-    inc_count,
+    warm_db,
+    partition_maintenance_loop,
+    get_quota,
+    reserve_slot,
+    reserve_up_to,
+    release_slot,
+    enqueue_job,
     save_feedback_and_grant_bonus,
-    already_sent_feedback_this_month,
+    claim_feedback,
+    ack_feedback,
     month_stats,
+    event_breakdown,
+    event_daily,
     reset_all_limits,
+    set_admin_code,
+    consume_admin_code,
+    close_db,
 )
-from prompts import SYSTEM_PROMPT, USER_PROMPT
-from utils import downscale
+from llm import close as close_llm, warm as warm_llm
+from utils import shutdown_pool, PRESCREEN_ENABLED, PRESCREEN_MIN_SIDE
+from telegram_files import pick_photo_size, MAX_DOWNLOAD_BYTES
+from cache import prune_loop
+from events import recorder
+import metrics
+from ratelimit import AdmissionMiddleware
+from albums import AlbumCollector, ALBUM_BATCH
+from outbox import send_message, Digest, FEEDBACK_DIGEST_INTERVAL, FEEDBACK_CLAIM_TIMEOUT
+from pipeline import process_image, process_album, user_error_text, ERROR_TEXT, FILE_TOO_LARGE_TEXT, PRESCREEN_TEXTS, target_side
 
 # Логгер
 logging.basicConfig(level=logging.INFO)
@@ -33,23 +53,66 @@ log = logging.getLogger(__name__)
 
 # Переменные окружения
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Свой Bot API сервер (локальный telegram-bot-api или заглушка из bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 FREE_LIMIT = int(os.getenv("FREE_LIMIT", "3"))
 OWNER_ID = int(os.getenv("OWNER_ID", "0"))
 FEEDBACK_GROUP_ID = int(os.getenv("FEEDBACK_GROUP_ID", "0"))
+# За сколько последних дней показывать токены в /stats
+STATS_DAYS = int(os.getenv("STATS_DAYS", "7"))
+# Картинки не разбирать в хендлере, а ставить в очередь для worker.py
+JOB_QUEUE = os.getenv("JOB_QUEUE", "0") == "1"
+# Запуск через webhook.py (задан WEBHOOK_URL): реплик несколько, и части одного альбома
+# приходят в разные процессы, а альбом собирается в памяти одного. Там альбомы по умолчанию
+# разбираются по картинке; ALBUM_BATCH_WEBHOOK=1 — если реплика одна или балансировщик
+# направляет апдейты одного чата в одну реплику
+WEBHOOK_MODE = bool(os.getenv("WEBHOOK_URL"))
+ALBUM_BATCH_WEBHOOK = os.getenv("ALBUM_BATCH_WEBHOOK", "0") == "1"
+# Собирать альбомы и разбирать их одним запросом (с очередью задач — только по картинке)
+ALBUMS = ALBUM_BATCH and not JOB_QUEUE and (not WEBHOOK_MODE or ALBUM_BATCH_WEBHOOK)
 
 if not TELEGRAM_BOT_TOKEN or not OPENAI_API_KEY:
     raise RuntimeError("Не заданы TELEGRAM_BOT_TOKEN или OPENAI_API_KEY.")
 
-bot = Bot(TELEGRAM_BOT_TOKEN)
-client = OpenAI(api_key=OPENAI_API_KEY)
+bot = Bot(
+    TELEGRAM_BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
 dp = Dispatcher()
 
-EXTRA_INSTRUCTION = (
-    "Важно: если изображение окажется фотографией, всё равно выполни краткий анализ по тем же пунктам, "
-    "как для иллюстрации. В начале коротко предупреди, что это фото, и продолжи.\n"
+
+async def answer(m: Message, text: str) -> Message:
+    """Ответ в чат сообщения — через общую очередь исходящих (outbox)."""
+    return await send_message(bot, m.chat.id, text)
+
+
+async def _forward_feedback(text: str) -> None:
+    """Пересылка отзывов в группу; если не вышло — владельцу."""
+    try:
+        await send_message(bot, FEEDBACK_GROUP_ID, text)
+    except Exception:
+        await send_message(bot, OWNER_ID, text)
+
+async def _pending_feedback(min_age: float) -> List[Tuple[Tuple[int, str], str]]:
+    """Отзывы, ждущие пересылки (claim_feedback), — в виде (ключ, текст) для дайджеста."""
+    rows = await claim_feedback(min_age, FEEDBACK_CLAIM_TIMEOUT)
+    return [
+        ((r["id"], r["month"]), f"📝 Отзыв от @{r['username'] or r['user_id']} (id {r['user_id']}):\n\n{r['text']}")
+        for r in rows
+    ]
+
+# Отзывы пересылаются пачкой раз в FEEDBACK_DIGEST_INTERVAL сек — из таблицы feedback,
+# так что переживают рестарт и не дробятся между репликами
+feedback_digest = Digest(
+    FEEDBACK_DIGEST_INTERVAL, _forward_feedback, "📝 Новые отзывы", _pending_feedback, ack_feedback
 )
 
+# Частота и число одновременно разбираемых картинок на пользователя (хендлеры с флагом admission)
+dp.message.middleware(AdmissionMiddleware(notify=answer, albums=ALBUMS))
+# Части альбома собираются вместе и разбираются одним запросом
+album_collector = AlbumCollector()
+
 WELCOME_TEXT = (
     "Привет! Я Арт-feedback БОТ.\n"
     "Пришли мне изображение — дам короткий, по делу разбор: композиция, ритмы, цвет/свет, стилизация, эмоции, уместность для ЦА.\n\n"
@@ -57,92 +120,79 @@ WELCOME_TEXT = (
     "Совет: загружай картинку хорошего качества, без сильной компрессии."
 )
 
-# ===== Хелперы =====
-
-def bytes_to_data_url(jpeg_bytes: bytes) -> str:
-    b64 = base64.b64encode(jpeg_bytes).decode("ascii")
-    return f"data:image/jpeg;base64,{b64}"
-
-async def analyze_image_with_gpt(image_bytes: bytes) -> str:
-    data_url = bytes_to_data_url(image_bytes)
-    def _call_openai():
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": EXTRA_INSTRUCTION + USER_PROMPT},
-                        {"type": "image_url", "image_url": {"url": data_url}},
-                    ],
-                },
-            ],
-            max_tokens=600,
-            temperature=0.4,
-        )
-        return completion.choices[0].message.content or ""
-
-    reply = await asyncio.to_thread(_call_openai)
-    return reply.strip()
-
 # ===== Команды =====
 
 @dp.message(CommandStart())
 async def start(m: Message):
-    await m.answer(WELCOME_TEXT)
+    await answer(m, WELCOME_TEXT)
+
+def _tokens(n: int) -> str:
+    return f"{n / 1000:.0f}k" if n >= 10_000 else str(n)
 
 @dp.message(Command("stats"))
 async def stats(m: Message):
     if m.from_user.id != OWNER_ID:
-        return await m.answer("Команда доступна только владельцу.")
+        return await answer(m, "Команда доступна только владельцу.")
     users_total, users_hit_limit, total_requests, feedback_count = await month_stats(FREE_LIMIT)
-    await m.answer(
-        "📊 Статистика за текущий месяц:\n"
-        f"• Уникальных пользователей: {users_total}\n"
-        f"• Дошли до лимита ({FREE_LIMIT}): {users_hit_limit}\n"
-        f"• Всего запросов: {total_requests}\n"
-        f"• Отправили отзыв: {feedback_count}"
-    )
+    lines = [
+        "📊 Статистика за текущий месяц:",
+        f"• Уникальных пользователей: {users_total}",
+        f"• Дошли до лимита ({FREE_LIMIT}): {users_hit_limit}",
+        f"• Всего запросов: {total_requests}",
+        f"• Отправили отзыв: {feedback_count}",
+    ]
+    # разбивки — из журнала событий (events.py)
+    breakdown = await event_breakdown()
+    if breakdown:
+        lines += ["", "⏱ События (сколько, задержка p50 / p95):"]
+        lines += [
+            f"• {kind} {outcome}: {n}, {p50 / 1000:.1f} / {p95 / 1000:.1f} с"
+            for kind, outcome, n, p50, p95 in breakdown
+        ]
+    daily = await event_daily(STATS_DAYS)
+    if daily:
+        lines += ["", f"🔢 Токены модели по дням (UTC, {STATS_DAYS} дн.):"]
+        lines += [
+            f"• {day}: {n} запр., вход {_tokens(prompt)}, ответ {_tokens(completion)}"
+            for day, n, prompt, completion in daily
+        ]
+    await answer(m, "\n".join(lines))
 
 @dp.message(Command("reset_limits"))
 async def reset_limits_cmd(m: Message):
     if m.from_user.id != OWNER_ID:
-        return await m.answer("Команда доступна только владельцу.")
+        return await answer(m, "Команда доступна только владельцу.")
     await reset_all_limits()
-    await m.answer("✅ Лимиты для всех пользователей на текущий месяц сброшены.")
-
-# /reset_all с подтверждением
-_pending_reset_code: str | None = None
+    await answer(m, "✅ Лимиты для всех пользователей на текущий месяц сброшены.")
 
+# /reset_all с подтверждением; код хранится в БД (общий для всех реплик)
 @dp.message(Command("reset_all"))
 async def reset_all_cmd(m: Message):
-    global _pending_reset_code
     if m.from_user.id != OWNER_ID:
-        return await m.answer("Команда доступна только владельцу.")
+        return await answer(m, "Команда доступна только владельцу.")
 
     parts = (m.text or "").strip().split()
 
     if len(parts) == 1:
-        _pending_reset_code = secrets.token_hex(4)
-        await m.answer(
+        code = secrets.token_hex(4)
+        await set_admin_code("reset_all", code)
+        await answer(m,
             "⚠️ Полный сброс ВСЕХ данных (лимиты, история, отзывы). Это необратимо.\n"
-            f"Чтобы подтвердить, отправь:\n/reset_all CONFIRM {_pending_reset_code}"
+            f"Чтобы подтвердить, отправь:\n/reset_all CONFIRM {code}"
         )
         return
 
     if len(parts) == 3 and parts[1].upper() == "CONFIRM":
-        if not _pending_reset_code or parts[2] != _pending_reset_code:
-            return await m.answer("Код подтверждения не совпал или устарел.")
-        _pending_reset_code = None
+        if not await consume_admin_code("reset_all", parts[2]):
+            return await answer(m, "Код подтверждения не совпал или устарел.")
         try:
             await reset_bot()
-            await m.answer("✅ Готово. Все данные обнулены.")
+            await answer(m, "✅ Готово. Все данные обнулены.")
         except Exception as e:
-            await m.answer(f"❌ Ошибка: {e}")
+            await answer(m, f"❌ Ошибка: {e}")
         return
 
-    await m.answer("Неверный формат. Используй: /reset_all или /reset_all CONFIRM <code>.")
+    await answer(m, "Неверный формат. Используй: /reset_all или /reset_all CONFIRM <code>.")
 
 @dp.message(Command("feedback"))
 async def feedback(m: Message):
@@ -152,28 +202,25 @@ async def feedback(m: Message):
     payload = parts[1].strip() if len(parts) > 1 else ""
 
     if user_id == OWNER_ID:
-        return await m.answer("Эта команда для пользователей.")
+        return await answer(m, "Эта команда для пользователей.")
 
-    used = await get_count(user_id)
-    if used < FREE_LIMIT:
-        return await m.answer("У тебя ещё есть бесплатные запросы. Используй их сначала 🙂")
+    async with recorder.track("feedback", user_id) as ev:
+        used, feedback_sent = await get_quota(user_id)
+        if used < FREE_LIMIT:
+            ev["outcome"] = "refused"
+            return await answer(m, "У тебя ещё есть бесплатные запросы. Используй их сначала 🙂")
 
-    if await already_sent_feedback_this_month(user_id):
-        return await m.answer("Ты уже присылал отзыв в этом месяце и получил +3. Спасибо!")
+        if feedback_sent:
+            ev["outcome"] = "refused"
+            return await answer(m, "Ты уже присылал отзыв в этом месяце и получил +3. Спасибо!")
 
-    if not payload:
-        return await m.answer("Напиши так:\n/feedback Твой отзыв.")
-
-    try:
-        await bot.send_message(
-            FEEDBACK_GROUP_ID,
-            f"📝 Отзыв от @{m.from_user.username or user_id} (id {user_id}):\n\n{payload}",
-        )
-    except Exception:
-        await bot.send_message(OWNER_ID, f"📝 Отзыв от id {user_id}:\n\n{payload}")
+        if not payload:
+            ev["outcome"] = "refused"
+            return await answer(m, "Напиши так:\n/feedback Твой отзыв.")
 
-    await save_feedback_and_grant_bonus(user_id, payload, FREE_LIMIT)
-    await m.answer("Спасибо за отзыв! Накинул ещё 3 бесплатных попытки.")
+        await save_feedback_and_grant_bonus(user_id, payload, FREE_LIMIT, m.from_user.username)
+        await feedback_digest.poke()
+        await answer(m, "Спасибо за отзыв! Накинул ещё 3 бесплатных попытки.")
 
 # Текстовые отзывы без команды
 @dp.message(F.text & ~F.text.startswith("/"))
@@ -183,64 +230,183 @@ async def handle_text_feedback(m: Message):
     if not text:
         return
 
-    used = await get_count(user_id)
-    if used < FREE_LIMIT or await already_sent_feedback_this_month(user_id):
+    used, feedback_sent = await get_quota(user_id)
+    if used < FREE_LIMIT or feedback_sent:
         return
 
-    try:
-        await bot.send_message(
-            FEEDBACK_GROUP_ID,
-            f"📝 Отзыв от @{m.from_user.username or user_id} (id {user_id}):\n\n{text}",
-        )
-    except Exception:
-        await bot.send_message(OWNER_ID, f"📝 Отзыв от id {user_id}:\n\n{text}")
-
-    await save_feedback_and_grant_bonus(user_id, text, FREE_LIMIT)
-    await m.answer("Спасибо за отзыв! Накинул ещё 3 бесплатных попытки.")
+    # в журнал — только текст, принятый как отзыв (остальной текст отзывом не считается)
+    async with recorder.track("feedback", user_id):
+        await save_feedback_and_grant_bonus(user_id, text, FREE_LIMIT, m.from_user.username)
+        await feedback_digest.poke()
+        await answer(m, "Спасибо за отзыв! Накинул ещё 3 бесплатных попытки.")
 
 # Обработка изображений
-@dp.message(F.photo | F.document)
+def _image_file(m: Message) -> Tuple[Optional[str], Optional[int], Optional[str]]:
+    """(file_id, file_size, None) или (None, None, текст отказа) — до скачивания и брони."""
+    # Из вариантов фото берём наименьший, которого хватает на размер, выбранный планировщиком
+    if m.photo:
+        largest = max(m.photo, key=lambda p: p.width * p.height)
+        photo = pick_photo_size(m.photo, target_side(largest.width, largest.height))
+        if PRESCREEN_ENABLED and max(photo.width, photo.height) < PRESCREEN_MIN_SIDE:
+            # даже самый большой вариант мал — отказываем без скачивания и брони
+            return None, None, PRESCREEN_TEXTS["too_small"]
+        file_id, file_size = photo.file_id, photo.file_size
+    elif m.document and str(m.document.mime_type).startswith("image/"):
+        file_id, file_size = m.document.file_id, m.document.file_size
+    else:
+        file_id, file_size = None, None
+    if not file_id:
+        return None, None, "Пришли фото или картинку (image/*)."
+
+    if file_size and file_size > MAX_DOWNLOAD_BYTES:
+        return None, None, FILE_TOO_LARGE_TEXT
+    return file_id, file_size, None
+
+async def _limit_reached(m: Message, user_id: int) -> None:
+    _, feedback_sent = await get_quota(user_id)
+    if feedback_sent:
+        await answer(m, "Лимит исчерпан. Ты уже получал +3 за отзыв.")
+    else:
+        await answer(m,
+            "Лимит исчерпан. Хочешь +3? Пришли короткий отзыв — что понравилось/не понравилось."
+        )
+
+@dp.message(F.photo | F.document, flags={"admission": True})
 async def handle_image(m: Message):
     user_id = m.from_user.id
-    used = await get_count(user_id)
-    if used >= FREE_LIMIT:
-        if await already_sent_feedback_this_month(user_id):
-            await m.answer("Лимит исчерпан. Ты уже получал +3 за отзыв.")
-        else:
-            await m.answer(
-                "Лимит исчерпан. Хочешь +3? Пришли короткий отзыв — что понравилось/не понравилось."
-            )
-        return
 
-    file_id = m.photo[-1].file_id if m.photo else (
-        m.document.file_id if m.document and str(m.document.mime_type).startswith("image/") else None
-    )
-    if not file_id:
-        return await m.answer("Пришли фото или картинку (image/*).")
+    if m.media_group_id and ALBUMS:
+        album = await album_collector.collect(m)
+        if album is None:
+            return  # часть альбома — её разберёт хендлер первой части
+        if len(album) > 1:
+            return await handle_album(album)
+
+    async with recorder.track("image", user_id) as ev:
+        file_id, file_size, refusal = _image_file(m)
+        if refusal:
+            ev["outcome"] = "refused"
+            return await answer(m, refusal)
+
+        # Бронируем слот до долгого вызова модели: параллельные картинки не превысят лимит
+        if not await reserve_slot(user_id, FREE_LIMIT):
+            ev["outcome"] = "limit"
+            return await _limit_reached(m, user_id)
+
+        if JOB_QUEUE:
+            # Ставим в очередь и сразу отвечаем; разбор сделает worker.py
+            ev["outcome"] = "queued"
+            try:
+                ack = await answer(m, "Принял! Поставил в очередь, скоро разберу… 🤔")
+                await enqueue_job(user_id, m.chat.id, file_id, file_size, ack.message_id)
+            except Exception as e:
+                await release_slot(user_id)
+                await answer(m, ERROR_TEXT)
+                log.error("Enqueue error: %s", e)
+                ev.update(outcome="error", error=type(e).__name__)
+            return
 
-    try:
-        tg_file = await bot.get_file(file_id)
-        file_stream = await bot.download_file(tg_file.file_path)
-        raw = file_stream.read()
-        prepared = downscale(raw, max_side=1536)
-
-        await m.answer("Принял! Секунду, анализирую… 🤔")
-        reply = await analyze_image_with_gpt(prepared)
-        new_count = await inc_count(user_id)
-        left = max(FREE_LIMIT - new_count, 0)
-        await m.answer(f"{reply}\n\nОсталось бесплатных запросов: {left}")
-    except Exception as e:
-        await m.answer("Упс, что-то пошло не так. Попробуй ещё раз.")
-        log.error("Image handling error: %s", e)
+        try:
+            await process_image(bot, user_id, m.chat.id, file_id, file_size)
+        except Exception as e:
+            # исключение вылетает только до закрытия брони (см. process_image) — снимаем её,
+            # запрос не списывается
+            await release_slot(user_id)
+            text = user_error_text(e)
+            if text is None:
+                log.error("Image handling error: %s", e)
+            ev.update(outcome="rejected" if text else "error", error=type(e).__name__)
+            await answer(m, text or ERROR_TEXT)
+
+async def handle_album(album: List[Message]) -> None:
+    """Альбом целиком: одна бронь на все картинки, один запрос к модели, один ответ."""
+    m = album[0]
+    user_id = m.from_user.id
+    async with recorder.track("album", user_id) as ev:
+        files, refusals = [], []
+        for part in album:
+            file_id, file_size, refusal = _image_file(part)
+            if refusal:
+                refusals.append(refusal)
+            else:
+                files.append((file_id, file_size))
+        if not files:
+            ev["outcome"] = "refused"
+            return await answer(m, refusals[0])
+
+        # Сколько картинок влезает в лимит — столько и бронируем, одним запросом
+        reserved = await reserve_up_to(user_id, FREE_LIMIT, len(files))
+        if not reserved:
+            ev["outcome"] = "limit"
+            return await _limit_reached(m, user_id)
+        notes = refusals[:1]
+        if reserved < len(files):
+            notes.append(f"В лимит влезло только {reserved} из {len(files)} картинок — разбираю первые.")
+            files = files[:reserved]
+
+        try:
+            await process_album(bot, user_id, m.chat.id, files, note="\n".join(notes))
+        except Exception as e:
+            # брони ещё не тронуты (см. process_album) — снимаем все
+            await release_slot(user_id, reserved)
+            text = user_error_text(e)
+            if text is None:
+                log.error("Album handling error: %s", e)
+            ev.update(outcome="rejected" if text else "error", error=type(e).__name__)
+            await answer(m, text or ERROR_TEXT)
 
 # ===== Точка входа =====
 
-async def main():
+# Общие для polling и webhook (webhook.py) старт/остановка.
+# Ссылки на фоновые задачи: asyncio держит только слабые, без них задачу может собрать GC
+_background_tasks: set[asyncio.Task] = set()
+_first_update_seen = False
+
+@dp.update.outer_middleware()
+async def first_update_timer(handler, event, data):
+    """Время от запуска процесса до первого обработанного апдейта — в bot_startup_seconds."""
+    global _first_update_seen
+    try:
+        return await handler(event, data)
+    finally:
+        if not _first_update_seen:
+            _first_update_seen = True
+            log.info("First update handled %.2fs after process start", metrics.startup_phase("first_update"))
+
+async def _warm_up() -> None:
+    """Прогрев пулов параллельно с началом приёма апдейтов: соединения БД, OpenAI и Telegram."""
+    results = await asyncio.gather(warm_db(), warm_llm(), bot.get_me(), return_exceptions=True)
+    for name, result in zip(("db", "openai", "telegram"), results):
+        if isinstance(result, Exception):
+            log.warning("Warm-up of %s failed: %s", name, result)
+    log.info("Pools warm %.2fs after process start", metrics.startup_phase("warm"))
+
+@dp.startup()
+async def on_startup():
+    # до приёма апдейтов — только схема (на актуальной — пара запросов); остальное в фоне
     await init_db()
+    metrics.start_server(metrics.METRICS_PORT)
+    _background_tasks.add(asyncio.create_task(prune_loop()))
+    _background_tasks.add(asyncio.create_task(partition_maintenance_loop()))
+    _background_tasks.add(asyncio.create_task(metrics.loop_lag_monitor()))
+    _background_tasks.add(asyncio.create_task(recorder.run()))
+    _background_tasks.add(asyncio.create_task(feedback_digest.run()))
+    _background_tasks.add(asyncio.create_task(_warm_up()))
     log.info(
-        "Bot is up. OWNER_ID=%s FEEDBACK_GROUP_ID=%s FREE_LIMIT=%s",
-        OWNER_ID, FEEDBACK_GROUP_ID, FREE_LIMIT
+        "Bot is up %.2fs after process start. OWNER_ID=%s FEEDBACK_GROUP_ID=%s FREE_LIMIT=%s",
+        metrics.startup_phase("ready"), OWNER_ID, FEEDBACK_GROUP_ID, FREE_LIMIT
     )
+
+@dp.shutdown()
+async def on_shutdown():
+    for task in _background_tasks:
+        task.cancel()
+    await recorder.flush()  # накопленные события журнала не теряем
+    await close_llm()
+    shutdown_pool()
+    await close_db()
+
+async def main():
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
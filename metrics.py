@@ -0,0 +1,177 @@
+# metrics.py — метрики в формате Prometheus.
+# Время по этапам (Telegram, даунскейл, модель, БД, ответ), байты, токены модели,
+# пул соединений asyncpg и задержка event loop. Отдаются локальным HTTP-листенером.
+
+import os
+import time
+import asyncio
+import functools
+import logging
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+log = logging.getLogger(__name__)
+
+# Порт листенера /metrics (0 — не поднимать). Воркер очереди слушает свой порт.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9101"))
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+# Как часто мерить задержку event loop, сек
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+_IMPORTED_AT = time.monotonic()
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+_BYTES_BUCKETS = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 5e6, 10e6, 20e6)
+
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds", "Время этапа обработки картинки", ["stage"], buckets=_LATENCY_BUCKETS
+)
+DB_SECONDS = Histogram(
+    "bot_db_seconds", "Время функции хранилища (вместе с ожиданием соединения)", ["fn"],
+    buckets=_LATENCY_BUCKETS,
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "bot_db_pool_wait_seconds", "Ожидание свободного соединения в пуле asyncpg",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+DB_COMMIT_BATCH = Histogram(
+    "bot_db_commit_batch", "Записей в одном групповом COMMIT (SQLite)",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+DB_POOL_CONNECTIONS = Gauge("bot_db_pool_connections", "Соединения пула asyncpg", ["state"])
+IMAGE_BYTES = Histogram(
+    "bot_image_bytes", "Размер картинки: скачанной (in) и ушедшей в модель (out)", ["direction"],
+    buckets=_BYTES_BUCKETS,
+)
+PRESCREEN_REJECTED = Counter(
+    "bot_prescreen_rejected_total", "Картинки, отклонённые предварительной проверкой без вызова модели", ["reason"]
+)
+MODEL_TOKENS = Counter("bot_model_tokens_total", "Токены модели из поля usage", ["kind"])
+MODEL_PROMPT_TOKENS = Histogram(
+    "bot_model_prompt_tokens", "Входные токены запроса разбора: оценка плана (estimated) и usage (actual)", ["kind"],
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+MODEL_PROMPT_TOKENS_RATIO = Histogram(
+    "bot_model_prompt_tokens_ratio", "usage.prompt_tokens / оценка входных токенов",
+    buckets=(0.5, 0.75, 0.9, 0.95, 1.0, 1.05, 1.1, 1.25, 1.5, 2.0),
+)
+IMAGE_ENCODINGS = Counter("bot_image_encodings_total", "Картинки, подготовленные для модели, по detail", ["detail"])
+MODEL_QUEUE = Gauge("bot_model_queue_depth", "Запросы, ждущие свободного слота модели")
+MODEL_IN_FLIGHT = Gauge("bot_model_in_flight", "Запросы, выполняющиеся в модели")
+MODEL_CALLS = Counter("bot_model_calls_total", "Попытки вызова модели по итогу", ["model", "outcome"])
+MODEL_RETRIES = Counter("bot_model_retries_total", "Повторы вызова модели: на запасной модели или после паузы", ["kind"])
+MODEL_HEDGES = Counter("bot_model_hedges_total", "Хеджированные копии запросов: отправлено / ответили первыми", ["event"])
+MODEL_BREAKER_OPEN = Gauge("bot_model_breaker_open", "Предохранитель модели разомкнут (1) или нет (0)", ["model"])
+MODEL_LIMIT = Gauge("bot_model_concurrency_limit", "Текущий адаптивный лимит одновременных запросов к модели")
+MODEL_SHED = Counter("bot_model_shed_total", "Запросы, отклонённые из-за перегрузки очереди к модели")
+FAIR_QUEUE_DEPTH = Gauge("bot_fair_queue_depth", "Запросы в общей очереди к модели (по кругу между пользователями)")
+OUTBOX_WAIT_SECONDS = Histogram(
+    "bot_outbox_wait_seconds", "Ожидание лимитов Telegram перед отправкой", buckets=_LATENCY_BUCKETS
+)
+OUTBOX_RETRY_AFTER = Counter("bot_outbox_retry_after_total", "Ответы Telegram RetryAfter (флуд-лимит)")
+OUTBOX_DROPPED = Counter("bot_outbox_dropped_total", "Пропущенные необязательные правки (лимит выбран)")
+EVENTS_BUFFERED = Gauge("bot_events_buffered", "События в памяти, ещё не записанные в хранилище")
+EVENTS_WRITTEN = Counter("bot_events_written_total", "События, записанные в хранилище")
+EVENTS_DROPPED = Counter("bot_events_dropped_total", "События, вытесненные из переполненного буфера")
+STARTUP_SECONDS = Gauge(
+    "bot_startup_seconds", "От запуска процесса: готов принимать апдейты (ready), пулы прогреты (warm), "
+    "обработан первый апдейт (first_update)", ["phase"],
+)
+LOOP_LAG_SECONDS = Histogram(
+    "bot_event_loop_lag_seconds", "Насколько event loop опаздывает с пробуждением",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+def process_uptime() -> float:
+    """Секунды с запуска процесса (по /proc — вместе с импортами до этого модуля)."""
+    try:
+        with open("/proc/self/stat") as f:
+            # поле 22 — момент старта в тиках с загрузки системы; comm в скобках может содержать пробелы
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _IMPORTED_AT
+
+
+def startup_phase(phase: str) -> float:
+    """Отмечает этап старта в bot_startup_seconds; возвращает секунды с запуска процесса."""
+    elapsed = process_uptime()
+    STARTUP_SECONDS.labels(phase).set(elapsed)
+    return elapsed
+
+
+@contextmanager
+def stage(name: str):
+    """Замер этапа: with stage("downscale"): ..."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+def timed_db(fn):
+    """Декоратор для async-функций хранилища (db_pg, db): время вызова в bot_db_seconds{fn=...}."""
+    hist = DB_SECONDS.labels(fn.__name__)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            hist.observe(time.perf_counter() - started)
+    return wrapper
+
+
+def record_usage(usage) -> None:
+    """Токены из completion.usage (в стриминге — из последнего чанка)."""
+    if usage is None:
+        return
+    MODEL_TOKENS.labels("prompt").inc(usage.prompt_tokens or 0)
+    MODEL_TOKENS.labels("completion").inc(usage.completion_tokens or 0)
+
+
+async def loop_lag_monitor(interval: float = LOOP_LAG_INTERVAL) -> None:
+    """Фоновая задача: спит interval и меряет, на сколько проснулась позже."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(loop.time() - started - interval, 0.0))
+
+
+def _pool_size(state: str) -> int:
+    import storage  # здесь, чтобы бэкенды хранилища могли импортировать metrics
+    pool = getattr(storage.backend, "pool", None)  # у SQLite пула нет
+    if pool is None:
+        return 0
+    if state == "idle":
+        return pool.get_idle_size()
+    return pool.get_size() - pool.get_idle_size()
+
+
+def start_server(port: int = METRICS_PORT) -> None:
+    """Поднимает /metrics на METRICS_ADDR:port и подключает gauge'и, которые читаются при сборе."""
+    import llm
+    import pipeline
+    import events
+
+    MODEL_QUEUE.set_function(llm.queue_depth)
+    FAIR_QUEUE_DEPTH.set_function(pipeline.model_queue.depth)
+    MODEL_IN_FLIGHT.set_function(llm.in_flight)
+    MODEL_LIMIT.set_function(llm.concurrency_limit)
+    EVENTS_BUFFERED.set_function(lambda: len(events.recorder))
+    for model, breaker in llm.breakers.items():
+        MODEL_BREAKER_OPEN.labels(model).set_function(
+            functools.partial(lambda b: float(b.state != b.CLOSED), breaker)
+        )
+    for state in ("in_use", "idle"):
+        DB_POOL_CONNECTIONS.labels(state).set_function(functools.partial(_pool_size, state))
+
+    if port:
+        start_http_server(port, addr=METRICS_ADDR)
+        log.info("Metrics on http://%s:%s/metrics", METRICS_ADDR, port)
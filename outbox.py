@@ -0,0 +1,197 @@
+# outbox.py — все исходящие сообщения бота идут через эту очередь.
+# Глобальный токен-бакет на бота и бакет на каждый чат (лимиты Telegram на флуд),
+# сообщения в один чат уходят строго по порядку, RetryAfter выжидается автоматически.
+# Длинные тексты режутся по 4096 символов; пересылки отзывов собираются в дайджесты.
+
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from metrics import OUTBOX_WAIT_SECONDS, OUTBOX_RETRY_AFTER, OUTBOX_DROPPED
+from ratelimit import TokenBucket
+
+log = logging.getLogger(__name__)
+
+# Всего сообщений в секунду от бота (Telegram: ~30)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+# В личный чат — сообщений в секунду, в группу — в минуту (Telegram: 1/сек и 20/мин)
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_GROUP_RATE_PER_MIN = float(os.getenv("TG_GROUP_RATE_PER_MIN", "20"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+# Сколько раз подряд выжидать RetryAfter, прежде чем сдаться
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+# Раз в столько секунд отзывы пересылаются одним сообщением (0 — сразу по одному)
+FEEDBACK_DIGEST_INTERVAL = float(os.getenv("FEEDBACK_DIGEST_INTERVAL", "300"))
+# Сколько сек забранные в дайджест отзывы невидимы для других реплик; не подтвердили
+# пересылку за это время (процесс упал посреди отправки) — их перешлют снова
+FEEDBACK_CLAIM_TIMEOUT = int(os.getenv("FEEDBACK_CLAIM_TIMEOUT", "600"))
+# Как часто повторять неудавшуюся пересылку при FEEDBACK_DIGEST_INTERVAL = 0, сек
+DIGEST_RETRY_INTERVAL = 60.0
+
+MAX_MESSAGE_LEN = 4096  # лимит Telegram на длину сообщения
+
+T = TypeVar("T")
+
+
+class _Chat:
+    __slots__ = ("bucket", "lock")
+
+    def __init__(self, chat_id: int):
+        if chat_id < 0:  # группы и каналы
+            self.bucket = TokenBucket(TG_GROUP_RATE_PER_MIN / 60, TG_CHAT_BURST)
+        else:
+            self.bucket = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+        self.lock = asyncio.Lock()  # FIFO: порядок сообщений в чате сохраняется
+
+
+_global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+_chats: Dict[int, _Chat] = {}
+_MAX_CHATS = 10_000  # после этого из памяти выкидываются простаивающие чаты
+
+
+def _chat(chat_id: int) -> _Chat:
+    chat = _chats.get(chat_id)
+    if chat is None:
+        if len(_chats) >= _MAX_CHATS:
+            for cid in [cid for cid, c in _chats.items() if not c.lock.locked() and c.bucket.full()]:
+                del _chats[cid]
+        chat = _chats[chat_id] = _Chat(chat_id)
+    return chat
+
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LEN) -> List[str]:
+    """Режет текст на части не длиннее limit — по абзацам, строкам или пробелам, если получится."""
+    parts = []
+    while len(text) > limit:
+        cut = -1
+        for sep in ("\n\n", "\n", " "):
+            cut = text.rfind(sep, limit // 2, limit)
+            if cut != -1:
+                break
+        if cut == -1:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    parts.append(text)
+    return [p for p in parts if p] or [""]
+
+
+async def _call(chat_id: int, make_call: Callable[[], Awaitable[T]], droppable: bool = False) -> Optional[T]:
+    """
+    Выполняет запрос к Telegram в очередь чата, под глобальным и чатовым бакетом.
+    droppable — необязательное действие (промежуточная правка): если чат занят
+    или лимит выбран, оно просто пропускается (None), RetryAfter тоже не выжидается.
+    """
+    chat = _chat(chat_id)
+    if droppable and (chat.lock.locked() or chat.bucket.wait_time() > 0 or _global.wait_time() > 0):
+        OUTBOX_DROPPED.inc()
+        return None
+    async with chat.lock:
+        for attempt in range(TG_MAX_RETRIES + 1):
+            started = time.monotonic()
+            await chat.bucket.take()
+            await _global.take()
+            OUTBOX_WAIT_SECONDS.observe(time.monotonic() - started)
+            try:
+                return await make_call()
+            except TelegramRetryAfter as e:
+                OUTBOX_RETRY_AFTER.inc()
+                if droppable:
+                    OUTBOX_DROPPED.inc()
+                    return None
+                if attempt == TG_MAX_RETRIES:
+                    raise
+                log.warning("Flood limit in chat %s, waiting %ss", chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+
+async def send_message(bot: Bot, chat_id: int, text: str, **kwargs) -> Message:
+    """Отправляет текст (длинный — несколькими сообщениями по порядку); возвращает первое."""
+    first = None
+    for part in split_text(text):
+        msg = await _call(chat_id, lambda part=part: bot.send_message(chat_id, part, **kwargs))
+        first = first or msg
+    return first
+
+
+async def edit_message(
+    bot: Bot, chat_id: int, message_id: int, text: str, droppable: bool = False
+) -> bool:
+    """
+    Правит текст сообщения (text должен влезать в одно сообщение).
+    False — правка пропущена (droppable) или текст не изменился.
+    """
+    async def edit():
+        try:
+            await bot.edit_message_text(text[:MAX_MESSAGE_LEN], chat_id=chat_id, message_id=message_id)
+            return True
+        except TelegramBadRequest as e:
+            # "message is not modified" — не ошибка
+            if "not modified" not in str(e):
+                raise
+            return False
+
+    return bool(await _call(chat_id, edit, droppable=droppable))
+
+
+class Digest:
+    """
+    Раз в interval секунд отдаёт накопившиеся тексты в send одним сообщением
+    (длинное send_message сам порежет). Тексты лежат в хранилище, а не в памяти процесса:
+    claim(min_age) забирает ждущие пересылки как пары (ключ, текст) — все разом, если самый
+    старый ждёт не меньше min_age сек, — а ack(ключи) подтверждает отправку. Падение
+    процесса их не теряет, а реплики не шлют дайджест по куску каждая.
+    interval <= 0 — пересылка сразу после каждого нового текста (poke).
+    """
+
+    SEPARATOR = "\n\n———\n\n"
+
+    def __init__(
+        self,
+        interval: float,
+        send: Callable[[str], Awaitable[None]],
+        title: str,
+        claim: Callable[[float], Awaitable[List[Tuple[Any, str]]]],
+        ack: Callable[[List[Any]], Awaitable[None]],
+    ):
+        self.interval = interval
+        self._send = send
+        self._title = title
+        self._claim = claim
+        self._ack = ack
+
+    async def poke(self) -> None:
+        """Новый текст уже в хранилище: при interval <= 0 пересылаем сразу."""
+        if self.interval <= 0:
+            await self.flush()
+
+    async def flush(self) -> None:
+        items = await self._claim(max(self.interval, 0))
+        if not items:
+            return
+        header = f"{self._title} ({len(items)}):\n\n" if len(items) > 1 else ""
+        try:
+            await self._send(header + self.SEPARATOR.join(text for _, text in items))
+        except Exception as e:
+            # не подтверждаем — тексты снова станут видны через таймаут забора
+            log.error("Digest send failed, %s items will be retried: %s", len(items), e)
+            return
+        await self._ack([key for key, _ in items])
+
+    async def run(self) -> None:
+        """
+        Фоновая задача: хранилище проверяется в несколько раз чаще interval, так что дайджест
+        уходит вскоре после того, как самому старому тексту исполнилось interval сек.
+        """
+        while True:
+            await asyncio.sleep(self.interval / 4 if self.interval > 0 else DIGEST_RETRY_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error("Digest flush failed: %s", e)
@@ -0,0 +1,298 @@
+# pipeline.py — разбор одной картинки: скачать → проверить → подготовить → кэш → модель → ответ.
+# Общий для обработки прямо в хендлере (main.py) и для воркера очереди (worker.py).
+
+import os
+import time
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+
+from storage import commit_slot, release_slot
+import llm
+import events
+from llm import analyze_image_with_gpt, analyze_images_with_gpt, ModelUnavailable
+from utils import (
+    encode_for_model, plan_encoding, prescreen, run_in_pool, EncodedImage, ImageTooLarge, Rejected,
+    MAX_IMAGE_PIXELS, PRESCREEN_ENABLED, PRESCREEN_MIN_SIDE,
+)
+from telegram_files import download_limited, FileTooLarge, MAX_DOWNLOAD_BYTES
+from cache import cache_key, get_cached_reply, store_reply, CACHE_HIT_COUNTS
+from metrics import stage, IMAGE_BYTES, IMAGE_ENCODINGS, MODEL_SHED, PRESCREEN_REJECTED
+from ratelimit import FairQueue
+from outbox import send_message, edit_message, split_text
+
+log = logging.getLogger(__name__)
+
+FREE_LIMIT = int(os.getenv("FREE_LIMIT", "3"))
+# Потолок длинной стороны картинки, которая уходит в модель (размер под бюджет — utils.plan_encoding)
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1536"))
+# Показывать ответ по мере генерации, редактируя сообщение «Принял!…»
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+# Не чаще одного редактирования за столько секунд (лимиты Telegram на edit)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+# Сброс нагрузки: не ставим в очередь к модели, если там уже столько запросов
+# или ожидание по оценке дольше стольких секунд
+MODEL_MAX_QUEUE = int(os.getenv("MODEL_MAX_QUEUE", "50"))
+MODEL_MAX_WAIT = float(os.getenv("MODEL_MAX_WAIT", "120"))
+
+PLACEHOLDER_TEXT = "Принял! Секунду, анализирую… 🤔"
+ALBUM_PLACEHOLDER_TEXT = "Принял альбом ({count} шт.)! Разбираю всё разом… 🤔"
+ALBUM_SKIPPED_TEXT = "Не разобрал {skipped} из {total}: {reason}"
+QUEUED_TEXT = "Принял! Ты в очереди: {position}-й. Скоро разберу… ⏳"
+ERROR_TEXT = "Упс, что-то пошло не так. Попробуй ещё раз."
+FILE_TOO_LARGE_TEXT = (
+    f"Файл слишком большой (больше {MAX_DOWNLOAD_BYTES // (1024 * 1024)} МБ). Пришли картинку поменьше."
+)
+IMAGE_TOO_LARGE_TEXT = (
+    f"Картинка слишком большая (больше {MAX_IMAGE_PIXELS // 1_000_000} Мп). Уменьши её и пришли снова."
+)
+# Ответы предварительной проверки (utils.prescreen) по Rejected.reason
+PRESCREEN_TEXTS = {
+    "too_small": (
+        f"Картинка слишком маленькая — тут не разглядеть деталей. Пришли побольше "
+        f"(от {PRESCREEN_MIN_SIDE} px по длинной стороне) — попытка не списалась."
+    ),
+    "blank": "Кажется, тут пусто: картинка почти однотонная. Пришли саму работу — попытка не списалась.",
+    "low_quality": (
+        "Картинка слишком сильно пережата, детали не разглядеть. Пришли файл получше "
+        "(можно документом, без сжатия) — попытка не списалась."
+    ),
+    "photo": "Это похоже на фотографию, а я разбираю иллюстрации. Пришли рисунок — попытка не списалась.",
+}
+MODEL_UNAVAILABLE_TEXT = "Модель сейчас недоступна. Попробуй через пару минут — попытка не списалась."
+OVERLOADED_TEXT = (
+    "Сейчас слишком много запросов, я не успеваю. Пришли картинку ещё раз через пару минут — "
+    "попытка не списалась."
+)
+
+# Общая очередь к модели: пользователи обслуживаются по кругу, сразу — не больше
+# текущего адаптивного лимита llm
+model_queue = FairQueue(capacity=llm.concurrency_limit)
+
+
+class Overloaded(RuntimeError):
+    """Очередь к модели переполнена — запрос сброшен, квоту не тратит."""
+
+
+def check_overload() -> None:
+    """Бросает Overloaded, если новый запрос к модели лучше сразу отклонить."""
+    depth = model_queue.depth()
+    if depth >= MODEL_MAX_QUEUE:
+        raise Overloaded(f"очередь к модели: {depth}")
+    wait = llm.limiter.expected_wait(depth)
+    if wait > MODEL_MAX_WAIT:
+        raise Overloaded(f"ожидание модели ~{wait:.0f} сек")
+
+
+class ReplyStreamer:
+    """
+    Постепенно показывает ответ модели в сообщении-заглушке.
+    Промежуточные правки троттлятся (не чаще STREAM_EDIT_INTERVAL) и пропускаются,
+    если лимиты Telegram выбраны; финальная отправляется всегда, а то, что не влезло
+    в одно сообщение, уходит следующими.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int, interval: float = STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self._next_edit_at = time.monotonic() + interval
+
+    async def update(self, text: str) -> None:
+        if time.monotonic() < self._next_edit_at:
+            return
+        self._next_edit_at = time.monotonic() + self.interval
+        # пока идёт генерация, показываем только то, что влезает в первое сообщение
+        await edit_message(self.bot, self.chat_id, self.message_id, split_text(text + " ▌")[0], droppable=True)
+
+    async def finish(self, text: str) -> None:
+        first, *rest = split_text(text)
+        await edit_message(self.bot, self.chat_id, self.message_id, first)
+        for part in rest:
+            await send_message(self.bot, self.chat_id, part)
+
+
+def user_error_text(exc: Exception) -> Optional[str]:
+    """Текст для пользователя, если ошибка «его» (повторять бесполезно), иначе None."""
+    if isinstance(exc, FileTooLarge):
+        return FILE_TOO_LARGE_TEXT
+    if isinstance(exc, ImageTooLarge):
+        return IMAGE_TOO_LARGE_TEXT
+    if isinstance(exc, Rejected):
+        return PRESCREEN_TEXTS.get(exc.reason, ERROR_TEXT)
+    if isinstance(exc, Overloaded):
+        return OVERLOADED_TEXT
+    if isinstance(exc, ModelUnavailable):
+        return MODEL_UNAVAILABLE_TEXT
+    return None
+
+
+async def _deliver(streamer: Optional[ReplyStreamer], bot: Bot, chat_id: int, text: str) -> None:
+    """Финальный ответ: правкой заглушки в режиме стриминга, иначе отдельным сообщением."""
+    try:
+        with stage("reply"):
+            if streamer:
+                await streamer.finish(text)
+            else:
+                await send_message(bot, chat_id, text)
+    except Exception as e:
+        # бронь уже закрыта: наружу не бросаем, иначе вызывающий снимет списанный слот
+        log.error("Final reply failed (chat %s): %s", chat_id, e)
+
+
+def target_side(width: int, height: int) -> int:
+    """Длинная сторона, до которой планировщик уменьшит картинку width x height (одну, не альбом)."""
+    plan = plan_encoding(width, height, llm.image_token_budget(), *llm.image_token_costs(), IMAGE_MAX_SIDE)
+    return max(plan.width, plan.height)
+
+
+async def _prepare(
+    bot: Bot, user_id: int, file_id: str, file_size: Optional[int], count: int = 1
+) -> EncodedImage:
+    """
+    Скачать, проверить (prescreen) и закодировать картинку для модели под бюджет
+    токенов; count — сколько картинок в запросе (альбом делит бюджет поровну).
+    """
+    raw = await download_limited(bot, file_id, file_size)
+    IMAGE_BYTES.labels("in").observe(len(raw))
+    events.add("bytes_in", len(raw))
+    if PRESCREEN_ENABLED:
+        # крошечные, пустые и пережатые картинки отклоняем до даунскейла и модели
+        with stage("prescreen"):
+            try:
+                await run_in_pool(prescreen, raw)
+            except Rejected as e:
+                PRESCREEN_REJECTED.labels(e.reason).inc()
+                log.info("Prescreen rejected image of user %s: %s", user_id, e)
+                raise
+            except ImageTooLarge:
+                raise
+            except Exception as e:
+                # проверка — только фильтр: если она сама упала, картинку пропускаем дальше
+                log.warning("Prescreen failed for image of user %s, passing it: %r", user_id, e)
+    with stage("downscale"):
+        prepared = await run_in_pool(
+            encode_for_model, raw, llm.image_token_budget(count), *llm.image_token_costs(), IMAGE_MAX_SIDE
+        )
+    IMAGE_BYTES.labels("out").observe(len(prepared.data))
+    IMAGE_ENCODINGS.labels(prepared.detail).inc()
+    events.add("bytes_out", len(prepared.data))
+    events.add("images", 1)
+    return prepared
+
+
+def _shed_if_overloaded(user_id: int) -> None:
+    """Промах кэша — нужна модель; при перегрузке отказываем до постановки в очередь."""
+    try:
+        check_overload()
+    except Overloaded as e:
+        MODEL_SHED.inc()
+        log.warning("Shedding request of user %s: %s", user_id, e)
+        raise
+
+
+async def process_image(
+    bot: Bot,
+    user_id: int,
+    chat_id: int,
+    file_id: str,
+    file_size: Optional[int] = None,
+    placeholder_id: Optional[int] = None,
+    job_id: Optional[int] = None,
+) -> None:
+    """
+    Полный разбор картинки с ответом пользователю.
+
+    Слот квоты вызывающий бронирует заранее (reserve_slot). Бронь закрывает один запрос
+    (commit или release), и исключения вылетают только до него: после остаётся лишь
+    отправка ответа, ошибки которой _deliver глотает. Значит, вылетело исключение —
+    бронь не тронута и остаётся за вызывающим (снять её или повторить попытку позже);
+    вернулась без исключения — бронь закрыта, снимать её нельзя.
+
+    placeholder_id — уже отправленное сообщение «Принял!…», которое можно править;
+    если его нет, заглушка отправляется перед вызовом модели.
+    job_id — разбор идёт задачей очереди: бронь закрывается один раз на задачу,
+    и повтор после уже закрытой брони не спишет слот второй раз.
+    """
+    prepared = await _prepare(bot, user_id, file_id, file_size)
+
+    # Та же картинка уже разбиралась — отвечаем из кэша без вызова модели
+    key = await cache_key(prepared.data, user_id)
+    cached = await get_cached_reply(key)
+    if cached is not None:
+        events.note(outcome="cached")
+        if CACHE_HIT_COUNTS:
+            new_count = await commit_slot(user_id, job_id=job_id)
+        else:
+            new_count = await release_slot(user_id, job_id=job_id)
+        left = max(FREE_LIMIT - new_count, 0)
+        streamer = ReplyStreamer(bot, chat_id, placeholder_id) if STREAM_REPLIES and placeholder_id else None
+        return await _deliver(streamer, bot, chat_id, f"{cached}\n\nОсталось бесплатных запросов: {left}")
+
+    _shed_if_overloaded(user_id)
+
+    if placeholder_id is None:
+        placeholder_id = (await send_message(bot, chat_id, PLACEHOLDER_TEXT)).message_id
+
+    async def notify_queued(position: int) -> None:
+        await edit_message(bot, chat_id, placeholder_id, QUEUED_TEXT.format(position=position), droppable=True)
+
+    streamer = ReplyStreamer(bot, chat_id, placeholder_id) if STREAM_REPLIES else None
+    async with model_queue.turn(user_id, on_queued=notify_queued):
+        reply = await analyze_image_with_gpt(prepared, on_text=streamer.update if streamer else None)
+    await store_reply(key, reply)
+    new_count = await commit_slot(user_id, job_id=job_id)
+    left = max(FREE_LIMIT - new_count, 0)
+    await _deliver(streamer, bot, chat_id, f"{reply}\n\nОсталось бесплатных запросов: {left}")
+
+
+async def process_album(
+    bot: Bot,
+    user_id: int,
+    chat_id: int,
+    files: List[Tuple[str, Optional[int]]],
+    note: str = "",
+) -> None:
+    """
+    Разбор альбома одним запросом к модели и одним ответом.
+
+    files — (file_id, file_size) по порядку. Вызывающий заранее бронирует len(files)
+    слотов. Как и в process_image, все брони закрывает один запрос (разобранные
+    списываются, отклонённые проверкой снимаются) и исключения вылетают только до него:
+    при исключении брони целиком снимает вызывающий, без исключения — они уже закрыты.
+    Кэш разборов альбомы не используют: ответ общий на весь набор картинок.
+    note — что дописать к ответу (например, какие части альбома не взяты).
+    """
+    # скачивание и подготовка — параллельно (подготовка — в пуле процессов)
+    results = await asyncio.gather(
+        *(_prepare(bot, user_id, file_id, file_size, len(files)) for file_id, file_size in files),
+        return_exceptions=True,
+    )
+    images = [r for r in results if isinstance(r, EncodedImage)]
+    failed = [r for r in results if isinstance(r, BaseException)]
+    for e in failed:
+        # отклонённые проверкой пропускаем, а сетевые и прочие ошибки — как у одной картинки
+        if user_error_text(e) is None or not images:
+            raise e
+
+    _shed_if_overloaded(user_id)
+    placeholder_id = (await send_message(bot, chat_id, ALBUM_PLACEHOLDER_TEXT.format(count=len(images)))).message_id
+
+    async def notify_queued(position: int) -> None:
+        await edit_message(bot, chat_id, placeholder_id, QUEUED_TEXT.format(position=position), droppable=True)
+
+    streamer = ReplyStreamer(bot, chat_id, placeholder_id) if STREAM_REPLIES else None
+    async with model_queue.turn(user_id, on_queued=notify_queued):
+        reply = await analyze_images_with_gpt(images, on_text=streamer.update if streamer else None)
+    new_count = await commit_slot(user_id, len(images), release=len(failed))
+    if failed:
+        reply += "\n\n" + ALBUM_SKIPPED_TEXT.format(
+            skipped=len(failed), total=len(files), reason=user_error_text(failed[0])
+        )
+    if note:
+        reply += "\n\n" + note
+    left = max(FREE_LIMIT - new_count, 0)
+    await _deliver(streamer, bot, chat_id, f"{reply}\n\nОсталось бесплатных запросов: {left}")
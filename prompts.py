@@ -17,3 +17,9 @@ USER_PROMPT = """
 Если изображение низкого качества/размер слишком мал — кратко попроси перезалить лучшее.
 Если это фотография, а не иллюстрация — скажи, что работаешь с иллюстрациями и нужен рисованный материал.
 """
+
+# Добавляется к USER_PROMPT, когда пришёл альбом (несколько картинок одним запросом)
+ALBUM_PROMPT = """
+Это альбом: {count} работ одного автора, картинки идут по порядку. Разбери каждую отдельно под заголовком
+«Работа 1», «Работа 2» и так далее — коротко: что это, оценка, главный совет. В конце — общий вывод по серии.
+"""
@@ -0,0 +1,433 @@
+# ratelimit.py — допуск запросов и честная очередь к модели.
+# Токен-бакет и лимит «в работе» на пользователя (middleware для хендлеров картинок)
+# и общая очередь перед вызовами модели, которая обслуживает пользователей по кругу:
+# альбом из 10 картинок не задерживает тех, кто прислал одну. Здесь же адаптивный
+# лимит одновременных запросов и предохранитель для внешних сервисов.
+
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+
+log = logging.getLogger(__name__)
+
+# Сколько картинок в минуту пополняется у пользователя и сколько можно прислать пачкой
+USER_RATE_PER_MIN = float(os.getenv("USER_RATE_PER_MIN", "6"))
+USER_BURST = int(os.getenv("USER_BURST", "5"))
+# Сколько картинок одного пользователя может разбираться одновременно
+USER_MAX_IN_FLIGHT = int(os.getenv("USER_MAX_IN_FLIGHT", "3"))
+# Предупреждать об ограничении не чаще раза в столько секунд (чтобы не отвечать спамеру на каждое)
+ADMISSION_WARN_INTERVAL = float(os.getenv("ADMISSION_WARN_INTERVAL", "30"))
+
+RATE_LIMITED_TEXT = "Слишком много картинок подряд. Подожди {wait} сек и пришли снова."
+TOO_MANY_IN_FLIGHT_TEXT = "Я ещё разбираю твои предыдущие картинки. Дождись ответа и пришли эту снова."
+
+
+class TokenBucket:
+    """Классический токен-бакет: rate токенов в секунду, не больше burst про запас."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n: float = 1) -> bool:
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait_time(self, n: float = 1) -> float:
+        """Через сколько секунд наберётся n токенов."""
+        self._refill()
+        if self.tokens >= n:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (n - self.tokens) / self.rate
+
+    async def take(self, n: float = 1) -> None:
+        """Ждёт, пока наберётся n токенов, и забирает их."""
+        while not self.try_take(n):
+            await asyncio.sleep(self.wait_time(n))
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class _UserState:
+    __slots__ = ("bucket", "in_flight", "warned_at", "album")
+
+    def __init__(self):
+        self.bucket = TokenBucket(USER_RATE_PER_MIN / 60, USER_BURST)
+        self.in_flight = 0
+        self.warned_at = 0.0
+        self.album: Optional[Tuple[str, bool]] = None  # (media_group_id последнего альбома, допущен ли)
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """
+    Допуск картинок от пользователя: токен-бакет на частоту и лимит одновременно
+    разбираемых. Срабатывает только для хендлеров с флагом admission:
+    @dp.message(..., flags={"admission": True}). Отклонённое сообщение до хендлера
+    не доходит — слот квоты не бронируется.
+    albums=True — альбом (сообщения с одним media_group_id) считается одной заявкой:
+    решение по первой части распространяется на остальные.
+    """
+
+    MAX_USERS = 10_000  # после этого из памяти выкидываются «спокойные» пользователи
+
+    def __init__(
+        self, notify: Optional[Callable[[Message, str], Awaitable[Any]]] = None, albums: bool = False
+    ):
+        # чем отвечать об отказе (по умолчанию — message.answer)
+        self._notify = notify
+        self._albums = albums
+        self._users: Dict[int, _UserState] = {}
+
+    def _state(self, user_id: int) -> _UserState:
+        state = self._users.get(user_id)
+        if state is None:
+            if len(self._users) >= self.MAX_USERS:
+                self._users = {
+                    uid: s for uid, s in self._users.items() if s.in_flight or not s.bucket.full()
+                }
+            state = self._users[user_id] = _UserState()
+        return state
+
+    async def _warn(self, state: _UserState, event: Message, text: str) -> None:
+        now = time.monotonic()
+        if now - state.warned_at < ADMISSION_WARN_INTERVAL:
+            return
+        state.warned_at = now
+        if self._notify is not None:
+            await self._notify(event, text)
+        else:
+            await event.answer(text)
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not get_flag(data, "admission") or event.from_user is None:
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        state = self._state(user_id)
+        album = event.media_group_id if self._albums else None
+        if album is not None and state.album is not None and state.album[0] == album:
+            # следующая часть альбома: её заберёт хендлер первой части
+            return await handler(event, data) if state.album[1] else None
+        if album is not None:
+            state.album = (album, False)
+        if state.in_flight >= USER_MAX_IN_FLIGHT:
+            log.info("User %s: too many in flight (%s)", user_id, state.in_flight)
+            return await self._warn(state, event, TOO_MANY_IN_FLIGHT_TEXT)
+        if not state.bucket.try_take():
+            wait = max(int(state.bucket.wait_time()) + 1, 1)
+            log.info("User %s: rate limited", user_id)
+            return await self._warn(state, event, RATE_LIMITED_TEXT.format(wait=wait))
+
+        if album is not None:
+            state.album = (album, True)
+        state.in_flight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            state.in_flight -= 1
+
+
+class FairQueue:
+    """
+    Очередь к ограниченному ресурсу (вызовы модели) с обслуживанием по кругу:
+    каждому пользователю с ожидающими запросами — по одному запросу за проход.
+    capacity — функция, а не число: ёмкость может меняться на ходу.
+    """
+
+    def __init__(self, capacity: Callable[[], int]):
+        self._capacity = capacity
+        self._active = 0
+        # user_id -> ожидающие; порядок ключей — порядок обхода по кругу
+        self._waiters: "OrderedDict[int, Deque[asyncio.Future]]" = OrderedDict()
+
+    def depth(self) -> int:
+        """Сколько запросов ждёт своей очереди."""
+        return sum(len(q) for q in self._waiters.values())
+
+    def active(self) -> int:
+        return self._active
+
+    def position(self, user_id: int, fut: asyncio.Future) -> int:
+        """Номер запроса в очереди (1 — следующий), с учётом обхода по кругу."""
+        queue = self._waiters.get(user_id)
+        if queue is None or fut not in queue:
+            return 0
+        k = queue.index(fut)
+        ahead = 0
+        before = True
+        for uid, q in self._waiters.items():
+            if uid == user_id:
+                before = False
+                ahead += k
+                continue
+            # за k полных проходов этот пользователь успеет min(len, k) раз,
+            # и ещё раз в нашем проходе, если стоит раньше нас
+            ahead += min(len(q), k + 1 if before else k)
+        return ahead + 1
+
+    def _wake(self) -> None:
+        while self._waiters and self._active < self._capacity():
+            user_id, queue = self._waiters.popitem(last=False)
+            fut = queue.popleft()
+            if queue:
+                self._waiters[user_id] = queue  # в конец круга
+            if fut.done():  # ожидающий уже отменён
+                continue
+            self._active += 1
+            fut.set_result(None)
+
+    async def acquire(
+        self, user_id: int, on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> None:
+        if not self._waiters and self._active < self._capacity():
+            self._active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(user_id, deque()).append(fut)
+        self._wake()  # ёмкость могла вырасти без release()
+        if on_queued is not None and not fut.done():
+            try:
+                await on_queued(self.position(user_id, fut))
+            except Exception as e:
+                log.warning("Queue notice failed (user %s): %s", user_id, e)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # место уже выдали — вернуть
+            else:
+                self._discard(user_id, fut)
+            raise
+
+    def _discard(self, user_id: int, fut: asyncio.Future) -> None:
+        queue = self._waiters.get(user_id)
+        if queue is not None and fut in queue:
+            queue.remove(fut)
+            if not queue:
+                del self._waiters[user_id]
+
+    def release(self) -> None:
+        self._active -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def turn(self, user_id: int, on_queued: Optional[Callable[[int], Awaitable[None]]] = None):
+        """async with queue.turn(user_id): ... — ждёт своей очереди и держит место."""
+        await self.acquire(user_id, on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Sample:
+    """Итог одного запроса под AdaptiveLimiter: latency (если дошёл до ответа) или overloaded."""
+
+    __slots__ = ("latency", "overloaded")
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.overloaded = False
+
+
+class AdaptiveLimiter:
+    """
+    Лимит одновременных запросов к внешнему сервису по схеме AIMD.
+    Пока задержка в норме и лимит реально выбирается — растёт на ~1 за «окно»
+    из limit запросов; на перегрузку (429, таймаут, 5xx) или p95 задержки выше
+    latency_target — умножается на backoff (не чаще раза в cooldown сек).
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        latency_target: float,
+        backoff: float = 0.7,
+        cooldown: float = 5.0,
+        window: int = 50,
+    ):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self._latencies: Deque[float] = deque(maxlen=window)  # до ответа сервиса
+        self._holds: Deque[float] = deque(maxlen=window)      # сколько держали слот
+        self._in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._last_cut = 0.0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        values = sorted(self._latencies)
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    def expected_wait(self, queued: int) -> float:
+        """Оценка ожидания для запроса, перед которым ещё queued: по среднему времени слота."""
+        if not self._holds:
+            return 0.0
+        mean_hold = sum(self._holds) / len(self._holds)
+        return (queued + 1) / self.limit * mean_hold
+
+    def _wake(self) -> None:
+        while self._waiters and self._in_flight < self.limit:
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self._in_flight += 1
+            fut.set_result(None)
+
+    async def _acquire(self) -> None:
+        if not self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._in_flight -= 1
+                self._wake()
+            else:
+                self._waiters.remove(fut)
+            raise
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._last_cut < self.cooldown:
+            return
+        self._last_cut = now
+        self._limit = max(self.min_limit, self._limit * self.backoff)
+        self._latencies.clear()  # дальше решаем по задержкам уже при новом лимите
+        log.warning("Concurrency limit cut to %s (%s)", self.limit, reason)
+
+    def _release(self, sample: Sample, held: float, saturated: bool) -> None:
+        self._in_flight -= 1
+        if sample.overloaded:
+            self._decrease("overload")
+        elif sample.latency is not None:
+            self._latencies.append(sample.latency)
+            self._holds.append(held)
+            p95 = self.percentile(0.95)
+            if len(self._latencies) >= 10 and p95 > self.latency_target:
+                self._decrease(f"p95 {p95:.1f}s")
+            elif saturated and self._limit < self.max_limit:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        async with limiter.slot() as sample: ... — ждёт свободного места.
+        Внутри надо проставить sample.latency при успехе или sample.overloaded при перегрузке;
+        прочие ошибки лимит не двигают.
+        """
+        await self._acquire()
+        # растём, только если лимит почти выбран: иначе он бы рос и в простое
+        saturated = self._in_flight >= 0.8 * self.limit or bool(self._waiters)
+        sample = Sample()
+        started = time.monotonic()
+        try:
+            yield sample
+        finally:
+            self._release(sample, time.monotonic() - started, saturated)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса: после failure_threshold ошибок подряд
+    размыкается на reset_timeout сек, потом пропускает один пробный запрос
+    (half-open) — по его итогу замыкается или снова размыкается.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def available(self) -> bool:
+        """Пропустит ли сейчас запрос (без побочных эффектов)."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at >= self.reset_timeout
+        return not self._probing
+
+    def allow(self) -> bool:
+        """Берёт разрешение на запрос; в half-open — единственный пробный."""
+        if not self.available():
+            return False
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            log.info("Circuit %s closed", self.name)
+        self.state = self.CLOSED
+        self._failures = 0
+        self._probing = False
+
+    def record_cancel(self) -> None:
+        """Запрос отменён без ответа — пробный слот свободен, счётчики не меняются."""
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                log.warning("Circuit %s open after %s failures", self.name, self._failures)
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
@@ -0,0 +1,94 @@
+# storage.py — единый интерфейс хранилища: лимиты, фидбек, статистика, сбросы, очередь, кэш,
+# журнал событий.
+# Бэкенд выбирается STORAGE_BACKEND: postgres (db_pg.py, по умолчанию) или sqlite (db.py —
+# один файл без сервера, для одного узла и бенчмарков). Остальной код импортирует отсюда.
+
+import os
+import importlib
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+_MODULES = {"postgres": "db_pg", "sqlite": "db"}
+
+# Что обязан реализовать каждый бэкенд — с одинаковыми сигнатурами и смыслом
+__all__ = [
+    "current_month",
+    "init_db",
+    "warm_db",
+    "close_db",
+    "maintain_partitions",
+    "partition_maintenance_loop",
+    "get_quota",
+    "get_count",
+    "inc_count",
+    "reserve_slot",
+    "reserve_up_to",
+    "commit_slot",
+    "release_slot",
+    "already_sent_feedback_this_month",
+    "save_feedback_and_grant_bonus",
+    "claim_feedback",
+    "ack_feedback",
+    "set_admin_code",
+    "consume_admin_code",
+    "enqueue_job",
+    "claim_job",
+    "complete_job",
+    "extend_job",
+    "retry_job",
+    "fail_job",
+    "listen_jobs",
+    "cache_lookup",
+    "cache_store",
+    "cache_prune",
+    "insert_events",
+    "event_breakdown",
+    "event_daily",
+    "month_stats",
+    "reset_all_limits",
+    "reset_bot",
+]
+
+if STORAGE_BACKEND not in _MODULES:
+    raise RuntimeError(f"STORAGE_BACKEND={STORAGE_BACKEND!r}: ожидается один из {', '.join(_MODULES)}")
+
+backend = importlib.import_module(_MODULES[STORAGE_BACKEND])
+
+_missing = [name for name in __all__ if not callable(getattr(backend, name, None))]
+if _missing:
+    raise RuntimeError(f"Бэкенд {STORAGE_BACKEND} не реализует: {', '.join(_missing)}")
+
+current_month = backend.current_month
+init_db = backend.init_db
+warm_db = backend.warm_db
+close_db = backend.close_db
+maintain_partitions = backend.maintain_partitions
+partition_maintenance_loop = backend.partition_maintenance_loop
+get_quota = backend.get_quota
+get_count = backend.get_count
+inc_count = backend.inc_count
+reserve_slot = backend.reserve_slot
+reserve_up_to = backend.reserve_up_to
+commit_slot = backend.commit_slot
+release_slot = backend.release_slot
+already_sent_feedback_this_month = backend.already_sent_feedback_this_month
+save_feedback_and_grant_bonus = backend.save_feedback_and_grant_bonus
+claim_feedback = backend.claim_feedback
+ack_feedback = backend.ack_feedback
+set_admin_code = backend.set_admin_code
+consume_admin_code = backend.consume_admin_code
+enqueue_job = backend.enqueue_job
+claim_job = backend.claim_job
+complete_job = backend.complete_job
+extend_job = backend.extend_job
+retry_job = backend.retry_job
+fail_job = backend.fail_job
+listen_jobs = backend.listen_jobs
+cache_lookup = backend.cache_lookup
+cache_store = backend.cache_store
+cache_prune = backend.cache_prune
+insert_events = backend.insert_events
+event_breakdown = backend.event_breakdown
+event_daily = backend.event_daily
+month_stats = backend.month_stats
+reset_all_limits = backend.reset_all_limits
+reset_bot = backend.reset_bot
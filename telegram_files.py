@@ -0,0 +1,70 @@
+# telegram_files.py — что и как скачивать из Telegram.
+# Берём самое маленькое фото, которого хватает для даунскейла, а документы
+# качаем потоком кусками с жёстким лимитом по байтам.
+
+import os
+from typing import List, Optional
+
+from aiogram import Bot
+from aiogram.types import PhotoSize
+
+from metrics import stage
+
+# Больше этого не качаем (Bot API сам отдаёт файлы только до 20 МБ)
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_BYTES", str(20 * 1024 * 1024)))
+DOWNLOAD_CHUNK = 64 * 1024
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "30"))  # сек
+
+
+class FileTooLarge(ValueError):
+    """Файл больше MAX_DOWNLOAD_BYTES."""
+
+
+def pick_photo_size(sizes: List[PhotoSize], max_side: int) -> PhotoSize:
+    """
+    Самый маленький вариант фото, у которого длинная сторона не меньше max_side
+    (всё равно потом уменьшаем до max_side). Если таких нет — самый большой.
+    """
+    adequate = [p for p in sizes if max(p.width, p.height) >= max_side]
+    if adequate:
+        return min(adequate, key=lambda p: p.width * p.height)
+    return max(sizes, key=lambda p: p.width * p.height)
+
+
+async def download_limited(
+    bot: Bot,
+    file_id: str,
+    size_hint: Optional[int] = None,
+    max_bytes: int = MAX_DOWNLOAD_BYTES,
+) -> bytes:
+    """
+    Скачивает файл в память, но не больше max_bytes.
+    Отказывает как можно раньше: по размеру из сообщения, по ответу getFile
+    и, наконец, прямо во время скачивания, если размер не был известен.
+    """
+    if size_hint and size_hint > max_bytes:
+        raise FileTooLarge(f"{size_hint} байт больше лимита {max_bytes}")
+
+    with stage("tg_get_file"):
+        tg_file = await bot.get_file(file_id)
+    if tg_file.file_size and tg_file.file_size > max_bytes:
+        raise FileTooLarge(f"{tg_file.file_size} байт больше лимита {max_bytes}")
+
+    with stage("tg_download"):
+        if bot.session.api.is_local:
+            # локальный Bot API сервер отдаёт путь к файлу на диске — скачивать нечего
+            stream = await bot.download_file(tg_file.file_path, timeout=DOWNLOAD_TIMEOUT)
+            data = stream.read(max_bytes + 1)
+            if len(data) > max_bytes:
+                raise FileTooLarge(f"файл больше лимита {max_bytes}")
+            return data
+
+        url = bot.session.api.file_url(bot.token, tg_file.file_path)
+        buf = bytearray()
+        async for chunk in bot.session.stream_content(
+            url=url, timeout=DOWNLOAD_TIMEOUT, chunk_size=DOWNLOAD_CHUNK, raise_for_status=True
+        ):
+            buf += chunk
+            if len(buf) > max_bytes:
+                raise FileTooLarge(f"файл больше лимита {max_bytes}")
+        return bytes(buf)
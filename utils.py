@@ -1,31 +1,342 @@
 # utils.py
-# Подготовка изображения: даунскейл и сохранение в JPEG
-from PIL import Image
+# Подготовка изображения: предварительная проверка, план кодирования под бюджет токенов модели,
+# даунскейл и сохранение в JPEG, хэши для кэша разборов.
+# Всё CPU-тяжёлое выполняется в пуле процессов (run_in_pool), чтобы не блокировать event loop.
+# PIL импортируется там же, при первом обращении: процессу бота он не нужен.
+import os
+import math
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import TYPE_CHECKING, NamedTuple, Optional
 from io import BytesIO
 
-def downscale(image_bytes: bytes, max_side: int = 1536, quality: int = 90) -> bytes:
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Сколько процессов под обработку картинок (0 — без пула, в отдельном потоке)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+# Максимум пикселей во входной картинке — защита от «бомб» вида 30000x30000 PNG
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "50000000"))
+
+# Предварительная проверка до вызова модели (prescreen): то, что модель всё равно
+# попросила бы перезалить, отклоняем локально и без списания попытки
+PRESCREEN_ENABLED = os.getenv("PRESCREEN_ENABLED", "1") == "1"
+# Меньше этого по длинной стороне разбирать нечего, px
+PRESCREEN_MIN_SIDE = int(os.getenv("PRESCREEN_MIN_SIDE", "320"))
+# Разброс яркости миниатюры (0..255) и доля пикселей-контуров, ниже которых картинка «пустая»
+PRESCREEN_MIN_STDDEV = float(os.getenv("PRESCREEN_MIN_STDDEV", "4"))
+PRESCREEN_MIN_EDGES = float(os.getenv("PRESCREEN_MIN_EDGES", "0.002"))
+# JPEG с качеством ниже этого (оценка по таблицам квантования) — «пережатый»
+PRESCREEN_MIN_JPEG_QUALITY = int(os.getenv("PRESCREEN_MIN_JPEG_QUALITY", "20"))
+# Отклонять фотографии по EXIF камеры. По умолчанию выключено: сфотографированный
+# на телефон рисунок на бумаге — тоже работа, а EXIF у него как у фото
+PRESCREEN_PHOTOS = os.getenv("PRESCREEN_PHOTOS", "0") == "1"
+# Кодирование для модели (encode_for_model): качество JPEG, его нижняя граница
+# и размер, выше которого качество понижается
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_MIN_JPEG_QUALITY = int(os.getenv("IMAGE_MIN_JPEG_QUALITY", "60"))
+IMAGE_MAX_UPLOAD_KB = int(os.getenv("IMAGE_MAX_UPLOAD_KB", "300"))
+# На сколько (доля) можно уменьшить картинку, чтобы она заняла меньше плиток
+IMAGE_TILE_SNAP = float(os.getenv("IMAGE_TILE_SNAP", "0.15"))
+_TILE_SIDE = 512  # плитка модели в режиме detail=high
+# Миниатюра для проверки на «пустоту»: на 128 px тонкие светлые линии скетча
+# усредняются с фоном и пропадают, на 512 — ещё видны
+_THUMB_SIDE = 512
+_EDGE_LEVEL = 32  # отклик FIND_EDGES, начиная с которого пиксель считается контуром
+# Сегменты JPEG, с которыми файл можно отдать модели как есть: JFIF, ICC-профиль, Adobe.
+# В APP1 (EXIF/XMP) бывают GPS и серийный номер камеры, в APP13 — IPTC с автором;
+# такие файлы всегда перекодируются, и метаданные не уходят ни в OpenAI, ни в хэш кэша
+_SAFE_JPEG_SEGMENTS = {"APP0", "APP2", "APP14"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+class ImageTooLarge(ValueError):
+    """Во входной картинке больше MAX_IMAGE_PIXELS пикселей."""
+
+
+class Rejected(ValueError):
+    """Картинка не прошла предварительную проверку; reason — too_small, blank, low_quality или photo."""
+
+    def __init__(self, reason: str, detail: str = ""):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+
+
+class EncodingPlan(NamedTuple):
+    """Во что превратить картинку для модели: размер, detail и оценка токенов."""
+    width: int
+    height: int
+    detail: str
+    tokens: int
+
+
+class EncodedImage(NamedTuple):
+    """Картинка, готовая к отправке в модель (результат encode_for_model)."""
+    data: bytes
+    detail: str
+    tokens: int            # оценка входных токенов за картинку
+    width: int
+    height: int
+    quality: Optional[int]  # качество JPEG (для неперекодированных — оценка по заголовку)
+
+
+async def run_in_pool(fn, *args, **kwargs):
+    """Выполняет fn(*args, **kwargs) в пуле процессов и ждёт результат, не блокируя loop."""
+    global _pool
+    call = partial(fn, *args, **kwargs)
+    if IMAGE_WORKERS <= 0:
+        return await asyncio.to_thread(call)
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_pool, call)
+    except BrokenProcessPool:
+        # воркер упал (например, OOM на огромной картинке) — пересоздадим пул при следующем вызове
+        _pool = None
+        raise
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+# Стандартная таблица квантования яркости JPEG (IJG, качество 50)
+_STD_LUMA_TABLE_SUM = sum((
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+))
+
+
+def _open(image_bytes: bytes) -> "Image.Image":
+    """
+    Открывает картинку (читает только заголовок) и проверяет число пикселей.
+    Свою проверку делаем по заголовку до декодирования; встроенная в PIL — страховка.
+    """
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    try:
+        im = Image.open(BytesIO(image_bytes))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e)) from e
+    w, h = im.size
+    if w * h > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f"{w}x{h} больше лимита {MAX_IMAGE_PIXELS} пикселей")
+    return im
+
+
+def _to_8bit(im: "Image.Image") -> "Image.Image":
+    """
+    16-битные и float-картинки (PNG I;16, TIFF I/F) — в 8-битную L.
+    Обычный convert("L"/"RGB") у PIL обрезает такие значения до 255, и 16-битный скан
+    становится белым; масштабируем сами: целые — из 16 бит, float — из 0..1.
     """
-    Уменьшает изображение до максимальной стороны max_side (если нужно)
-    и сохраняет в JPEG хорошего качества.
+    if im.mode == "F":
+        lo, hi = im.getextrema()
+        return im.point(lambda v: v * 255).convert("L") if hi <= 1.0 else im.convert("L")
+    return im.convert("I").point(lambda v: v / 256).convert("L")
+
+
+def _has_metadata(im: "Image.Image") -> bool:
+    """Есть ли в JPEG сегменты, которые нельзя отдавать наружу (см. _SAFE_JPEG_SEGMENTS)."""
+    segments = {marker for marker, _ in getattr(im, "applist", ())}
+    return bool(segments - _SAFE_JPEG_SEGMENTS) or "comment" in im.info
 
-    Зачем:
-    - Меньше пикселей = меньше токенов = дешевле и быстрее.
-    - 1536 px по длинной стороне — нормальный баланс качество/цена для MVP.
 
-    Возвращает: байты JPEG.
+def jpeg_quality(im: "Image.Image") -> Optional[int]:
     """
-    im = Image.open(BytesIO(image_bytes)).convert("RGB")
+    Примерное качество JPEG (1..100), с которым его сохраняли, — по таблице
+    квантования яркости из заголовка, без декодирования. None — не JPEG.
+    """
+    tables = getattr(im, "quantization", None)
+    if not tables or 0 not in tables:
+        return None
+    scale = 100 * sum(tables[0]) / _STD_LUMA_TABLE_SUM  # обратная формула libjpeg
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return max(1, min(100, round(quality)))
+
+
+def _has_camera_exif(im: "Image.Image") -> bool:
+    """Производитель/модель камеры и параметры съёмки (выдержка, диафрагма, ISO) в EXIF."""
+    exif = im.getexif()
+    if not (exif.get(0x010F) or exif.get(0x0110)):  # Make, Model
+        return False
+    shot = exif.get_ifd(0x8769)  # Exif IFD
+    return any(tag in shot for tag in (0x829A, 0x829D, 0x8827))  # ExposureTime, FNumber, ISO
+
+
+def prescreen(image_bytes: bytes) -> None:
+    """
+    Дешёвая проверка перед моделью; бросает Rejected, если разбирать нечего.
+
+    - размер и качество JPEG — только по заголовку;
+    - «пустая»/однотонная картинка — по миниатюре 512 px: разброс яркости и доля
+      контуров (ImageStat и FIND_EDGES считаются в C по всей миниатюре сразу);
+      JPEG сразу декодируется уменьшенным и только по яркости (draft);
+    - фотография — по EXIF камеры, если включено PRESCREEN_PHOTOS.
+    """
+    from PIL import Image, ImageFilter, ImageStat
+    im = _open(image_bytes)
     w, h = im.size
+    if max(w, h) < PRESCREEN_MIN_SIDE:
+        raise Rejected("too_small", f"{w}x{h}")
+
+    quality = jpeg_quality(im)
+    if quality is not None and quality < PRESCREEN_MIN_JPEG_QUALITY:
+        raise Rejected("low_quality", f"JPEG quality ~{quality}")
+    if PRESCREEN_PHOTOS and _has_camera_exif(im):
+        raise Rejected("photo", "camera EXIF")
+
+    if im.format == "JPEG":
+        im.draft("L", (_THUMB_SIDE, _THUMB_SIDE))
+    if im.mode in ("P", "PA"):
+        im = im.convert("RGBA")
+    elif im.mode.startswith("I") or im.mode == "F":
+        im = _to_8bit(im)
+    im.thumbnail((_THUMB_SIDE, _THUMB_SIDE))
+    if im.mode in ("RGBA", "LA"):
+        # прозрачный фон считаем белым, иначе линии на прозрачном PNG сольются с ним
+        bg = Image.new("RGBA", im.size, (255, 255, 255, 255))
+        bg.alpha_composite(im.convert("RGBA"))
+        im = bg
+    gray = im.convert("L")
+
+    stddev = ImageStat.Stat(gray).stddev[0]
+    # крайние пиксели FIND_EDGES не фильтрует — отрезаем рамку в 1 px
+    edges = gray.filter(ImageFilter.FIND_EDGES).crop((1, 1, gray.width - 1, gray.height - 1))
+    edge_density = sum(edges.histogram()[_EDGE_LEVEL:]) / max(edges.width * edges.height, 1)
+    # «пустая» — только если низкие оба показателя: ложный отказ хуже лишнего вызова модели
+    if stddev < PRESCREEN_MIN_STDDEV and edge_density < PRESCREEN_MIN_EDGES:
+        raise Rejected("blank", f"stddev {stddev:.1f}, edges {edge_density:.4f}")
+
 
-    # Считаем, нужно ли уменьшать
-    longest = max(w, h)
-    scale = longest / max_side if longest > max_side else 1.0
+def vision_tokens(width: int, height: int, detail: str, base: int, tile: int) -> int:
+    """
+    Сколько входных токенов модель насчитает за картинку width x height.
+
+    detail="low" — всегда base. detail="high" — как считает OpenAI: вписать
+    в 2048x2048, уменьшить до короткой стороны 768 (не увеличивая), затем
+    base + tile за каждую плитку 512x512, которую задевает картинка.
+    """
+    if detail == "low":
+        return base
+    scale = min(1.0, 2048 / max(width, height))
+    if min(width, height) * scale > 768:
+        scale = 768 / min(width, height)
+    w, h = width * scale, height * scale
+    return base + tile * math.ceil(w / _TILE_SIDE) * math.ceil(h / _TILE_SIDE)
+
+
+def plan_encoding(width: int, height: int, budget: int, base: int, tile: int, max_side: int) -> EncodingPlan:
+    """
+    Размер и detail картинки под сетку плиток модели и бюджет токенов budget.
+
+    - больше, чем модель всё равно оставит (2048 / короткая сторона 768) и max_side,
+      не отправляем — это лишние байты без пользы;
+    - из сеток плиток, которые влезают в бюджет, берём дающую самую крупную картинку;
+      если на IMAGE_TILE_SNAP меньше помещается в меньшее число плиток — берём её
+      (картинка 1100x768 занимает 6 плиток, а 1024x715 — 4);
+    - бюджета не хватает даже на одну плитку или картинка и так не больше 512 px —
+      detail="low": за base токенов модель видит её целиком в 512x512.
+    """
+    scale = min(1.0, 2048 / max(width, height), max_side / max(width, height))
+    if min(width, height) * scale > 768:
+        scale = 768 / min(width, height)
+    w, h = width * scale, height * scale
+    max_tiles = (budget - base) // tile
+    if max(w, h) <= _TILE_SIDE or max_tiles < 1:
+        low = min(1.0, _TILE_SIDE / max(w, h))
+        return EncodingPlan(max(int(w * low), 1), max(int(h * low), 1), "low", base)
 
-    if scale > 1.0:
-        new_w = int(w / scale)
-        new_h = int(h / scale)
-        im = im.resize((new_w, new_h), Image.LANCZOS)
+    # для каждого числа плиток — наибольший масштаб, при котором картинка в них влезает
+    best = {}
+    for cols in range(1, math.ceil(w / _TILE_SIDE) + 1):
+        for rows in range(1, math.ceil(h / _TILE_SIDE) + 1):
+            if cols * rows > max_tiles:
+                break
+            k = min(1.0, cols * _TILE_SIDE / w, rows * _TILE_SIDE / h)
+            best[cols * rows] = max(best.get(cols * rows, 0.0), k)
+    top = max(best.values())
+    k = next(best[t] for t in sorted(best) if best[t] >= top * (1 - IMAGE_TILE_SNAP))
+    out_w, out_h = max(int(w * k), 1), max(int(h * k), 1)
+    return EncodingPlan(out_w, out_h, "high", vision_tokens(out_w, out_h, "high", base, tile))
+
+
+def encode_for_model(image_bytes: bytes, budget: int, base: int, tile: int, max_side: int) -> EncodedImage:
+    """
+    Готовит картинку для модели по плану plan_encoding: уменьшает и сохраняет в JPEG.
+
+    Качество — IMAGE_JPEG_QUALITY; если файл выходит больше IMAGE_MAX_UPLOAD_KB,
+    качество понижается ступенями до IMAGE_MIN_JPEG_QUALITY (меньше base64 в запросе —
+    быстрее отправка). На токены качество не влияет, только на размер запроса.
+
+    Быстрые пути:
+    - JPEG уже RGB, нужного размера, не тяжелее лимита и без метаданных (EXIF, XMP, IPTC,
+      комментарий) — отдаём как есть, без перекодирования. Сохранённый PIL JPEG их не содержит.
+    - Большой JPEG декодируется сразу уменьшенным (draft: 1/2, 1/4, 1/8 на этапе IDCT).
+    """
+    from PIL import Image
+    im = _open(image_bytes)
+    w, h = im.size
+
+    plan = plan_encoding(w, h, budget, base, tile, max_side)
+    max_bytes = IMAGE_MAX_UPLOAD_KB * 1024
+    if (
+        (plan.width, plan.height) == (w, h)
+        and im.format == "JPEG" and im.mode == "RGB"
+        and len(image_bytes) <= max_bytes
+        and not _has_metadata(im)
+    ):
+        return EncodedImage(image_bytes, plan.detail, plan.tokens, w, h, jpeg_quality(im))
+
+    if im.format == "JPEG" and (plan.width, plan.height) != (w, h):
+        # draft выберет ближайший масштаб, при котором картинка не меньше запрошенной
+        im.draft("RGB", (plan.width, plan.height))
+    if im.mode.startswith("I") or im.mode == "F":
+        im = _to_8bit(im)
+    im = im.convert("RGB")
+    if im.size != (plan.width, plan.height):
+        im = im.resize((plan.width, plan.height), Image.LANCZOS)
+
+    quality = IMAGE_JPEG_QUALITY
+    while True:
+        out = BytesIO()
+        # comment="" — иначе PIL перенесёт COM-сегмент исходного JPEG (EXIF он сам не переносит)
+        im.save(out, format="JPEG", quality=quality, optimize=True, comment="")
+        if out.tell() <= max_bytes or quality <= IMAGE_MIN_JPEG_QUALITY:
+            break
+        quality = max(quality - 10, IMAGE_MIN_JPEG_QUALITY)
+    return EncodedImage(out.getvalue(), plan.detail, plan.tokens, plan.width, plan.height, quality)
+
+
+def image_hashes(jpeg_bytes: bytes) -> tuple[str, int]:
+    """
+    Ключи для кэша разборов: (sha256 байтов, перцептивный dHash).
+
+    sha256 ловит точные повторы (пересылки, повторная отправка),
+    dHash — те же картинки после пережатия/ресайза мессенджером.
+    dHash: уменьшаем до 9x8 в градациях серого и сравниваем соседние пиксели —
+    получается 64 бита. Приводим к знаковому int64, чтобы влез в BIGINT.
+    """
+    sha = hashlib.sha256(jpeg_bytes).hexdigest()
 
-    out = BytesIO()
-    im.save(out, format="JPEG", quality=quality, optimize=True)
-    return out.getvalue()
+    from PIL import Image
+    im = Image.open(BytesIO(jpeg_bytes)).convert("L").resize((9, 8), Image.LANCZOS)
+    px = im.tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = px[row * 9 + col]
+            right = px[row * 9 + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    if bits >= 1 << 63:
+        bits -= 1 << 64
+    return sha, bits
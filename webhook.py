@@ -0,0 +1,70 @@
+# webhook.py — запуск бота в режиме вебхука (aiohttp) вместо polling.
+# Процесс не хранит состояние между апдейтами (всё общее — в Postgres), поэтому
+# реплик можно поднять сколько угодно за балансировщиком. Исключение — сборка альбомов
+# в памяти процесса: здесь она по умолчанию выключена (см. ALBUM_BATCH_WEBHOOK в main.py).
+# Запуск: python webhook.py
+#
+# Переменные окружения:
+#   WEBHOOK_URL    — публичный https-адрес, куда Telegram шлёт апдейты (например, https://bot.example.com/webhook)
+#   WEBHOOK_SECRET — секрет, который Telegram передаёт в X-Telegram-Bot-Api-Secret-Token
+#   WEBHOOK_PATH   — путь обработчика (по умолчанию /webhook)
+#   PORT           — порт, который слушает процесс (по умолчанию 8080)
+#   ALBUM_BATCH_WEBHOOK=1 — разбирать альбом одним запросом; только если реплика одна
+#                    или апдейты одного чата всегда попадают в одну реплику
+#   QUOTA_CACHE_TTL — кэш квоты в памяти процесса здесь по умолчанию выключен (0):
+#                    запись на одной реплике не сбрасывает кэш других
+
+import os
+import logging
+from urllib.parse import urlparse
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from main import bot, dp
+
+log = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or urlparse(WEBHOOK_URL or "").path or "/webhook"
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+PORT = int(os.getenv("PORT", "8080"))
+
+
+async def set_webhook() -> None:
+    """
+    Регистрирует вебхук в Telegram. Вызов идемпотентный, так что его
+    спокойно делает каждая реплика при старте.
+    """
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    log.info("Webhook set: %s", WEBHOOK_URL)
+
+
+async def healthz(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика."""
+    return web.Response(text="ok")
+
+
+def build_app() -> web.Application:
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("Не заданы WEBHOOK_URL или WEBHOOK_SECRET.")
+
+    dp.startup.register(set_webhook)
+
+    app = web.Application()
+    app.router.add_get("/healthz", healthz)
+    # Запросы без правильного секрета отклоняются с 401;
+    # апдейт обрабатывается в фоне, Telegram сразу получает 200
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(build_app(), port=PORT)
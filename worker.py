@@ -0,0 +1,207 @@
+# worker.py — воркер очереди разборов (таблица jobs в хранилище, см. storage.py).
+# Забирает задачи, которые ставят хендлеры бота при JOB_QUEUE=1, и прогоняет
+# их через pipeline.process_image. Процессов-воркеров может быть сколько угодно,
+# независимо от числа процессов бота. Запуск: python worker.py
+
+import os
+import time
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from storage import (
+    init_db,
+    warm_db,
+    claim_job,
+    complete_job,
+    extend_job,
+    retry_job,
+    fail_job,
+    listen_jobs,
+    release_slot,
+    close_db,
+)
+from llm import close as close_llm, warm as warm_llm, ModelUnavailable
+from utils import shutdown_pool
+from outbox import send_message
+from pipeline import process_image, user_error_text, ERROR_TEXT, OVERLOADED_TEXT, Overloaded
+from events import recorder
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер, как в main.py
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Сколько задач один процесс ведёт одновременно
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+# Сколько сек задача невидима для других воркеров после захвата; пока разбор идёт,
+# воркер продлевает её каждые JOB_HEARTBEAT_INTERVAL сек. Не продлил (воркер умер) —
+# задачу заберёт другой
+JOB_VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "300"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", str(JOB_VISIBILITY_TIMEOUT / 3)))
+# Бронь квоты, сделанная ботом при постановке задачи, живёт QUOTA_RESERVATION_TTL сек
+# (как в storage). Ожидание в очереди плюс разбор должны уложиться в неё с запасом
+# JOB_DEADLINE_MARGIN: иначе бронь истечёт раньше и пользователь выйдет за FREE_LIMIT
+QUOTA_RESERVATION_TTL = int(os.getenv("QUOTA_RESERVATION_TTL", "600"))
+JOB_DEADLINE_MARGIN = float(os.getenv("JOB_DEADLINE_MARGIN", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))    # сек, удваивается с каждой попыткой
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))  # страховка, если NOTIFY потерялся
+
+if not TELEGRAM_BOT_TOKEN or not OPENAI_API_KEY:
+    raise RuntimeError("Не заданы TELEGRAM_BOT_TOKEN или OPENAI_API_KEY.")
+
+
+class LeaseLost(RuntimeError):
+    """Задачу перехватил другой воркер — этот её больше не трогает (ни задачу, ни бронь)."""
+
+
+class JobExpired(RuntimeError):
+    """Задача не уложилась в срок брони квоты."""
+
+
+async def _run_leased(job, work, deadline: float) -> None:
+    """
+    Выполняет work, продлевая невидимость задачи каждые JOB_HEARTBEAT_INTERVAL сек.
+    deadline (time.monotonic) прошёл — прерывает работу и бросает JobExpired;
+    задача перехвачена — прерывает и бросает LeaseLost.
+    """
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise JobExpired(f"дольше {QUOTA_RESERVATION_TTL - JOB_DEADLINE_MARGIN:.0f} сек с постановки")
+            done, _ = await asyncio.wait({task}, timeout=min(JOB_HEARTBEAT_INTERVAL, left))
+            if done:
+                return task.result()
+            try:
+                extended = await extend_job(job["id"], job["lease"], JOB_VISIBILITY_TIMEOUT)
+            except Exception as e:
+                # БД моргнула — попробуем на следующем тике, невидимость ещё не истекла
+                log.warning("Job %s: heartbeat failed: %s", job["id"], e)
+                continue
+            if not extended:
+                raise LeaseLost(f"lease {job['lease']}")
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+async def _give_up(bot: Bot, job, error: str, text: str) -> None:
+    """
+    Окончательная неудача: снимаем бронь и говорим пользователю.
+    Если слот задачи уже списан (сорвалась только доставка), release_slot его не тронет.
+    """
+    if not await fail_job(job["id"], job["lease"], error):
+        log.warning("Job %s: taken over by another worker, leaving it", job["id"])
+        return
+    await release_slot(job["user_id"], job_id=job["id"])
+    try:
+        await send_message(bot, job["chat_id"], text)
+    except Exception as e:
+        log.error("Job %s: failed to notify user: %s", job["id"], e)
+
+
+async def handle_job(bot: Bot, job) -> None:
+    if job["attempts"] > JOB_MAX_ATTEMPTS:
+        # задачу уже брали максимум раз и воркер каждый раз умирал на ней
+        log.error("Job %s: exceeded %s attempts", job["id"], JOB_MAX_ATTEMPTS)
+        return await _give_up(bot, job, job["last_error"] or "worker lost", ERROR_TEXT)
+
+    # срок считаем от постановки задачи: бронь квоты сделана тогда же
+    deadline = time.monotonic() + QUOTA_RESERVATION_TTL - JOB_DEADLINE_MARGIN - job["age"]
+    async with recorder.track("job", job["user_id"]) as ev:
+        try:
+            await _run_leased(job, process_image(
+                bot,
+                job["user_id"],
+                job["chat_id"],
+                job["file_id"],
+                job["file_size"],
+                job["placeholder_id"],
+                job["id"],
+            ), deadline)
+        except LeaseLost as e:
+            log.warning("Job %s: taken over by another worker (%s), dropping it", job["id"], e)
+            ev.update(outcome="lost", error=type(e).__name__)
+            return
+        except JobExpired as e:
+            log.error("Job %s expired: %s", job["id"], e)
+            ev.update(outcome="expired", error=type(e).__name__)
+            return await _give_up(bot, job, repr(e), OVERLOADED_TEXT)
+        except (Overloaded, ModelUnavailable) as e:
+            # модель перегружена или недоступна — задача подождёт в очереди, попытка не засчитывается
+            log.info("Job %s: deferred (%s)", job["id"], e)
+            ev.update(outcome="deferred", error=type(e).__name__)
+            return await retry_job(job["id"], job["lease"], JOB_RETRY_DELAY, repr(e), refund_attempt=True)
+        except Exception as e:
+            text = user_error_text(e)
+            ev.update(outcome="rejected" if text else "error", error=type(e).__name__)
+            if text is None and job["attempts"] < JOB_MAX_ATTEMPTS:
+                delay = JOB_RETRY_DELAY * 2 ** (job["attempts"] - 1)
+                log.warning("Job %s: attempt %s failed (%s), retry in %.0fs", job["id"], job["attempts"], e, delay)
+                return await retry_job(job["id"], job["lease"], delay, repr(e))
+            log.error("Job %s failed: %s", job["id"], e)
+            return await _give_up(bot, job, repr(e), text or ERROR_TEXT)
+
+    if not await complete_job(job["id"], job["lease"]):
+        log.warning("Job %s: taken over by another worker before completion", job["id"])
+
+
+async def worker_loop(bot: Bot, wakeup: asyncio.Event) -> None:
+    while True:
+        try:
+            job = await claim_job(JOB_VISIBILITY_TIMEOUT)
+        except Exception as e:
+            log.error("claim_job failed: %s", e)
+            job = None
+        if job is None:
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await handle_job(bot, job)
+        except Exception as e:
+            # БД недоступна и т.п. — задача вернётся в очередь по таймауту видимости
+            log.error("Job %s: unexpected error: %s", job["id"], e)
+
+
+async def main():
+    await init_db()
+    metrics.start_server(metrics.WORKER_METRICS_PORT)
+    lag_task = asyncio.create_task(metrics.loop_lag_monitor())
+    events_task = asyncio.create_task(recorder.run())
+    # пулы БД и OpenAI прогреваются, пока воркер уже забирает задачи
+    warm_task = asyncio.gather(warm_db(), warm_llm(), return_exceptions=True)
+    bot = Bot(
+        TELEGRAM_BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+    )
+    wakeup = asyncio.Event()
+    listener = await listen_jobs(wakeup.set)
+    log.info("Worker is up. concurrency=%s", JOB_WORKER_CONCURRENCY)
+    try:
+        await asyncio.gather(*(worker_loop(bot, wakeup) for _ in range(JOB_WORKER_CONCURRENCY)))
+    finally:
+        lag_task.cancel()
+        events_task.cancel()
+        warm_task.cancel()
+        await recorder.flush()
+        await listener.close()
+        await close_llm()
+        shutdown_pool()
+        await close_db()
+        await bot.session.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())